@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatBot.settings')
 
 application = get_asgi_application()
+
+# Product catalog snapshot is per process, build it before the first message
+from instabot.catalog import warm_catalog  # noqa: E402
+
+warm_catalog()
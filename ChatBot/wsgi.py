@@ -15,3 +15,8 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatBot.settings')
 
 application = get_wsgi_application()
 app = application
+
+# Product catalog snapshot is per process, build it before the first message
+from instabot.catalog import warm_catalog  # noqa: E402
+
+warm_catalog()
@@ -1,6 +1,5 @@
 from django.contrib import admin
-from .models import InstaBotMessage, Product, ConversationSession, Purchase, Customer
-import json
+from .models import InstaBotMessage, Product, ConversationSession, Purchase, PurchaseItem, Customer, WebhookEvent, IntentCacheEntry, KeywordRule, CircuitBreakerState, OutboundMessage, ProcessedEvent, DailyStat, DailyProductStat, ArchivedMessage
 
 
 @admin.register(Product)
@@ -16,12 +15,24 @@ class ProductAdmin(admin.ModelAdmin):
     created_display.short_description = 'Статус'
 
 
+class PurchaseItemInline(admin.TabularInline):
+    model = PurchaseItem
+    fields = ['product', 'product_name', 'quantity', 'price', 'subtotal']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
 @admin.register(Purchase)
 class PurchaseAdmin(admin.ModelAdmin):
     list_display = ['id', 'sender_id', 'phone_number', 'total_amount', 'timestamp', 'products_summary']
     list_filter = ['timestamp']
     search_fields = ['sender_id', 'phone_number', 'address']
     readonly_fields = ['timestamp', 'products_detail', 'customer_last_message']
+    exclude = ['products_data']
+    inlines = [PurchaseItemInline]
+    # Skip the unfiltered COUNT(*) over all orders when searching or filtering
+    show_full_result_count = False
 
     def products_summary(self, obj):
         try:
@@ -55,7 +66,7 @@ class ConversationSessionAdmin(admin.ModelAdmin):
     list_display = ['sender_id', 'current_state', 'cart_summary', 'updated_at']
     list_filter = ['current_state', 'updated_at']
     search_fields = ['sender_id']
-    readonly_fields = ['created_at', 'updated_at', 'cart_detail']
+    readonly_fields = ['created_at', 'updated_at', 'cart_detail', 'conversation_summary', 'summarized_until']
     actions = ['reset_sessions']
 
     def cart_summary(self, obj):
@@ -72,20 +83,13 @@ class ConversationSessionAdmin(admin.ModelAdmin):
             return "Корзина пуста"
 
         try:
-            from .models import Product
-            detail = []
-            total = 0
-            for item in products:
-                try:
-                    product = Product.objects.get(id=item['product_id'])
-                    quantity = item['quantity']
-                    subtotal = product.price * quantity
-                    total += subtotal
-                    detail.append(f"• {product.name} x{quantity} = {subtotal} сом")
-                except Product.DoesNotExist:
-                    detail.append(f"• Товар ID:{item['product_id']} (не найден) x{item['quantity']}")
-
-            detail.append(f"\nИтого: {total} сом")
+            from .cart import price_cart
+            cart = price_cart(products)
+            detail = [str(line) for line in cart.lines]
+            for item in cart.missing:
+                detail.append(f"• Товар ID:{item['product_id']} (не найден) x{item['quantity']}")
+
+            detail.append(f"\nИтого: {cart.total} сом")
             return "\n".join(detail)
         except:
             return "Ошибка загрузки корзины"
@@ -122,3 +126,76 @@ class CustomerAdmin(admin.ModelAdmin):
     search_fields = ['sender_id', 'phone_number']
     readonly_fields = ['timestamp']
 
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'status', 'attempts', 'created_at', 'wait_ms', 'processing_ms']
+    list_filter = ['status', 'created_at']
+    readonly_fields = ['created_at', 'started_at', 'finished_at', 'wait_ms', 'processing_ms']
+
+
+@admin.register(IntentCacheEntry)
+class IntentCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ['text', 'intent', 'hits', 'misses', 'updated_at']
+    list_filter = ['intent']
+    search_fields = ['text']
+    readonly_fields = ['key', 'created_at']
+
+
+@admin.register(KeywordRule)
+class KeywordRuleAdmin(admin.ModelAdmin):
+    list_display = ['keyword', 'intent', 'weight', 'active']
+    list_filter = ['intent', 'active']
+    search_fields = ['keyword']
+    list_editable = ['weight', 'active']
+
+
+@admin.register(CircuitBreakerState)
+class CircuitBreakerStateAdmin(admin.ModelAdmin):
+    list_display = ['name', 'state', 'failure_count', 'opened_at', 'short_circuited', 'total_open_seconds']
+    readonly_fields = ['opened_at', 'probe_started_at', 'last_success_at', 'last_failure_at', 'short_circuited', 'total_open_seconds', 'updated_at']
+
+
+@admin.register(OutboundMessage)
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ['recipient_id', 'status', 'attempts', 'next_attempt_at', 'created_at', 'wait_ms']
+    list_filter = ['status', 'created_at']
+    search_fields = ['recipient_id', 'text']
+    readonly_fields = ['created_at', 'sent_at', 'wait_ms']
+
+
+@admin.register(ProcessedEvent)
+class ProcessedEventAdmin(admin.ModelAdmin):
+    list_display = ['key', 'created_at']
+    search_fields = ['key']
+    readonly_fields = ['key', 'created_at']
+
+
+@admin.register(DailyStat)
+class DailyStatAdmin(admin.ModelAdmin):
+    list_display = ['day', 'messages', 'new_sessions', 'orders', 'revenue', 'updated_at']
+    date_hierarchy = 'day'
+    readonly_fields = ['day', 'messages', 'new_sessions', 'orders', 'revenue', 'updated_at']
+
+
+@admin.register(DailyProductStat)
+class DailyProductStatAdmin(admin.ModelAdmin):
+    list_display = ['day', 'product_name', 'quantity', 'revenue']
+    list_filter = ['day']
+    search_fields = ['product_name']
+    readonly_fields = ['day', 'product', 'product_name', 'quantity', 'revenue']
+
+
+@admin.register(ArchivedMessage)
+class ArchivedMessageAdmin(admin.ModelAdmin):
+    list_display = ['sender_id', 'role', 'content_preview', 'timestamp', 'archived_at']
+    list_filter = ['role']
+    search_fields = ['sender_id']
+    readonly_fields = ['message_id', 'sender_id', 'role', 'content', 'timestamp', 'archived_at']
+    show_full_result_count = False
+
+    def content_preview(self, obj):
+        return obj.content[:100] + '...' if len(obj.content) > 100 else obj.content
+
+    content_preview.short_description = 'Сообщение'
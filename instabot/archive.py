@@ -0,0 +1,72 @@
+import gzip
+import json
+import logging
+import os
+
+from decouple import config
+from django.utils import timezone
+
+from .models import ArchivedMessage, InstaBotMessage
+
+logger = logging.getLogger(__name__)
+
+# Directory for gzipped JSON lines exports of archived messages, empty disables the export
+ARCHIVE_EXPORT_DIR = config('ARCHIVE_EXPORT_DIR', default='')
+
+ARCHIVE_FIELDS = ('id', 'sender_id', 'role', 'content', 'timestamp')
+
+
+class MessageArchive:
+    """Copies messages into ArchivedMessage and, if export_dir is set, a .jsonl.gz file.
+
+    Used as a context manager around retention.purge_expired_messages, which calls add()
+    with the ids of every batch before deleting them from the live table. One export file
+    is written per run; rows archived again after an interrupted run are skipped by the table
+    but may appear twice in the exports, the id field identifies them.
+    """
+
+    def __init__(self, export_dir=ARCHIVE_EXPORT_DIR):
+        self.export_dir = export_dir
+        self.path = None
+        self.archived = 0
+        self._file = None
+
+    def __enter__(self):
+        if self.export_dir:
+            os.makedirs(self.export_dir, exist_ok=True)
+            self.path = os.path.join(self.export_dir, f'messages-{timezone.now():%Y%m%d-%H%M%S}.jsonl.gz')
+            self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file:
+            self._file.close()
+            self._file = None
+            if not self.archived:
+                os.remove(self.path)
+                self.path = None
+
+    def add(self, ids):
+        """Copy messages with these ids, returns number copied"""
+        rows = list(InstaBotMessage.objects.filter(pk__in=ids).order_by('pk').values(*ARCHIVE_FIELDS))
+        ArchivedMessage.objects.bulk_create(
+            [
+                ArchivedMessage(
+                    message_id=row['id'],
+                    sender_id=row['sender_id'],
+                    role=row['role'],
+                    content=row['content'],
+                    timestamp=row['timestamp'],
+                )
+                for row in rows
+            ],
+            ignore_conflicts=True
+        )
+
+        if self._file:
+            # Written before the batch commits, a failed batch is exported again on the next run
+            self._file.writelines(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows)
+            self._file.flush()
+
+        self.archived += len(rows)
+        return len(rows)
@@ -0,0 +1,360 @@
+"""ASGI webhook path.
+
+Only the AI calls are async (AsyncGroq). ORM access, the sync state handlers and the local
+intent model run in threads through sync_to_async, and replies go through the shared
+graph_api outbox, which sends from its own thread pool with requests: Graph API sends are
+not async. Session changes are written once per message by session_store.commit, handlers
+only change fields.
+
+Messages of a sender are handled in order across the requests one process serves. Several
+ASGI worker processes do not coordinate, deployments that need strict per-sender order
+across processes use WEBHOOK_QUEUE_MODE.
+"""
+import asyncio
+import json
+import logging
+import weakref
+
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from groq import AsyncGroq
+
+from . import graph_api, streaming, tracing, views
+from .dedupe import event_deduplicator, event_key
+from .event_queue import enqueue_event
+from .intent_cache import intent_cache
+from .intent_model import predict_intent
+from .models import InstaBotMessage
+from .session_store import session_store
+
+logger = logging.getLogger(__name__)
+
+async_client = AsyncGroq(
+    api_key=config("OPENAI_API_KEY"),
+    base_url=config("GROQ_BASE_URL", default="") or None,
+)
+
+@csrf_exempt
+async def webhook_async(request):
+    """ASGI variant of views.webhook: AI calls do not block a thread"""
+    if request.method == 'GET':
+        return views.webhook(request)
+
+    elif request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+
+            if views.WEBHOOK_QUEUE_MODE:
+                await sync_to_async(enqueue_event)(request.body)
+                return JsonResponse({"status": "Event queued"})
+
+            await dispatch_webhook_payload_async(data)
+            return JsonResponse({"status": "Event processed"})
+
+        except Exception as e:
+            logger.error(f"Webhook error: {str(e)}")
+            return JsonResponse({"error": str(e)}, status=400)
+
+    return HttpResponse(status=405)
+
+
+async def dispatch_webhook_payload_async(data):
+    """Process messaging events concurrently across senders and in order per sender"""
+    events_by_sender = {}
+    for entry in data.get("entry", []):
+        if 'messaging' in entry:
+            for event in entry['messaging']:
+                sender_id = event.get("sender", {}).get("id")
+                events_by_sender.setdefault(sender_id, []).append(event)
+        elif 'comments' in entry:
+            await sync_to_async(views.process_comment)(entry['comments'])
+        elif 'mention' in entry:
+            await sync_to_async(views.process_mention)(entry['mention'])
+
+    await asyncio.gather(*[
+        process_sender_events_async(sender_id, events) for sender_id, events in events_by_sender.items()
+    ])
+
+
+# sender_id -> lock held while the sender's events are processed, dropped once nobody waits on it
+_sender_locks = weakref.WeakValueDictionary()
+
+
+def sender_lock(sender_id):
+    lock = _sender_locks.get(sender_id)
+    if lock is None:
+        lock = _sender_locks[sender_id] = asyncio.Lock()
+    return lock
+
+
+async def process_sender_events_async(sender_id, events):
+    """Process events of one sender in order, after those of earlier requests (the lock is FIFO)"""
+    async with sender_lock(sender_id):
+        for event in events:
+            await process_messaging_event_async(event)
+
+
+async def process_messaging_event_async(event):
+    message = event.get("message", {})
+    sender_id = event.get("sender", {}).get("id")
+
+    if sender_id == views.BOT_ID:
+        return
+
+    text = message.get("text")
+    if not text:
+        return
+
+    with tracing.trace(sender_id):
+        await process_text_message_async(sender_id, text, event)
+
+
+async def process_text_message_async(sender_id, text, event):
+    """Async variant of views.process_text_message"""
+    # Replays seen by this worker are dropped without leaving the event loop
+    key = event_key(event)
+    with tracing.stage('dedupe'):
+        duplicate = event_deduplicator.seen(key) or not await sync_to_async(event_deduplicator.claim)(key)
+    if duplicate:
+        logger.info(f"Dropping duplicate event {key} from {sender_id}")
+        return
+
+    try:
+        with tracing.stage('save_message'):
+            await InstaBotMessage.objects.acreate(
+                sender_id=sender_id,
+                role="user",
+                content=text
+            )
+
+        with tracing.stage('session'):
+            session = await sync_to_async(session_store.load)(sender_id)
+
+        with tracing.stage(f'state:{session.current_state}'), streaming.stream_to(str(sender_id)) as target:
+            reply = await handle_conversation_flow_async(session, text)
+
+        with tracing.stage('session_write'):
+            await sync_to_async(session_store.commit)(session)
+
+        with tracing.stage('save_reply'):
+            await InstaBotMessage.objects.acreate(
+                sender_id=sender_id,
+                role="assistant",
+                content=reply
+            )
+
+        remainder = target.remainder(reply)
+        if remainder:
+            await send_message_async(remainder, str(sender_id))
+
+    except Exception as e:
+        logger.error(f"Error processing message from {sender_id}: {str(e)}")
+        session_store.evict(sender_id)
+        await sync_to_async(event_deduplicator.release)(key)
+        fallback_message = "Извините, произошла техническая ошибка. Попробуйте еще раз или напишите 'помощь' для начала."
+        await send_message_async(fallback_message, str(sender_id))
+
+    with tracing.stage('send'):
+        await sync_to_async(graph_api.get_outbox().flush, thread_sensitive=False)(str(sender_id))
+
+
+async def handle_conversation_flow_async(session, user_message):
+    """Async conversation flow: only states that may call the AI are reimplemented,
+    the rest reuse the sync handlers in a worker thread"""
+
+    ai_handlers = {
+        'idle': handle_idle_state_async,
+        'post_purchase': handle_post_purchase_state_async,
+        'browsing': handle_browsing_state_async,
+        'complaint': handle_complaint_state_async,
+        'inquiry': handle_inquiry_state_async,
+    }
+
+    is_reset = user_message.lower() in ['помощь', 'начать', 'старт', 'reset']
+    is_confirmation = user_message.strip().lower() == "подтвердить"
+
+    handler = ai_handlers.get(session.current_state)
+    if handler is None or is_reset or is_confirmation:
+        return await sync_to_async(views.handle_conversation_flow)(session, user_message)
+
+    try:
+        return await handler(session, user_message)
+    except Exception as e:
+        logger.error(f"Error in conversation flow for {session.sender_id}: {str(e)}")
+        # Deferred like every save() of a loaded session, no database access here
+        session.reset_session()
+        return "Произошла ошибка. Давайте начнем сначала. Чем могу помочь?"
+
+
+async def handle_idle_state_async(session, user_message):
+    try:
+        if await sync_to_async(views.has_recent_purchase)(session.sender_id):
+            session.current_state = 'post_purchase'
+            return await handle_post_purchase_state_async(session, user_message)
+
+        intent = await classify_intent_async(user_message)
+
+        reply = await sync_to_async(views.route_idle_intent)(session, intent)
+        if reply is None:
+            return await generate_ai_response_async(session, user_message)
+        return reply
+
+    except Exception as e:
+        logger.error(f"Error in idle state for {session.sender_id}: {str(e)}")
+        return "Привет! Чем могу помочь? Могу показать каталог товаров или ответить на ваши вопросы."
+
+
+async def handle_post_purchase_state_async(session, user_message):
+    try:
+        reply = await sync_to_async(views.route_post_purchase)(session, user_message)
+        if reply is not None:
+            return reply
+
+        return await generate_ai_response_async(session, user_message)
+
+    except Exception as e:
+        logger.error(f"Error in post-purchase state for {session.sender_id}: {str(e)}")
+        session.current_state = 'idle'
+        return "Спасибо за заказ! Чем еще могу помочь?"
+
+
+async def handle_browsing_state_async(session, user_message):
+    try:
+        reply = await sync_to_async(views.route_browsing)(session, user_message)
+        if reply is not None:
+            return reply
+
+        return await generate_ai_response_async(session, user_message)
+
+    except Exception as e:
+        logger.error(f"Error in browsing state for {session.sender_id}: {str(e)}")
+        catalog = await sync_to_async(views.format_product_catalog)()
+        return f"Вот наш каталог:\n\n{catalog}\n\nЧто вас интересует?"
+
+
+async def handle_complaint_state_async(session, user_message):
+    try:
+        session.current_state = 'idle'
+
+        response = await generate_ai_response_async(session, user_message)
+        response += "\n\nВаша жалоба принята. Мы обязательно разберем ситуацию."
+        return response
+
+    except Exception as e:
+        logger.error(f"Error handling complaint for {session.sender_id}: {str(e)}")
+        return "Мне очень жаль, что у вас возникли проблемы. Мы обязательно разберем ситуацию."
+
+
+async def handle_inquiry_state_async(session, user_message):
+    try:
+        session.current_state = 'idle'
+
+        return await generate_ai_response_async(session, user_message)
+
+    except Exception as e:
+        logger.error(f"Error handling inquiry for {session.sender_id}: {str(e)}")
+        return "Чем могу помочь? Могу показать каталог товаров или ответить на ваши вопросы."
+
+
+@tracing.timed('classify_intent')
+async def classify_intent_async(user_message):
+    """Async variant of views.classify_intent"""
+
+    intent = await sync_to_async(views.classify_intent_by_keywords)(user_message)
+    if intent:
+        return intent
+
+    intent = await sync_to_async(intent_cache.get)(user_message)
+    if intent:
+        return intent
+
+    # Loading the model file and inference are CPU work, kept off the event loop
+    intent = await sync_to_async(predict_intent, thread_sensitive=False)(user_message)
+    if intent:
+        return intent
+
+    if await sync_to_async(views.is_ai_api_healthy)():
+        try:
+            completion = await async_client.chat.completions.create(
+                model="google/gemma-3n-e4b-it",
+                messages=views.get_intent_messages(user_message),
+                timeout=views.AI_API_TIMEOUT,
+                max_tokens=20
+            )
+
+            intent = completion.choices[0].message.content.strip().upper()
+            tracing.record_tokens('intent', completion.usage)
+            await sync_to_async(views.record_ai_success)()
+
+            if intent in views.INTENTS:
+                await sync_to_async(intent_cache.set)(user_message, intent)
+                return intent
+
+        except Exception as e:
+            logger.error(f"Error classifying intent with AI: {str(e)}")
+            await sync_to_async(views.record_ai_failure)()
+
+    return 'ПРОЧЕЕ'
+
+
+@tracing.timed('ai_response')
+async def generate_ai_response_async(session, user_message):
+    """Async variant of views.generate_ai_response"""
+
+    if not await sync_to_async(views.is_ai_api_healthy)():
+        logger.warning(f"AI API unhealthy, using fallback for {session.sender_id}")
+        return await sync_to_async(views.get_fallback_response)(session.current_state, user_message)
+
+    target = streaming.current_target()
+
+    try:
+        messages = await sync_to_async(views.build_ai_messages)(session)
+
+        if target is not None:
+            await send_typing_async(target.recipient_id)
+            stream = await async_client.chat.completions.create(
+                model="google/gemma-3n-e4b-it",
+                messages=messages,
+                timeout=views.AI_API_TIMEOUT,
+                max_tokens=200,
+                stream=True
+            )
+            response = await streaming.deliver_stream_async(stream, target, send_stream_chunk_async)
+        else:
+            completion = await async_client.chat.completions.create(
+                model="google/gemma-3n-e4b-it",
+                messages=messages,
+                timeout=views.AI_API_TIMEOUT,
+                max_tokens=200
+            )
+            response = completion.choices[0].message.content
+            tracing.record_tokens('reply', completion.usage)
+
+        if response and len(response.strip()) > 0:
+            await sync_to_async(views.record_ai_success)()
+            return response
+        else:
+            raise Exception("Empty response from AI API")
+
+    except Exception as e:
+        logger.error(f"Error generating AI response for {session.sender_id}: {str(e)}")
+        await sync_to_async(views.record_ai_failure)()
+
+        return await sync_to_async(views.get_fallback_response)(session.current_state, user_message)
+
+
+async def send_message_async(reply, recipient_id):
+    """Queue message in the shared outbox, sending happens on its pooled connections"""
+    return views.send_message(reply, recipient_id)
+
+
+async def send_stream_chunk_async(chunk, recipient_id):
+    """Queue streamed chunk in the shared outbox, see views.send_stream_chunk"""
+    return views.send_stream_chunk(chunk, recipient_id)
+
+
+async def send_typing_async(recipient_id):
+    """Queue typing indicator in the shared outbox, sent ahead of the reply"""
+    return views.send_typing(recipient_id)
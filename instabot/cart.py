@@ -0,0 +1,58 @@
+from .catalog import get_catalog
+from .models import Product
+
+
+class CartLine:
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+        self.subtotal = product.price * quantity
+
+    def __str__(self):
+        return f"• {self.product.name} x{self.quantity} = {self.subtotal} сом"
+
+
+class CartPricing:
+    """Priced cart lines and total. Items whose product no longer exists are skipped"""
+
+    def __init__(self, lines, missing):
+        self.lines = lines
+        self.missing = missing  # Cart items whose product was deleted
+        self.total = sum((line.subtotal for line in lines), 0)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+
+def price_cart(items, current=False):
+    """Price cart items with at most one query, regardless of cart size.
+
+    Available products come from the catalog cache, the rest (e.g. products taken off
+    sale while sitting in a cart) are loaded with a single in_bulk query. The cache may be
+    up to CATALOG_CACHE_TTL old in other processes, so orders are priced with current=True,
+    which loads every product from the database in that one query.
+    """
+    catalog = None if current else get_catalog()
+    products = {}
+    unknown_ids = []
+
+    for item in items:
+        product = catalog.by_id.get(item['product_id']) if catalog else None
+        if product is None:
+            unknown_ids.append(item['product_id'])
+        else:
+            products[product.id] = product
+
+    if unknown_ids:
+        products.update(Product.objects.in_bulk(unknown_ids))
+
+    lines = []
+    missing = []
+    for item in items:
+        product = products.get(item['product_id'])
+        if product is None:
+            missing.append(item)
+        else:
+            lines.append(CartLine(product, item['quantity']))
+
+    return CartPricing(lines, missing)
@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+from decouple import config
+
+from .matcher import ProductMatcher
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for staleness in other processes, which don't see local invalidations
+CATALOG_CACHE_TTL = config('CATALOG_CACHE_TTL', default=60, cast=int)
+
+
+class CatalogSnapshot:
+    """Immutable view of available products built once per catalog version"""
+
+    def __init__(self, products, version):
+        self.products = products
+        self.version = version
+        self.built_at = time.time()
+        self.text = render_catalog(products)
+        self.by_id = {product.id: product for product in products}
+        self.by_name = {product.name.lower(): product for product in products}
+        self.matcher = ProductMatcher(products)
+
+
+_lock = threading.Lock()
+_snapshot = None
+_version = 0
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def render_catalog(products):
+    """Format available products for display"""
+    if not products:
+        return "К сожалению, товаров нет в наличии."
+
+    catalog_text = ["📋 Наши товары:\n"]
+
+    for product in products:
+        catalog_text.append(f"🔹 {product.name}")
+        catalog_text.append(f"   Цена: {product.price} сом")
+        catalog_text.append(f"   {product.description}\n")
+
+    catalog_text.append("Доставка по Бишкеку бесплатная! 🚚")
+    return "\n".join(catalog_text)
+
+
+def _is_fresh(snapshot):
+    return (
+        snapshot is not None
+        and snapshot.version == _version
+        and time.time() - snapshot.built_at < CATALOG_CACHE_TTL
+    )
+
+
+def get_catalog():
+    """Return current catalog snapshot, rebuilding it after invalidation or TTL expiry"""
+    global _snapshot
+
+    snapshot = _snapshot
+    if _is_fresh(snapshot):
+        _stats['hits'] += 1
+        return snapshot
+
+    with _lock:
+        # Another thread may have rebuilt it while we waited
+        if _is_fresh(_snapshot):
+            _stats['hits'] += 1
+            return _snapshot
+
+        version = _version
+        products = list(Product.objects.filter(available=True).order_by('id'))
+        _snapshot = CatalogSnapshot(products, version)
+        _stats['misses'] += 1
+        return _snapshot
+
+
+def invalidate_catalog():
+    """Drop cached catalog, the next get_catalog() reloads it from the database"""
+    global _version
+
+    with _lock:
+        _version += 1
+        _stats['invalidations'] += 1
+
+
+def warm_catalog():
+    """Build the snapshot of this process before the first message needs it.
+
+    Called at startup of the processes that handle messages; the snapshot is per process,
+    so building it anywhere else does not help them.
+    """
+    try:
+        get_catalog()
+    except Exception as e:
+        # E.g. database not reachable yet, the first message builds it instead
+        logger.error(f"Error warming catalog cache: {str(e)}")
+
+
+def catalog_stats():
+    total = _stats['hits'] + _stats['misses']
+    snapshot = _snapshot
+    return {
+        **_stats,
+        'hit_rate': _stats['hits'] / total if total else 0,
+        'version': _version,
+        'products': len(snapshot.products) if snapshot else 0,
+    }
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from decouple import config
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import CircuitBreakerState
+
+logger = logging.getLogger(__name__)
+
+AI_BREAKER_FAILURE_THRESHOLD = config('AI_BREAKER_FAILURE_THRESHOLD', default=3, cast=int)
+# Seconds the breaker stays open before a background probe is sent
+AI_BREAKER_RESET_TIMEOUT = config('AI_BREAKER_RESET_TIMEOUT', default=60, cast=int)
+# Seconds a worker trusts its local copy of the shared state
+AI_BREAKER_STATE_TTL = config('AI_BREAKER_STATE_TTL', default=2, cast=float)
+# Short-circuited requests are counted in memory and written at most this often
+SHORT_CIRCUIT_FLUSH_SECONDS = 10
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker whose state is shared by all workers through the database.
+
+    While open every request is short-circuited to the fallback. After reset_timeout one
+    worker moves it to half-open and probes the API in a background thread; the probe
+    result closes or re-opens it. User requests never wait for a probe.
+    """
+
+    def __init__(self, name, probe, failure_threshold, reset_timeout):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._cached = None
+        self._cached_at = 0
+        self._short_circuited = 0
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        state = self.get_state()
+
+        if state.state == 'closed':
+            return True
+
+        self._count_short_circuit()
+
+        if state.state == 'open' and state.opened_at and \
+                timezone.now() - max(state.opened_at, state.probe_started_at or state.opened_at) >= \
+                timedelta(seconds=self.reset_timeout):
+            # reset_timeout after opening, or after the last failed probe
+            self._start_probe()
+
+        elif state.state == 'half_open' and (
+            state.probe_started_at is None or
+            timezone.now() - state.probe_started_at >= timedelta(seconds=self.reset_timeout)
+        ):
+            # Probe owner died, let someone probe again
+            self._start_probe()
+
+        return False
+
+    def record_success(self):
+        state = self.get_state()
+        now = timezone.now()
+
+        if state.state != 'closed':
+            self._close(now)
+        elif state.failure_count or not state.last_success_at or \
+                now - state.last_success_at > timedelta(seconds=60):
+            # Avoid a write per successful call, last_success_at is informational
+            self._update(failure_count=0, last_success_at=now)
+
+    def record_failure(self):
+        now = timezone.now()
+        self._update(failure_count=F('failure_count') + 1, last_failure_at=now)
+
+        opened = CircuitBreakerState.objects.filter(
+            name=self.name,
+            state='closed',
+            failure_count__gte=self.failure_threshold
+        ).update(state='open', opened_at=now, updated_at=now)
+        if opened:
+            logger.warning(f"Circuit breaker '{self.name}' opened after {self.failure_threshold} failures")
+        self._cached = None
+
+    def get_state(self):
+        if self._cached is not None and time.time() - self._cached_at < AI_BREAKER_STATE_TTL:
+            return self._cached
+
+        state, created = CircuitBreakerState.objects.get_or_create(name=self.name)
+        self._cached = state
+        self._cached_at = time.time()
+        return state
+
+    def stats(self):
+        self.flush_short_circuited()
+        self._cached = None
+        state = self.get_state()
+        open_seconds = 0
+        if state.state != 'closed' and state.opened_at:
+            open_seconds = (timezone.now() - state.opened_at).total_seconds()
+        return {
+            'state': state.state,
+            'failure_count': state.failure_count,
+            'short_circuited': state.short_circuited,
+            'current_open_seconds': open_seconds,
+            'total_open_seconds': state.total_open_seconds + open_seconds,
+            'last_success_at': state.last_success_at,
+            'last_failure_at': state.last_failure_at,
+        }
+
+    def flush_short_circuited(self):
+        """Add the requests short-circuited by this process to the shared counter"""
+        with self._lock:
+            count = self._short_circuited
+            self._short_circuited = 0
+            self._flushed_at = time.time()
+        if count:
+            # Leaves updated_at alone, it is not a state change
+            CircuitBreakerState.objects.filter(name=self.name).update(
+                short_circuited=F('short_circuited') + count
+            )
+
+    def _count_short_circuit(self):
+        with self._lock:
+            self._short_circuited += 1
+            due = time.time() - self._flushed_at >= SHORT_CIRCUIT_FLUSH_SECONDS
+        if due:
+            self.flush_short_circuited()
+
+    def _update(self, **fields):
+        CircuitBreakerState.objects.filter(name=self.name).update(updated_at=timezone.now(), **fields)
+        self._cached = None
+
+    def _close(self, now):
+        state = CircuitBreakerState.objects.filter(name=self.name).exclude(state='closed').first()
+        if state is not None:
+            open_seconds = (now - state.opened_at).total_seconds() if state.opened_at else 0
+            closed = CircuitBreakerState.objects.filter(pk=state.pk, state=state.state).update(
+                state='closed',
+                failure_count=0,
+                last_success_at=now,
+                total_open_seconds=F('total_open_seconds') + open_seconds,
+                opened_at=None,
+                updated_at=now
+            )
+            if closed:
+                logger.info(f"Circuit breaker '{self.name}' closed after {open_seconds:.0f}s")
+        self._cached = None
+
+    def _start_probe(self):
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.reset_timeout)
+        # probe_started_at is only written here, other updates of the row do not hide a dead probe
+        claimed = CircuitBreakerState.objects.filter(
+            Q(state='open') |
+            Q(state='half_open', probe_started_at__lt=stale) |
+            Q(state='half_open', probe_started_at__isnull=True),
+            name=self.name
+        ).update(state='half_open', probe_started_at=now, updated_at=now)
+        self._cached = None
+
+        # Only the worker that won the transition probes
+        if claimed:
+            threading.Thread(target=self._run_probe, name=f'{self.name}-probe', daemon=True).start()
+
+    def _run_probe(self):
+        try:
+            healthy = self.probe()
+        except Exception as e:
+            logger.error(f"Circuit breaker '{self.name}' probe failed: {str(e)}")
+            healthy = False
+
+        try:
+            now = timezone.now()
+            if healthy:
+                self._close(now)
+            else:
+                # opened_at stays at the start of the outage, probe_started_at times the next probe
+                CircuitBreakerState.objects.filter(name=self.name, state='half_open').update(
+                    state='open',
+                    updated_at=now
+                )
+                self._cached = None
+        finally:
+            connection.close()
@@ -0,0 +1,115 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from decouple import config
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import ProcessedEvent
+from .retention import delete_in_batches
+
+logger = logging.getLogger(__name__)
+
+# Meta redelivers unacknowledged events for up to a day and a half
+DEDUPE_TTL_HOURS = config('DEDUPE_TTL_HOURS', default=48, cast=int)
+DEDUPE_CACHE_SIZE = config('DEDUPE_CACHE_SIZE', default=50000, cast=int)
+
+
+def event_key(event):
+    """Message mid, or sender and timestamp for events without one. None if neither is present"""
+    mid = event.get("message", {}).get("mid")
+    if mid:
+        return mid
+
+    sender_id = event.get("sender", {}).get("id")
+    timestamp = event.get("timestamp")
+    if sender_id and timestamp:
+        return f"{sender_id}:{timestamp}"
+    return None
+
+
+class EventDeduplicator:
+    """Seen webhook events: bounded in-memory LRU in front of the unique ProcessedEvent table.
+
+    Replays handled by the same worker are dropped by the LRU without touching the database,
+    the unique constraint catches replays that land on another worker. Events whose processing
+    failed are released, so a redelivery is processed again.
+    """
+
+    def __init__(self, max_size=DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, key):
+        with self._lock:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                self.duplicates += 1
+                return True
+            return False
+
+    def claim(self, key):
+        """Return True if the event is new and should be processed, False for a replay"""
+        if key is None:
+            return True
+
+        with self._lock:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                self.duplicates += 1
+                return False
+            # Mark before the insert so concurrent deliveries in this process can't both pass
+            self._remember(key)
+
+        try:
+            with transaction.atomic():
+                ProcessedEvent.objects.create(key=key)
+        except IntegrityError:
+            with self._lock:
+                self.duplicates += 1
+            return False
+        except Exception as e:
+            # Processing twice is better than dropping a message
+            logger.error(f"Error recording processed event {key}: {str(e)}")
+        return True
+
+    def release(self, key):
+        """Forget a claimed event, a redelivery of it is then processed again"""
+        if key is None:
+            return
+
+        with self._lock:
+            self._seen.pop(key, None)
+        try:
+            ProcessedEvent.objects.filter(key=key).delete()
+        except Exception as e:
+            logger.error(f"Error releasing processed event {key}: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def _remember(self, key):
+        self._seen[key] = True
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+
+event_deduplicator = EventDeduplicator()
+
+
+def purge_processed_events(ttl_hours=None, **options):
+    """Delete dedupe records older than the redelivery window, returns number deleted.
+
+    options are passed on to retention.delete_in_batches
+    """
+    hours = DEDUPE_TTL_HOURS if ttl_hours is None else ttl_hours
+    return delete_in_batches(
+        ProcessedEvent.objects.filter(created_at__lt=timezone.now() - timedelta(hours=hours)),
+        'purge_processed_events',
+        **options
+    )
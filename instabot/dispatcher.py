@@ -0,0 +1,103 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from decouple import config
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+BOT_DISPATCH_CONCURRENCY = config('BOT_DISPATCH_CONCURRENCY', default=4, cast=int)
+
+
+class SenderDispatcher:
+    """Run events of different senders concurrently, keeping each sender's events in order.
+
+    Every sender gets its own FIFO. A sender is drained by at most one pool thread at a
+    time, so ConversationSession transitions for that sender never interleave.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or BOT_DISPATCH_CONCURRENCY
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency,
+            thread_name_prefix='bot-dispatch'
+        )
+        self._lock = threading.Lock()
+        self._queues = {}  # sender_id -> deque of (future, func, args)
+
+    def submit(self, sender_id, func, *args):
+        """Schedule func(*args) after all earlier events of the same sender"""
+        future = Future()
+        if self.concurrency <= 1:
+            # Sequential mode: run inline in the caller's thread
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self._lock:
+            pending = self._queues.get(sender_id)
+            if pending is None:
+                self._queues[sender_id] = deque([(future, func, args)])
+                self._executor.submit(self._drain, sender_id)
+            else:
+                pending.append((future, func, args))
+        return future
+
+    def _drain(self, sender_id):
+        while True:
+            with self._lock:
+                pending = self._queues[sender_id]
+                if not pending:
+                    del self._queues[sender_id]
+                    return
+                future, func, args = pending[0]
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except Exception as e:
+                    logger.error(f"Error dispatching event for {sender_id}: {str(e)}")
+                    future.set_exception(e)
+                finally:
+                    close_old_connections()
+
+            with self._lock:
+                pending.popleft()
+
+    def pending_count(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._queues.values())
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Return the process-wide dispatcher"""
+    global _dispatcher
+
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = SenderDispatcher()
+    return _dispatcher
+
+
+def configure_dispatcher(concurrency):
+    """Replace the process-wide dispatcher with one of the given concurrency"""
+    global _dispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            _dispatcher.shutdown()
+        _dispatcher = SenderDispatcher(concurrency)
+    return _dispatcher
@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from decouple import config
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Avg, Count, F, Max, Min
+from django.utils import timezone
+
+from .dedupe import event_deduplicator, event_key
+from .models import WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+# Claims of one event; an event that keeps failing or killing its worker is failed after this many
+WEBHOOK_EVENT_MAX_ATTEMPTS = config('WEBHOOK_EVENT_MAX_ATTEMPTS', default=3, cast=int)
+# Events stuck in 'processing' longer than this are considered abandoned by a dead worker
+WEBHOOK_EVENT_VISIBILITY_TIMEOUT = config('WEBHOOK_EVENT_VISIBILITY_TIMEOUT', default=300, cast=int)
+
+
+def enqueue_event(body):
+    """Store raw webhook body in the queue table"""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return WebhookEvent.objects.create(payload=body)
+
+
+def claim_events(limit=10):
+    """Lock and mark a batch of pending events as processing, counting the attempt"""
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=WEBHOOK_EVENT_VISIBILITY_TIMEOUT)
+
+    with transaction.atomic():
+        pending = WebhookEvent.objects.filter(status='pending')
+        stale = WebhookEvent.objects.filter(status='processing', started_at__lt=stale_before)
+        events = list(
+            (pending | stale).select_for_update(skip_locked=True).order_by('id')[:limit]
+        )
+        if not events:
+            return []
+
+        # Abandoned by a dead worker on every attempt, most likely the event kills it
+        exhausted = [event for event in events if event.attempts >= WEBHOOK_EVENT_MAX_ATTEMPTS]
+        if exhausted:
+            WebhookEvent.objects.filter(id__in=[event.id for event in exhausted]).update(
+                status='failed',
+                finished_at=now,
+                last_error=f'Abandoned by the worker {WEBHOOK_EVENT_MAX_ATTEMPTS} times'
+            )
+            for event in exhausted:
+                logger.error(f"Queued event {event.id} abandoned {event.attempts} times, marking failed")
+            events = [event for event in events if event.attempts < WEBHOOK_EVENT_MAX_ATTEMPTS]
+
+        WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(
+            status='processing',
+            started_at=now,
+            attempts=F('attempts') + 1
+        )
+
+    # The dead worker claimed the messages of reclaimed events, they must not be dropped as replays.
+    # Messages it had already answered are answered again: delivery is at least once
+    for event in events:
+        if event.status == 'processing':
+            release_messages(event)
+
+    for event in events:
+        event.status = 'processing'
+        event.started_at = now
+        event.attempts += 1
+    return events
+
+
+def release_messages(event):
+    """Release the dedupe claims of the messages in a queued event"""
+    try:
+        entries = event.get_payload().get('entry', [])
+    except (ValueError, AttributeError):
+        return
+    for entry in entries:
+        for messaging_event in entry.get('messaging', []):
+            event_deduplicator.release(event_key(messaging_event))
+
+
+def complete_event(event, error=None):
+    """Record processing result and per-stage latency for an event.
+
+    A failed event is queued again until it has been claimed WEBHOOK_EVENT_MAX_ATTEMPTS times,
+    its messages that failed released their dedupe claims and are processed again.
+    """
+    finished_at = timezone.now()
+    event.finished_at = finished_at
+    event.wait_ms = int((event.started_at - event.created_at).total_seconds() * 1000)
+    event.processing_ms = int((finished_at - event.started_at).total_seconds() * 1000)
+
+    if error is None:
+        event.status = 'done'
+        event.last_error = None
+    elif event.attempts < WEBHOOK_EVENT_MAX_ATTEMPTS:
+        event.status = 'pending'
+        event.last_error = str(error)
+    else:
+        event.status = 'failed'
+        event.last_error = str(error)
+
+    event.save(update_fields=[
+        'status', 'last_error', 'finished_at', 'wait_ms', 'processing_ms'
+    ])
+
+
+def process_events(events, on_complete=None):
+    """Hand queued webhook events to the sender dispatcher without waiting for them.
+
+    Different senders are processed concurrently while each sender keeps queue order. An event
+    is completed from the callback of its last finished message, so a slow conversation holds
+    up only its own sender. on_complete(event) is called once the event is completed.
+    """
+    from .views import submit_webhook_payload
+
+    for event in events:
+        try:
+            futures = submit_webhook_payload(event.get_payload())
+        except Exception as e:
+            logger.error(f"Error processing queued event {event.id}: {str(e)}")
+            finish_event(event, e, on_complete)
+            continue
+        complete_when_done(event, futures, on_complete)
+
+
+def complete_when_done(event, futures, on_complete):
+    if not futures:
+        finish_event(event, None, on_complete)
+        return
+
+    lock = threading.Lock()
+    remaining = set(futures)
+
+    def done(future):
+        with lock:
+            remaining.discard(future)
+            if remaining:
+                return
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            logger.error(f"Error processing queued event {event.id}: {str(errors[0])}")
+        finish_event(event, errors[0] if errors else None, on_complete)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def finish_event(event, error, on_complete):
+    try:
+        complete_event(event, error=error)
+    except Exception as e:
+        logger.error(f"Error completing queued event {event.id}: {str(e)}")
+    finally:
+        if on_complete:
+            on_complete(event)
+
+
+class InFlight:
+    """Number of claimed events that are not completed yet"""
+
+    def __init__(self):
+        self.count = 0
+        self._changed = threading.Condition()
+
+    def add(self, count):
+        with self._changed:
+            self.count += count
+
+    def done(self, event=None):
+        with self._changed:
+            self.count -= 1
+            self._changed.notify_all()
+
+    def wait_below(self, limit, timeout):
+        """Wait until fewer than limit events are in flight, False on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.count < limit, timeout)
+
+
+def queue_stats(window_minutes=60):
+    """Return queue depth and latency figures for recently finished events"""
+    now = timezone.now()
+    pending = WebhookEvent.objects.filter(status='pending')
+    oldest = pending.aggregate(oldest=Min('created_at'))['oldest']
+
+    recent = WebhookEvent.objects.filter(
+        status='done',
+        finished_at__gte=now - timedelta(minutes=window_minutes)
+    ).aggregate(
+        processed=Count('id'),
+        avg_wait_ms=Avg('wait_ms'),
+        max_wait_ms=Max('wait_ms'),
+        avg_processing_ms=Avg('processing_ms'),
+        max_processing_ms=Max('processing_ms'),
+    )
+
+    return {
+        'pending': pending.count(),
+        'processing': WebhookEvent.objects.filter(status='processing').count(),
+        'failed': WebhookEvent.objects.filter(status='failed').count(),
+        'oldest_pending_seconds': (now - oldest).total_seconds() if oldest else 0,
+        **recent,
+    }
+
+
+def run_worker(stop_event, batch_size=10, poll_interval=1.0, drain_only=False):
+    """Worker loop: keep up to batch_size events in flight, claiming more as soon as any completes"""
+    in_flight = InFlight()
+    try:
+        while not stop_event.is_set():
+            close_old_connections()
+            if not in_flight.wait_below(batch_size, poll_interval):
+                continue
+
+            events = claim_events(batch_size - in_flight.count)
+            if not events:
+                if drain_only:
+                    if not in_flight.count:
+                        break
+                    # --once returns after the claimed events are done, failed ones may be queued again
+                    in_flight.wait_below(1, None)
+                    continue
+                time.sleep(poll_interval)
+                continue
+
+            in_flight.add(len(events))
+            process_events(events, on_complete=in_flight.done)
+    finally:
+        connection.close()
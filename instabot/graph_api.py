@@ -0,0 +1,320 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .rate_limit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_URL = config('GRAPH_API_URL', default='https://graph.instagram.com/v21.0')
+LONG_USER_ACCESS_TOKEN = config('LONG_USER_ACCESS_TOKEN')
+GRAPH_API_TIMEOUT = config('GRAPH_API_TIMEOUT', default=10, cast=float)
+# Keep-alive connections kept open to the Graph API
+GRAPH_POOL_SIZE = config('GRAPH_POOL_SIZE', default=10, cast=int)
+# Retries on 5xx with exponential backoff. Rate limits are not retried here, they raise
+# RateLimited and the reply goes to the delay queue instead of holding a send thread
+GRAPH_MAX_RETRIES = config('GRAPH_MAX_RETRIES', default=3, cast=int)
+GRAPH_BACKOFF_FACTOR = 0.5
+GRAPH_BACKOFF_MAX = 30
+GRAPH_SEND_WORKERS = config('GRAPH_SEND_WORKERS', default=4, cast=int)
+# Instagram rejects longer texts, coalesced replies are split at this size
+GRAPH_MAX_MESSAGE_CHARS = 1000
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# Graph API error codes meaning the app or account is throttled
+RATE_LIMIT_ERROR_CODES = (4, 17, 32, 613)
+# Used when a rate limit response has no Retry-After
+RATE_LIMIT_DEFAULT_DELAY = 60
+
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after=RATE_LIMIT_DEFAULT_DELAY):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GraphAPIError(Exception):
+    """Error response other than a rate limit, left after the retries"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def build_send_request(reply, recipient_id):
+    return build_graph_request(recipient_id, {
+        'message': {
+            'text': str(reply)
+        }
+    })
+
+
+def build_typing_request(recipient_id):
+    return build_graph_request(recipient_id, {'sender_action': 'typing_on'})
+
+
+def build_graph_request(recipient_id, payload):
+    url = f'{GRAPH_API_URL}/me/messages'
+    headers = {
+        'Authorization': f'Bearer {LONG_USER_ACCESS_TOKEN}',
+        'Content-Type': "application/json"
+    }
+    json_body = {
+        'recipient': {
+            'id': int(recipient_id)
+        },
+        **payload
+    }
+    return url, headers, json_body
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return process-wide pooled session, connections are reused between sends"""
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=GRAPH_MAX_RETRIES,
+                    backoff_factor=GRAPH_BACKOFF_FACTOR,
+                    backoff_max=GRAPH_BACKOFF_MAX,
+                    status_forcelist=RETRY_STATUSES,
+                    # Send API calls are POSTs, retried statuses mean the message was not accepted
+                    allowed_methods=['POST'],
+                    # urllib3 sleeps a Retry-After in full, backoff_max bounds the wait instead
+                    respect_retry_after_header=False,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GRAPH_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+class SendMetrics:
+    """Send API call latency and error counters of this process"""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.coalesced = 0
+
+    def record(self, latency_ms, ok, retries=0):
+        with self._lock:
+            self.calls += 1
+            self._latencies.append(latency_ms)
+            self.retries += retries
+            if not ok:
+                self.errors += 1
+
+    def record_coalesced(self, count):
+        with self._lock:
+            self.coalesced += count
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+        def percentile(percent):
+            if not latencies:
+                return 0
+            return latencies[min(len(latencies) - 1, int(round(percent / 100 * (len(latencies) - 1))))]
+
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'coalesced': self.coalesced,
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'max_ms': latencies[-1] if latencies else 0,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+            self.calls = self.errors = self.retries = self.coalesced = 0
+
+
+send_metrics = SendMetrics()
+
+
+def post(url, headers, json_body):
+    """POST through the pooled session and record latency, returns response JSON.
+
+    Raises RateLimited as soon as the API is throttling, GraphAPIError for any other error
+    response left after the retries.
+    """
+    start_time = time.perf_counter()
+    try:
+        response = get_session().post(url, headers=headers, json=json_body, timeout=GRAPH_API_TIMEOUT)
+    except Exception:
+        send_metrics.record((time.perf_counter() - start_time) * 1000, ok=False)
+        raise
+
+    retries = response.raw.retries.history if getattr(response.raw, 'retries', None) else ()
+    send_metrics.record((time.perf_counter() - start_time) * 1000, ok=response.ok, retries=len(retries))
+    rate_limiter.adapt(response.headers)
+
+    if not response.ok:
+        try:
+            error_code = response.json().get('error', {}).get('code')
+        except ValueError:
+            error_code = None
+
+        if response.status_code == 429 or error_code in RATE_LIMIT_ERROR_CODES:
+            retry_after = response.headers.get('Retry-After')
+            raise RateLimited(
+                f"Graph API rate limit ({response.status_code}, code {error_code})",
+                retry_after=max(1, int(retry_after)) if retry_after and retry_after.isdigit() else RATE_LIMIT_DEFAULT_DELAY
+            )
+
+        raise GraphAPIError(
+            f"Graph API error {response.status_code} for {json_body.get('recipient')}: {response.text[:200]}",
+            status_code=response.status_code
+        )
+    return response.json()
+
+
+def send_text(text, recipient_id):
+    url, headers, json_body = build_send_request(text, recipient_id)
+    return post(url, headers, json_body)
+
+
+def send_typing(recipient_id):
+    url, headers, json_body = build_typing_request(recipient_id)
+    return post(url, headers, json_body)
+
+
+class Outbox:
+    """Per-recipient send queue.
+
+    One send per recipient is in flight at a time, so messages keep their order. Texts queued
+    meanwhile are joined into one message, which saves calls when the Graph API is slower than
+    reply generation (e.g. streamed chunks). Typing indicators are queued like texts, so they
+    never hold up the caller and never overtake a reply.
+    """
+
+    def __init__(self, send=send_text, workers=GRAPH_SEND_WORKERS, max_chars=GRAPH_MAX_MESSAGE_CHARS,
+                 typing=send_typing):
+        self._send = send
+        self._typing = typing
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}  # recipient_id -> [(text, future, separator)], text None for a typing indicator
+        self._active = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='graph-send')
+
+    def submit(self, recipient_id, text, separator='\n\n'):
+        """Queue text for recipient_id, the returned Future resolves to the API response.
+
+        separator joins text to the texts queued before it, streamed chunks of one reply use ' '
+        """
+        return self._queue(recipient_id, (text, Future(), separator))
+
+    def submit_typing(self, recipient_id):
+        """Queue a typing indicator for recipient_id"""
+        return self._queue(recipient_id, (None, Future(), None))
+
+    def _queue(self, recipient_id, item):
+        future = item[1]
+        with self._lock:
+            self._pending.setdefault(recipient_id, []).append(item)
+            if recipient_id in self._active:
+                return future
+            self._active.add(recipient_id)
+
+        self._executor.submit(self._drain, recipient_id)
+        return future
+
+    def flush(self, recipient_id=None, timeout=None):
+        """Wait until everything queued for recipient_id (or everyone) is sent"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while (recipient_id in self._active) if recipient_id is not None else self._active:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _drain(self, recipient_id):
+        while True:
+            with self._lock:
+                batch = self._take_batch(recipient_id)
+                if not batch:
+                    self._active.discard(recipient_id)
+                    self._idle.notify_all()
+                    return
+
+            if len(batch) > 1:
+                send_metrics.record_coalesced(len(batch) - 1)
+
+            first = batch[0][0]
+            try:
+                if first is None:
+                    result = self._typing(recipient_id)
+                else:
+                    text = first + ''.join(separator + text for text, future, separator in batch[1:])
+                    result = self._send(text, recipient_id)
+            except Exception as e:
+                kind = 'typing indicator' if first is None else 'message'
+                logger.error(f"Error sending {kind} to {recipient_id}: {str(e)}")
+                result = {"error": str(e)}
+
+            for text, future, separator in batch:
+                future.set_result(result)
+
+    def _take_batch(self, recipient_id):
+        """Pop a typing indicator, or the longest prefix of queued texts that fits in one message"""
+        pending = self._pending.get(recipient_id)
+        if not pending:
+            self._pending.pop(recipient_id, None)
+            return []
+
+        batch = [pending.pop(0)]
+        if batch[0][0] is None:
+            return batch
+        size = len(batch[0][0])
+        while pending and pending[0][0] is not None and size + len(pending[0][2]) + len(pending[0][0]) <= self.max_chars:
+            batch.append(pending.pop(0))
+            size += len(batch[-1][2]) + len(batch[-1][0])
+        return batch
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+
+_outbox = None
+
+
+def get_outbox():
+    """Process-wide outbox, sends are rate limited and deferred to the delay queue when throttled"""
+    global _outbox
+
+    if _outbox is None:
+        from .outbound_queue import deliver, deliver_typing
+
+        with _session_lock:
+            if _outbox is None:
+                _outbox = Outbox(send=deliver, typing=deliver_typing)
+    return _outbox
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from decouple import config
+from django.db.models import F
+from django.utils import timezone
+
+from .models import IntentCacheEntry
+
+logger = logging.getLogger(__name__)
+
+INTENT_CACHE_TTL = config('INTENT_CACHE_TTL', default=7 * 24 * 3600, cast=int)
+INTENT_CACHE_SIZE = config('INTENT_CACHE_SIZE', default=5000, cast=int)
+# Share classifications between workers through the IntentCacheEntry table
+INTENT_CACHE_DB = config('INTENT_CACHE_DB', default=True, cast=bool)
+# Hit counters are written to the database in batches
+INTENT_CACHE_FLUSH_INTERVAL = 60
+
+
+def normalize_message(text):
+    """Lowercase, drop punctuation and extra whitespace so trivial variations share an entry"""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def cache_key(normalized):
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class IntentCache:
+    """LRU + TTL cache of normalised message -> AI-classified intent"""
+
+    def __init__(self, max_size=INTENT_CACHE_SIZE, ttl=INTENT_CACHE_TTL, use_db=INTENT_CACHE_DB):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_db = use_db
+        self._entries = OrderedDict()  # key -> (intent, expires_at)
+        self._lock = threading.Lock()
+        self._pending_hits = {}
+        self._last_flush = time.time()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        """Return cached intent or None"""
+        self._flush_hits()
+        key = cache_key(normalize_message(text))
+        now = time.time()
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached and cached[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._record_hit(key)
+                return cached[0]
+
+        intent = self._get_from_db(key) if self.use_db else None
+
+        with self._lock:
+            if intent:
+                self.db_hits += 1
+                self._record_hit(key)
+                self._store(key, intent, now)
+            else:
+                self.misses += 1
+
+        return intent
+
+    def set(self, text, intent):
+        normalized = normalize_message(text)
+        key = cache_key(normalized)
+
+        with self._lock:
+            self._store(key, intent, time.time())
+
+        if self.use_db:
+            try:
+                entry, created = IntentCacheEntry.objects.update_or_create(
+                    key=key,
+                    defaults={'text': normalized, 'intent': intent, 'updated_at': timezone.now()}
+                )
+                IntentCacheEntry.objects.filter(pk=entry.pk).update(misses=F('misses') + 1)
+            except Exception as e:
+                logger.error(f"Error saving intent cache entry: {str(e)}")
+
+    def stats(self):
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.db_hits) / lookups if lookups else 0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key, intent, now):
+        self._entries[key] = (intent, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get_from_db(self, key):
+        try:
+            entry = IntentCacheEntry.objects.filter(
+                key=key,
+                updated_at__gte=timezone.now() - timedelta(seconds=self.ttl)
+            ).only('intent').first()
+            return entry.intent if entry else None
+        except Exception as e:
+            logger.error(f"Error reading intent cache: {str(e)}")
+            return None
+
+    def _record_hit(self, key):
+        if self.use_db:
+            self._pending_hits[key] = self._pending_hits.get(key, 0) + 1
+
+    def _flush_hits(self):
+        if not self.use_db or time.time() - self._last_flush < INTENT_CACHE_FLUSH_INTERVAL:
+            return
+
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+            self._last_flush = time.time()
+
+        try:
+            for key, count in pending.items():
+                IntentCacheEntry.objects.filter(key=key).update(hits=F('hits') + count)
+        except Exception as e:
+            logger.error(f"Error flushing intent cache hits: {str(e)}")
+
+        stats = self.stats()
+        logger.info(
+            f"Intent cache: hit rate {stats['hit_rate']:.1%}, "
+            f"{stats['hits']} memory hits, {stats['db_hits']} db hits, {stats['misses']} misses"
+        )
+
+
+intent_cache = IntentCache()
@@ -0,0 +1,225 @@
+import gzip
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+from decouple import config
+
+from .intent_cache import normalize_message
+
+logger = logging.getLogger(__name__)
+
+MODEL_FORMAT = 1
+INTENT_MODEL_PATH = config(
+    'INTENT_MODEL_PATH',
+    default=str(Path(__file__).resolve().parent / 'intent_model' / 'intent_model.json.gz')
+)
+# Below this probability classify_intent escalates to the LLM
+INTENT_MODEL_THRESHOLD = config('INTENT_MODEL_THRESHOLD', default=0.75, cast=float)
+# How often the artifact's mtime is checked for a newly trained model
+INTENT_MODEL_RELOAD_INTERVAL = 60
+
+NGRAM_SIZES = (2, 3, 4)
+
+
+def extract_ngrams(text):
+    """Character n-gram counts of the normalised text, padded at word boundaries"""
+    padded = f' {normalize_message(text)} '
+    counts = {}
+    for size in NGRAM_SIZES:
+        for index in range(len(padded) - size + 1):
+            gram = padded[index:index + size]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+def tfidf_vector(counts, idf):
+    """Sublinear TF-IDF, L2-normalised, unknown n-grams dropped"""
+    vector = {}
+    for gram, count in counts.items():
+        weight = idf.get(gram)
+        if weight is not None:
+            vector[gram] = (1 + math.log(count)) * weight
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    if norm:
+        for gram in vector:
+            vector[gram] /= norm
+    return vector
+
+
+def softmax(scores):
+    top = max(scores)
+    exps = [math.exp(score - top) for score in scores]
+    total = sum(exps)
+    return [value / total for value in exps]
+
+
+class IntentModel:
+    """Character n-gram TF-IDF + multinomial logistic regression"""
+
+    def __init__(self, labels, idf, weights, bias, version=None, metrics=None):
+        self.labels = labels
+        self.idf = idf
+        self.weights = weights  # n-gram -> list of per-label weights
+        self.bias = bias
+        self.version = version
+        self.metrics = metrics or {}
+
+    def predict_proba(self, text):
+        vector = tfidf_vector(extract_ngrams(text), self.idf)
+        scores = list(self.bias)
+        weights = self.weights
+        for gram, value in vector.items():
+            row = weights.get(gram)
+            if row:
+                for index, weight in enumerate(row):
+                    scores[index] += weight * value
+        return softmax(scores)
+
+    def predict(self, text):
+        """Return (intent, probability)"""
+        probs = self.predict_proba(text)
+        best = max(range(len(probs)), key=probs.__getitem__)
+        return self.labels[best], probs[best]
+
+    @classmethod
+    def train(cls, texts, labels, epochs=15, learning_rate=0.5, l2=1e-5, min_df=1, seed=42):
+        classes = sorted(set(labels))
+        class_index = {label: index for index, label in enumerate(classes)}
+
+        counts = [extract_ngrams(text) for text in texts]
+        document_frequency = {}
+        for sample in counts:
+            for gram in sample:
+                document_frequency[gram] = document_frequency.get(gram, 0) + 1
+        total = len(counts)
+        idf = {
+            gram: math.log((1 + total) / (1 + frequency)) + 1
+            for gram, frequency in document_frequency.items()
+            if frequency >= min_df
+        }
+
+        vectors = [tfidf_vector(sample, idf) for sample in counts]
+        targets = [class_index[label] for label in labels]
+        weights = {}
+        bias = [0.0] * len(classes)
+        order = list(range(total))
+        rng = random.Random(seed)
+
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            rate = learning_rate / (1 + epoch * 0.5)
+            for sample_index in order:
+                vector = vectors[sample_index]
+                scores = list(bias)
+                for gram, value in vector.items():
+                    row = weights.get(gram)
+                    if row:
+                        for index, weight in enumerate(row):
+                            scores[index] += weight * value
+                probs = softmax(scores)
+
+                for index, prob in enumerate(probs):
+                    gradient = prob - (1.0 if index == targets[sample_index] else 0.0)
+                    if abs(gradient) < 1e-4:
+                        continue
+                    bias[index] -= rate * gradient
+                    for gram, value in vector.items():
+                        row = weights.setdefault(gram, [0.0] * len(classes))
+                        row[index] -= rate * (gradient * value + l2 * row[index])
+
+        return cls(classes, idf, weights, bias)
+
+    def to_dict(self):
+        # Drop n-grams without meaningful weight to keep the artifact small
+        weights = {
+            gram: [round(weight, 5) for weight in row]
+            for gram, row in self.weights.items()
+            if max(abs(weight) for weight in row) >= 1e-4
+        }
+        return {
+            'format': MODEL_FORMAT,
+            'version': self.version,
+            'labels': self.labels,
+            'idf': {gram: round(value, 5) for gram, value in self.idf.items() if gram in weights},
+            'weights': weights,
+            'bias': self.bias,
+            'metrics': self.metrics,
+        }
+
+    def save(self, directory):
+        """Write versioned artifact and make it the current model. Returns its path"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.version = self.version or time.strftime('%Y%m%d%H%M%S')
+
+        versioned_path = directory / f'intent_model-{self.version}.json.gz'
+        with gzip.open(versioned_path, 'wt', encoding='utf-8') as artifact:
+            json.dump(self.to_dict(), artifact, ensure_ascii=False)
+
+        current_path = directory / 'intent_model.json.gz'
+        temporary_path = directory / f'.intent_model-{self.version}.tmp'
+        with open(versioned_path, 'rb') as source, open(temporary_path, 'wb') as target:
+            target.write(source.read())
+        os.replace(temporary_path, current_path)
+        return versioned_path
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as artifact:
+            data = json.load(artifact)
+        if data.get('format') != MODEL_FORMAT:
+            raise ValueError(f"Unsupported intent model format: {data.get('format')}")
+        return cls(
+            data['labels'], data['idf'], data['weights'], data['bias'],
+            version=data.get('version'), metrics=data.get('metrics')
+        )
+
+
+_lock = threading.Lock()
+_model = None
+_model_mtime = None
+_last_check = 0
+
+
+def get_intent_model():
+    """Return current model, reloading it when a new artifact is written. None if absent"""
+    global _model, _model_mtime, _last_check
+
+    if time.time() - _last_check < INTENT_MODEL_RELOAD_INTERVAL:
+        return _model
+
+    with _lock:
+        _last_check = time.time()
+        try:
+            mtime = os.path.getmtime(INTENT_MODEL_PATH)
+        except OSError:
+            _model = None
+            return None
+
+        if mtime != _model_mtime:
+            try:
+                _model = IntentModel.load(INTENT_MODEL_PATH)
+                _model_mtime = mtime
+                logger.info(f"Loaded intent model {_model.version}")
+            except Exception as e:
+                logger.error(f"Error loading intent model: {str(e)}")
+                _model = None
+        return _model
+
+
+def predict_intent(text):
+    """Return intent when the local model is confident enough, otherwise None"""
+    model = get_intent_model()
+    if model is None:
+        return None
+
+    intent, probability = model.predict(text)
+    if probability >= INTENT_MODEL_THRESHOLD:
+        return intent
+    return None
@@ -0,0 +1,128 @@
+import re
+import threading
+import time
+
+from decouple import config
+
+from .models import KeywordRule
+
+KEYWORD_RULES_TTL = config('KEYWORD_RULES_TTL', default=60, cast=int)
+# 'priority': first intent of INTENT_PRIORITY with a matching keyword, like the inline keyword lists.
+# 'score': highest weighted score wins, INTENT_PRIORITY only breaks ties
+KEYWORD_RANKING = config('KEYWORD_RANKING', default='priority')
+
+# Used while the KeywordRule table is empty; `manage.py load_keyword_rules` copies them there.
+# Every state handler has its own vocabulary, the idle state uses the first four
+DEFAULT_RULES = {
+    'ПОКУПКА': ['купить', 'заказать', 'хочу', 'возьму', 'оформить'],
+    'КАТАЛОГ': ['каталог', 'товары', 'что есть', 'показать', 'посмотреть'],
+    'ЖАЛОБА': ['жалоба', 'плохо', 'не работает', 'недоволен', 'проблема'],
+    'БЛАГОДАРНОСТЬ': ['спасибо', 'благодарю', 'отлично', 'хорошо'],
+    # After a purchase: wants more products
+    'ДОПОЛНИТЬ': ['купить', 'заказать', 'еще', 'также', 'тоже'],
+    # After a purchase: wants to see the catalog
+    'ПОКАЗАТЬ_КАТАЛОГ': ['каталог', 'товары', 'что есть'],
+    # While browsing: wants to buy
+    'ВЫБРАТЬ': ['купить', 'заказать', 'хочу', 'возьму'],
+    # Choosing products: done, ready to place the order
+    'ОФОРМЛЕНИЕ': ['заказ', 'оформить', 'купить', 'хватит', 'достаточно'],
+}
+
+# Routing order, with 'score' ranking the tie-break order between equally scored intents
+INTENT_PRIORITY = ['ПОКУПКА', 'КАТАЛОГ', 'ЖАЛОБА', 'БЛАГОДАРНОСТЬ']
+
+
+class KeywordClassifier:
+    """All intent vocabularies compiled into one regex, scored in a single pass.
+
+    The lookahead lets the scan report a keyword at every position, so overlapping keywords
+    ("заказ" inside "заказать", "хорошо" inside "нехорошо") are all counted like the old
+    `word in message` checks did.
+    """
+
+    def __init__(self, rules):
+        """rules: iterable of (intent, keyword, weight)"""
+        weights = {}
+        for intent, keyword, weight in rules:
+            keyword = keyword.lower()
+            if keyword:
+                weights.setdefault(keyword, []).append((intent, weight))
+
+        # Longest alternative wins at a position; shorter keywords it starts with are credited too
+        keywords = sorted(weights, key=len, reverse=True)
+        self._credits = {
+            keyword: [
+                credit
+                for other in keywords if keyword.startswith(other)
+                for credit in weights[other]
+            ]
+            for keyword in keywords
+        }
+        pattern = '|'.join(re.escape(keyword) for keyword in keywords) or r'(?!)'
+        self._pattern = re.compile(f'(?=({pattern}))')
+
+    def score(self, text):
+        """Return {intent: score} for every intent whose keywords occur in text"""
+        scores = {}
+        credits = self._credits
+        for keyword in self._pattern.findall(text.lower()):
+            for intent, weight in credits[keyword]:
+                scores[intent] = scores.get(intent, 0) + weight
+        return scores
+
+
+def best_intent(scores, candidates=INTENT_PRIORITY, ranking=None):
+    """Intent among candidates picked by ranking (KEYWORD_RANKING by default), None if none matched"""
+    if (ranking or KEYWORD_RANKING) == 'score':
+        best = None
+        for intent in candidates:
+            if scores.get(intent, 0) > scores.get(best, 0):
+                best = intent
+        return best
+
+    for intent in candidates:
+        if scores.get(intent, 0) > 0:
+            return intent
+    return None
+
+
+def default_rules():
+    return [
+        (intent, keyword, 1.0)
+        for intent, keywords in DEFAULT_RULES.items()
+        for keyword in keywords
+    ]
+
+
+_lock = threading.Lock()
+_classifier = None
+_built_at = 0
+_version = 0
+_built_version = -1
+
+
+def get_classifier():
+    """Return compiled classifier, rebuilt after rule changes or TTL expiry"""
+    global _classifier, _built_at, _built_version
+
+    if _classifier is not None and _built_version == _version and time.time() - _built_at < KEYWORD_RULES_TTL:
+        return _classifier
+
+    with _lock:
+        version = _version
+        rules = list(
+            KeywordRule.objects.filter(active=True).values_list('intent', 'keyword', 'weight')
+        )
+        _classifier = KeywordClassifier(rules or default_rules())
+        _built_at = time.time()
+        _built_version = version
+        return _classifier
+
+
+def invalidate_classifier():
+    global _version
+    _version += 1
+
+
+def score_intents(text):
+    return get_classifier().score(text)
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+import time
+from instabot.archive import ARCHIVE_EXPORT_DIR, MessageArchive
+from instabot.retention import MESSAGE_RETENTION_HOURS, PURGE_BATCH_SIZE, purge_expired_messages
+
+
+class Command(BaseCommand):
+    help = (
+        'Move chat history older than the retention window from InstaBotMessage to ArchivedMessage '
+        'and a gzipped JSON lines export, keeping the live table and its indexes small'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=MESSAGE_RETENTION_HOURS,
+            help=f'Hours of chat history to keep in the live table (default: {MESSAGE_RETENTION_HOURS})',
+        )
+        parser.add_argument(
+            '--export-dir',
+            type=str,
+            default=ARCHIVE_EXPORT_DIR,
+            help=f'Directory for the .jsonl.gz export, empty disables it (default: {ARCHIVE_EXPORT_DIR or "none"})',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help=f'Messages moved per transaction (default: {PURGE_BATCH_SIZE})',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help='Seconds to pause between batches (default: 0.1)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count messages that would be archived without moving them',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        start_time = time.time()
+        with MessageArchive('' if options['dry_run'] else options['export_dir']) as archive:
+            # Daily statistics are rolled up before the messages leave the table
+            moved = purge_expired_messages(
+                retention_hours=options['hours'],
+                batch_size=options['batch_size'],
+                sleep=options['sleep'],
+                dry_run=options['dry_run'],
+                on_batch=self.report_batch,
+                archive=archive,
+            )
+        elapsed = time.time() - start_time
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Будет архивировано {moved} сообщений'))
+            return
+        rate = f' за {elapsed:.1f}с ({moved / max(elapsed, 0.001):.0f} строк/с)' if moved else ''
+        self.stdout.write(self.style.SUCCESS(f'Архивировано {moved} сообщений{rate}'))
+        if archive.path:
+            self.stdout.write(f'Экспорт: {archive.path}')
+
+    def report_batch(self, batch):
+        if self.verbosity >= 2:
+            self.stdout.write(
+                f'  {batch["deleted"]} сообщений до id {batch["last_id"]} за {batch["seconds"] * 1000:.0f} мс'
+            )
@@ -0,0 +1,189 @@
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+import json
+import time
+from instabot.catalog import get_catalog
+from instabot.models import ConversationSession, Purchase, PurchaseItem
+
+BENCH_SENDER_PREFIX = 'bench-cart-'
+BENCH_ADMIN = 'bench-cart-admin'
+
+
+class Command(BaseCommand):
+    help = 'Time cart operations, the purchase admin list and top products on a seeded order table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=100000,
+            help='Orders seeded for the admin and top products queries (default: 100000)',
+        )
+        parser.add_argument(
+            '--cart-size',
+            type=int,
+            default=10,
+            help='Items in the benchmarked cart (default: 10)',
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=10000,
+            help='Cart operations per measurement (default: 10000)',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Keep seeded orders for repeated runs',
+        )
+
+    def handle(self, *args, **options):
+        products = get_catalog().products
+        if not products:
+            raise CommandError('Нет доступных товаров, выполните setup_bot')
+
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК КОРЗИНЫ И ЗАКАЗОВ ===\n'))
+        self.bench_cart(products, options['cart_size'], options['iterations'])
+
+        try:
+            self.seed(products, options['orders'])
+            self.bench_admin(options['orders'])
+            self.bench_top_products()
+        finally:
+            if not options['keep']:
+                self.cleanup()
+
+    def bench_cart(self, products, cart_size, iterations):
+        items = [{'product_id': 100000 + index, 'quantity': 1} for index in range(cart_size)]
+        product_id = products[0].id
+
+        # The cart as it was stored before, JSON text parsed and serialised on every operation
+        text = json.dumps(items)
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            cart = json.loads(text)
+            cart.append({'product_id': product_id, 'quantity': 1})
+            text = json.dumps(cart)
+            cart = [item for item in json.loads(text) if item['product_id'] != product_id]
+            text = json.dumps(cart)
+            len(json.loads(text))
+        legacy = (time.perf_counter() - start_time) / iterations
+
+        session = ConversationSession(sender_id=f'{BENCH_SENDER_PREFIX}session')
+        session.set_selected_products(items)
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            session.add_product(product_id)
+            session.remove_product(product_id)
+            len(session.get_selected_products())
+        current = (time.perf_counter() - start_time) / iterations
+
+        self.stdout.write(f'Корзина из {cart_size} товаров, добавить + удалить + прочитать:')
+        self.stdout.write(f'  JSON в TextField: {legacy * 1000000:8.1f} мкс')
+        self.stdout.write(f'  JSONField:        {current * 1000000:8.1f} мкс ({legacy / current:.1f}x)\n')
+
+    def seed(self, products, count):
+        existing = Purchase.objects.filter(sender_id__startswith=BENCH_SENDER_PREFIX).count()
+        if existing >= count:
+            self.stdout.write(f'Заказы уже созданы: {existing}\n')
+            return
+
+        self.stdout.write(f'Создание {count - existing} заказов...')
+        start_time = time.perf_counter()
+        for offset in range(existing, count, 5000):
+            batch = range(offset, min(offset + 5000, count))
+            lines = {index: [products[index % len(products)], products[(index + 1) % len(products)]] for index in batch}
+            purchases = Purchase.objects.bulk_create([
+                Purchase(
+                    sender_id=f'{BENCH_SENDER_PREFIX}{index % 1000}',
+                    products_data=[
+                        {
+                            'product_id': product.id,
+                            'product_name': product.name,
+                            'quantity': 1,
+                            'price': float(product.price),
+                            'subtotal': float(product.price),
+                        }
+                        for product in lines[index]
+                    ],
+                    phone_number='0555000000',
+                    address='bench',
+                    customer_last_message='Подтвердить',
+                    total_amount=sum(product.price for product in lines[index]),
+                )
+                for index in batch
+            ])
+            if purchases[0].pk is None:
+                # Backends without RETURNING, look the new ids up
+                purchases = list(Purchase.objects.filter(sender_id__startswith=BENCH_SENDER_PREFIX).order_by('-id')[:len(batch)])[::-1]
+            PurchaseItem.objects.bulk_create([
+                PurchaseItem(
+                    purchase=purchase,
+                    product=product,
+                    product_name=product.name,
+                    quantity=1,
+                    price=product.price,
+                    subtotal=product.price,
+                )
+                for purchase, index in zip(purchases, batch)
+                for product in lines[index]
+            ], batch_size=5000)
+        self.stdout.write(f'  {time.perf_counter() - start_time:.1f}с\n')
+
+    def bench_admin(self, count):
+        user, created = get_user_model().objects.get_or_create(
+            username=BENCH_ADMIN,
+            defaults={'is_staff': True, 'is_superuser': True}
+        )
+        model_admin = admin.site._registry[Purchase]
+        factory = RequestFactory()
+        middle_page = count // model_admin.list_per_page // 2 + 1
+
+        self.stdout.write('Список заказов в админке:')
+        for name, params in (
+            ('первая страница', {}),
+            (f'страница {middle_page}', {'p': middle_page}),
+            ('поиск по отправителю', {'q': f'{BENCH_SENDER_PREFIX}7'}),
+        ):
+            request = factory.get('/admin/instabot/purchase/', params)
+            request.user = user
+            start_time = time.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                response = model_admin.changelist_view(request)
+                response.render()
+            elapsed = time.perf_counter() - start_time
+            self.stdout.write(f'  {name:<22} {elapsed * 1000:7.0f} мс, запросов {len(queries)}')
+        self.stdout.write('')
+
+    def bench_top_products(self):
+        start_time = time.perf_counter()
+        sold = {}
+        for products_data in Purchase.objects.values_list('products_data', flat=True).iterator(chunk_size=5000):
+            for item in products_data:
+                sold[item['product_name']] = sold.get(item['product_name'], 0) + item['quantity']
+        in_python = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        top = list(
+            PurchaseItem.objects.values('product_name')
+            .annotate(sold=Sum('quantity'), revenue=Sum('subtotal'))
+            .order_by('-sold')[:5]
+        )
+        in_sql = time.perf_counter() - start_time
+
+        self.stdout.write('Топ товаров по продажам:')
+        self.stdout.write(f'  разбор JSON заказов в Python: {in_python * 1000:7.0f} мс')
+        self.stdout.write(f'  GROUP BY по PurchaseItem:     {in_sql * 1000:7.0f} мс')
+        for row in top:
+            self.stdout.write(f'    {row["product_name"]}: {row["sold"]} шт, {row["revenue"]} сом')
+
+    def cleanup(self):
+        purchases = Purchase.objects.filter(sender_id__startswith=BENCH_SENDER_PREFIX)
+        PurchaseItem.objects.filter(purchase__in=purchases).delete()
+        purchases.delete()
+        get_user_model().objects.filter(username=BENCH_ADMIN).delete()
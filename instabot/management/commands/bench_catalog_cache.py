@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+import time
+from instabot.catalog import catalog_stats, get_catalog, invalidate_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        'Time building the product catalog snapshot and reading it from the cache. '
+        'The snapshot is per process, the web and worker processes build their own at startup'
+    )
+
+    def handle(self, *args, **options):
+        invalidate_catalog()
+
+        start_time = time.time()
+        snapshot = get_catalog()
+        build_time = time.time() - start_time
+
+        start_time = time.time()
+        get_catalog()
+        hit_time = time.time() - start_time
+
+        stats = catalog_stats()
+
+        self.stdout.write(self.style.SUCCESS('=== КЭШ КАТАЛОГА ==='))
+        self.stdout.write(f'Товаров в каталоге: {len(snapshot.products)}')
+        self.stdout.write(f'Версия: {stats["version"]}')
+        self.stdout.write(f'Построение: {build_time * 1000:.2f} мс')
+        self.stdout.write(f'Чтение из кэша: {hit_time * 1000000:.1f} мкс')
+        self.stdout.write(
+            f'Попаданий: {stats["hits"]}, промахов: {stats["misses"]}, '
+            f'сбросов: {stats["invalidations"]}'
+        )
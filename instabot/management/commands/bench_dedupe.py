@@ -0,0 +1,110 @@
+from django.core.management.base import BaseCommand
+import time
+from instabot import graph_api, views
+from instabot.dedupe import event_deduplicator
+from instabot.models import ConversationSession, InstaBotMessage, ProcessedEvent, Product, Purchase
+from instabot.stubs import GraphStubServer
+
+BENCH_SENDER_BASE = 980000000000
+
+
+class Command(BaseCommand):
+    help = 'Replay webhook events to check duplicate suppression and measure its cost'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=200,
+            help='Distinct events delivered before replaying them (default: 200)',
+        )
+        parser.add_argument(
+            '--senders',
+            type=int,
+            default=20,
+            help='Distinct senders (default: 20)',
+        )
+
+    def handle(self, *args, **options):
+        graph = GraphStubServer(latency_ms=0).start()
+        original_graph_url = graph_api.GRAPH_API_URL
+        graph_api.GRAPH_API_URL = graph.url
+        sender_ids = [str(BENCH_SENDER_BASE + index) for index in range(options['senders'])]
+
+        events = [
+            {
+                'sender': {'id': sender_ids[index % len(sender_ids)]},
+                'timestamp': 1700000000000 + index,
+                'message': {'mid': f'bench-dedupe-{index}', 'text': 'каталог'},
+            }
+            for index in range(options['events'])
+        ]
+
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК ПОВТОРНЫХ СОБЫТИЙ ==='))
+        self.stdout.write(f'Событий: {len(events)}, отправителей: {len(sender_ids)}\n')
+
+        try:
+            self.run_phase('Первая доставка', events, sender_ids)
+            self.run_phase('Повтор (память)', events, sender_ids)
+            # Another worker has an empty LRU and relies on the unique constraint
+            event_deduplicator.clear()
+            self.run_phase('Повтор (БД)', events, sender_ids)
+            self.check_purchase_replay(sender_ids[0])
+        finally:
+            graph_api.GRAPH_API_URL = original_graph_url
+            graph.stop()
+            self.cleanup(sender_ids, events)
+
+    def run_phase(self, name, events, sender_ids):
+        messages_before = InstaBotMessage.objects.filter(sender_id__in=sender_ids).count()
+        duplicates_before = event_deduplicator.duplicates
+
+        start_time = time.perf_counter()
+        for event in events:
+            views.process_messaging_event(event)
+        elapsed = time.perf_counter() - start_time
+
+        created = InstaBotMessage.objects.filter(sender_id__in=sender_ids).count() - messages_before
+        dropped = event_deduplicator.duplicates - duplicates_before
+        self.stdout.write(
+            f'{name:<16} | {elapsed / len(events) * 1000000:9.0f} мкс/событие | '
+            f'отброшено {dropped:5} | новых сообщений {created:5}'
+        )
+
+    def check_purchase_replay(self, sender_id):
+        product = Product.objects.filter(available=True).first()
+        if product is None:
+            self.stdout.write(self.style.WARNING('Нет товаров, проверка повторного подтверждения пропущена'))
+            return
+
+        session, created = ConversationSession.objects.update_or_create(
+            sender_id=sender_id,
+            defaults={
+                'current_state': 'purchase_confirmation',
+                'collected_phone': '+996555123456',
+                'collected_address': 'ул. Тестовая 1',
+            }
+        )
+        session.set_selected_products([{'product_id': product.id, 'quantity': 1}])
+        session.save()
+
+        event = {
+            'sender': {'id': sender_id},
+            'timestamp': 1700000999999,
+            'message': {'mid': 'bench-dedupe-confirm', 'text': 'Подтвердить'},
+        }
+        for attempt in range(3):
+            views.process_messaging_event(event)
+
+        purchases = Purchase.objects.filter(sender_id=sender_id).count()
+        status = self.style.SUCCESS('✓') if purchases == 1 else self.style.ERROR('✗')
+        self.stdout.write(f'\n«Подтвердить» доставлено 3 раза: заказов создано {purchases} {status}')
+
+    def cleanup(self, sender_ids, events):
+        InstaBotMessage.objects.filter(sender_id__in=sender_ids).delete()
+        ConversationSession.objects.filter(sender_id__in=sender_ids).delete()
+        Purchase.objects.filter(sender_id__in=sender_ids).delete()
+        ProcessedEvent.objects.filter(
+            key__in=[event['message']['mid'] for event in events] + ['bench-dedupe-confirm']
+        ).delete()
+        event_deduplicator.clear()
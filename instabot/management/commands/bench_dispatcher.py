@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from concurrent.futures import wait
+import threading
+import time
+from instabot.dispatcher import SenderDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Benchmark sender dispatcher throughput against the number of distinct senders'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=400,
+            help='Events per run (default: 400)',
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0.02,
+            help='Simulated processing time per event in seconds (default: 0.02)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Dispatcher concurrency (default: 16)',
+        )
+        parser.add_argument(
+            '--senders',
+            type=str,
+            default='1,2,4,8,16,32,64',
+            help='Comma separated list of distinct sender counts (default: 1,2,4,8,16,32,64)',
+        )
+
+    def handle(self, *args, **options):
+        events = options['events']
+        latency = options['latency']
+        concurrency = options['concurrency']
+        sender_counts = [int(value) for value in options['senders'].split(',')]
+
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК ДИСПЕТЧЕРА ==='))
+        self.stdout.write(
+            f'Событий: {events}, обработка: {latency * 1000:.0f} мс, потоков: {concurrency}\n'
+        )
+
+        baseline = None
+        for senders in sender_counts:
+            throughput, ordered = self.run_once(events, latency, concurrency, senders)
+            if baseline is None:
+                baseline = throughput
+
+            status = self.style.SUCCESS('порядок ✓') if ordered else self.style.ERROR('порядок ✗')
+            self.stdout.write(
+                f'Отправителей: {senders:>4} | {throughput:8.1f} событий/с | '
+                f'x{throughput / baseline:5.1f} | {status}'
+            )
+
+    def run_once(self, events, latency, concurrency, senders):
+        dispatcher = SenderDispatcher(concurrency)
+        seen = {}
+        lock = threading.Lock()
+
+        def handle_event(sender_id, sequence):
+            time.sleep(latency)
+            with lock:
+                seen.setdefault(sender_id, []).append(sequence)
+
+        start_time = time.time()
+        futures = [
+            dispatcher.submit(i % senders, handle_event, i % senders, i)
+            for i in range(events)
+        ]
+        wait(futures)
+        elapsed = time.time() - start_time
+        dispatcher.shutdown()
+
+        ordered = all(sequence == sorted(sequence) for sequence in seen.values())
+        return events / elapsed, ordered
@@ -0,0 +1,135 @@
+from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import time
+from instabot import graph_api
+from instabot.management.commands.loadtest_webhook import percentile
+from instabot.stubs import GraphStubServer
+
+
+class Command(BaseCommand):
+    help = 'Compare bare requests.post, the pooled session and the coalescing outbox against a local Graph API stub'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=300,
+            help='Messages per mode (default: 300)',
+        )
+        parser.add_argument(
+            '--recipients',
+            type=int,
+            default=30,
+            help='Distinct recipients (default: 30)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=8,
+            help='Sends in flight at once (default: 8)',
+        )
+        parser.add_argument(
+            '--latency-ms',
+            type=int,
+            default=20,
+            help='Stub latency per call (default: 20)',
+        )
+        parser.add_argument(
+            '--fail-every',
+            type=int,
+            default=0,
+            help='Answer every N-th call with 429 to exercise rate limit errors, 0 disables (default: 0)',
+        )
+
+    def handle(self, *args, **options):
+        graph = GraphStubServer(latency_ms=options['latency_ms'], fail_every=options['fail_every']).start()
+        original_graph_url = graph_api.GRAPH_API_URL
+        graph_api.GRAPH_API_URL = graph.url
+
+        # Recipients get consecutive replies in bursts, like streamed chunks or fallback + reply
+        messages = [
+            (str(1000 + index % options['recipients']), f'Сообщение {index}')
+            for index in range(options['messages'])
+        ]
+        messages.sort(key=lambda message: message[0])
+
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК ОТПРАВКИ В GRAPH API ==='))
+        self.stdout.write(
+            f'Сообщений: {len(messages)}, получателей: {options["recipients"]}, '
+            f'параллельно: {options["concurrency"]}, задержка: {options["latency_ms"]} мс, '
+            f'429 каждый: {options["fail_every"] or "-"}\n'
+        )
+
+        try:
+            for mode, run in (
+                ('requests.post', self.run_bare),
+                ('Пул', self.run_pooled),
+                ('Пул + очередь', self.run_outbox),
+            ):
+                graph.reset()
+                graph_api.send_metrics.reset()
+                start_time = time.perf_counter()
+                latencies, errors = run(messages, options['concurrency'])
+                elapsed = time.perf_counter() - start_time
+
+                stats = graph_api.send_metrics.stats()
+                self.stdout.write(
+                    f'{mode:<14} | {len(messages) / elapsed:7.1f} сообщ/с | '
+                    f'p50 {percentile(latencies, 50):6.1f} мс, p95 {percentile(latencies, 95):6.1f} мс | '
+                    f'вызовов {graph.calls:4}, новых соединений {graph.connections:4}, '
+                    f'доставлено {self.count_delivered(graph):4}, ошибок {errors}, '
+                    f'повторов {stats["retries"]}, объединено {stats["coalesced"]}'
+                )
+        finally:
+            graph_api.GRAPH_API_URL = original_graph_url
+            graph.stop()
+
+    def count_delivered(self, graph):
+        """Texts that reached the stub, coalesced messages carry several"""
+        with graph.lock:
+            return sum(
+                body['message']['text'].count('\n\n') + 1
+                for received_at, body in graph.received if 'message' in body
+            )
+
+    def run_bare(self, messages, concurrency):
+        def send(message):
+            recipient_id, text = message
+            url, headers, json_body = graph_api.build_send_request(text, recipient_id)
+            start_time = time.perf_counter()
+            response = requests.post(url, headers=headers, json=json_body, timeout=10)
+            return (time.perf_counter() - start_time) * 1000, response.ok
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, messages))
+        return [latency for latency, ok in results], sum(1 for latency, ok in results if not ok)
+
+    def run_pooled(self, messages, concurrency):
+        def send(message):
+            recipient_id, text = message
+            start_time = time.perf_counter()
+            try:
+                graph_api.send_text(text, recipient_id)
+                ok = True
+            except (graph_api.GraphAPIError, graph_api.RateLimited):
+                ok = False
+            return (time.perf_counter() - start_time) * 1000, ok
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, messages))
+        return [latency for latency, ok in results], sum(1 for latency, ok in results if not ok)
+
+    def run_outbox(self, messages, concurrency):
+        outbox = graph_api.Outbox(workers=concurrency)
+        submitted = [(time.perf_counter(), outbox.submit(recipient_id, text)) for recipient_id, text in messages]
+
+        latencies = []
+        errors = 0
+        for start_time, future in submitted:
+            result = future.result()
+            latencies.append((time.perf_counter() - start_time) * 1000)
+            if 'error' in result:
+                errors += 1
+        outbox.shutdown()
+        return latencies, errors
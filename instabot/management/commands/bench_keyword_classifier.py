@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+import time
+from instabot.keywords import KeywordClassifier, best_intent, default_rules
+
+
+def legacy_classify(user_message):
+    """Keyword lists as they were inlined in classify_intent"""
+    message_lower = user_message.lower()
+    if any(word in message_lower for word in ['купить', 'заказать', 'хочу', 'возьму', 'оформить']):
+        return 'ПОКУПКА'
+    if any(word in message_lower for word in ['каталог', 'товары', 'что есть', 'показать', 'посмотреть']):
+        return 'КАТАЛОГ'
+    if any(word in message_lower for word in ['жалоба', 'плохо', 'не работает', 'недоволен', 'проблема']):
+        return 'ЖАЛОБА'
+    if any(word in message_lower for word in ['спасибо', 'благодарю', 'отлично', 'хорошо']):
+        return 'БЛАГОДАРНОСТЬ'
+    return None
+
+
+def legacy_post_purchase(user_message):
+    """Post-purchase handler checks: two more lowercase + scan passes"""
+    if any(word in user_message.lower() for word in ['купить', 'заказать', 'еще', 'также', 'тоже']):
+        return 'ПОКУПКА'
+    if any(word in user_message.lower() for word in ['каталог', 'товары', 'что есть']):
+        return 'КАТАЛОГ'
+    return legacy_classify(user_message)
+
+
+SAMPLE_MESSAGES = [
+    'Здравствуйте',
+    'Сколько стоит доставка?',
+    'Хочу купить триммер Wahl',
+    'Покажите каталог пожалуйста',
+    'Спасибо большое, все отлично!',
+    'Машинка не работает, это проблема',
+    'А можно еще один такой же?',
+    'Спасибо, отлично, хочу еще',
+    'Добрый день! Подскажите, пожалуйста, есть ли у вас профессиональные машинки для стрижки '
+    'с керамическими ножами и сколько времени занимает доставка по Бишкеку?',
+]
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark compiled keyword classifier against the inline keyword lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20000,
+            help='Passes over the sample messages (default: 20000)',
+        )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        classifier = KeywordClassifier(default_rules())
+        total = iterations * len(SAMPLE_MESSAGES)
+
+        results = [
+            ('Списки (classify_intent)', lambda message: legacy_classify(message)),
+            ('Списки (post_purchase)', lambda message: legacy_post_purchase(message)),
+            ('Компилированный, приоритет', lambda message: best_intent(classifier.score(message), ranking='priority')),
+            ('Компилированный, по весу', lambda message: best_intent(classifier.score(message), ranking='score')),
+        ]
+
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК КЛАССИФИКАТОРА КЛЮЧЕВЫХ СЛОВ ==='))
+        for title, func in results:
+            start_time = time.perf_counter()
+            for _ in range(iterations):
+                for message in SAMPLE_MESSAGES:
+                    func(message)
+            elapsed = time.perf_counter() - start_time
+            self.stdout.write(f'{title:<30} {elapsed / total * 1000000:6.2f} мкс/сообщение')
+
+        # Priority ranking routes like the inline lists, any difference there is a regression
+        for ranking, title in (
+            ('priority', 'Расхождения с прежними списками (приоритет, ожидается нет)'),
+            ('score', 'Расхождения с прежними списками (по весу, ожидаемые)'),
+        ):
+            self.stdout.write(f'\n{title}:')
+            differences = 0
+            for message in SAMPLE_MESSAGES:
+                old, new = legacy_classify(message), best_intent(classifier.score(message), ranking=ranking)
+                if old != new:
+                    differences += 1
+                    self.stdout.write(f'  {message[:40]!r}: {old} -> {new}')
+            if not differences:
+                self.stdout.write('  нет')
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+import random
+import re
+import time
+from instabot.matcher import ProductMatcher
+from instabot.models import Product
+
+
+def legacy_extract(products, message):
+    """Linear scan used before the matcher index"""
+    for product in products:
+        if product.name.lower() in message.lower():
+            quantity_match = re.search(r'(\d+)\s*шт|(\d+)\s*штук|(\d+)\s*штуки', message.lower())
+            quantity = 1
+            if quantity_match:
+                quantity = int(quantity_match.group(1) or quantity_match.group(2) or quantity_match.group(3))
+            return product.id, quantity
+    return None, None
+
+
+class Command(BaseCommand):
+    help = 'Benchmark product name matcher against the linear scan on a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--products',
+            type=int,
+            default=10000,
+            help='Synthetic catalog size (default: 10000)',
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=500,
+            help='Messages to match (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        random.seed(42)
+        brands = ['Wahl', 'Moser', 'Philips', 'Remington', 'Babyliss', 'Panasonic', 'Braun', 'Andis']
+        kinds = ['Триммер', 'Машинка для стрижки', 'Бритва', 'Шейвер']
+
+        products = [
+            Product(id=i + 1, name=f'{random.choice(kinds)} {random.choice(brands)} {i + 1000}', price=1000)
+            for i in range(options['products'])
+        ]
+
+        messages = []
+        for _ in range(options['messages']):
+            first, second = random.sample(products, 2)
+            messages.append(random.choice([
+                f'Хочу {first.name.lower()} 2 шт',
+                f'Добавьте {first.name} и {second.name} 3 штуки',
+                'А есть что-нибудь для бороды?',
+            ]))
+
+        start_time = time.time()
+        matcher = ProductMatcher(products)
+        build_time = time.time() - start_time
+
+        start_time = time.time()
+        for message in messages:
+            legacy_extract(products, message)
+        legacy_time = time.time() - start_time
+
+        start_time = time.time()
+        found = 0
+        for message in messages:
+            found += len(matcher.find(message))
+        matcher_time = time.time() - start_time
+
+        count = len(messages)
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК ПОИСКА ТОВАРОВ ==='))
+        self.stdout.write(f'Товаров: {len(products)}, сообщений: {count}')
+        self.stdout.write(f'Построение индекса: {build_time * 1000:.1f} мс')
+        self.stdout.write(f'Линейный поиск: {legacy_time / count * 1000000:.1f} мкс/сообщение')
+        self.stdout.write(f'Индекс: {matcher_time / count * 1000000:.1f} мкс/сообщение')
+        self.stdout.write(f'Ускорение: x{legacy_time / matcher_time:.1f}')
+        self.stdout.write(f'Найдено товаров индексом: {found}')
@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from instabot import graph_api, views
+from instabot.catalog import get_catalog
+from instabot.dedupe import event_deduplicator
+from instabot.management.commands.loadtest_bot import CONVERSATION
+from instabot.models import ConversationSession, InstaBotMessage, ProcessedEvent, Purchase
+from instabot.session_store import SESSION_CACHE_TTL, session_store
+from instabot.stubs import GraphStubServer
+
+BENCH_SENDER = '960000000000'
+SESSION_TABLE = ConversationSession._meta.db_table
+
+
+class Command(BaseCommand):
+    help = 'Count session reads and writes per conversation turn, expecting at most one of each'
+
+    def handle(self, *args, **options):
+        products = get_catalog().products
+        if not products:
+            raise CommandError('Нет доступных товаров, выполните setup_bot')
+
+        graph = GraphStubServer(latency_ms=0).start()
+        original_graph_url = graph_api.GRAPH_API_URL
+        graph_api.GRAPH_API_URL = graph.url
+
+        self.stdout.write(self.style.SUCCESS('=== ЗАПРОСЫ К СЕССИИ ЗА СООБЩЕНИЕ ==='))
+        failed = 0
+        try:
+            for mode, ttl in (('Без кэша', 0), ('С кэшем', SESSION_CACHE_TTL or 30)):
+                self.cleanup()
+                original_ttl = session_store.ttl
+                session_store.ttl = ttl
+                try:
+                    failed += self.run_conversation(mode, products[0])
+                finally:
+                    session_store.ttl = original_ttl
+        finally:
+            graph_api.GRAPH_API_URL = original_graph_url
+            graph.stop()
+            self.cleanup()
+
+        if failed:
+            self.stdout.write(self.style.ERROR(f'\nСообщений с лишними запросами к сессии: {failed}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('\nНе больше одного чтения и одной записи сессии на сообщение'))
+
+    def run_conversation(self, mode, product):
+        self.stdout.write(f'\n{mode}')
+        self.stdout.write(f'{"Сообщение":<36} | {"состояние":<28} | всего | чтение | запись')
+        self.stdout.write('-' * 90)
+
+        failed = 0
+        for index, (stage, text) in enumerate(CONVERSATION):
+            text = text.format(product=product.name)
+            event = {
+                'sender': {'id': BENCH_SENDER},
+                'message': {'mid': f'bench-session-{mode}-{index}', 'text': text},
+            }
+            with CaptureQueriesContext(connection) as queries:
+                views.process_messaging_event(event)
+
+            reads, writes = self.count_session_queries(queries.captured_queries)
+            state = ConversationSession.objects.get(sender_id=BENCH_SENDER).current_state
+            ok = reads <= 1 and writes <= 1
+            failed += not ok
+            status = self.style.SUCCESS('✓') if ok else self.style.ERROR('✗')
+            self.stdout.write(
+                f'{text[:36]:<36} | {state:<28} | {len(queries):5} | {reads:6} | {writes:6} {status}'
+            )
+        return failed
+
+    def count_session_queries(self, captured):
+        reads = writes = 0
+        for query in captured:
+            if SESSION_TABLE not in query['sql']:
+                continue
+            verb = query['sql'].split(' ', 1)[0].upper()
+            if verb == 'SELECT':
+                reads += 1
+            elif verb in ('UPDATE', 'INSERT'):
+                writes += 1
+        return reads, writes
+
+    def cleanup(self):
+        InstaBotMessage.objects.filter(sender_id=BENCH_SENDER).delete()
+        ConversationSession.objects.filter(sender_id=BENCH_SENDER).delete()
+        Purchase.objects.filter(sender_id=BENCH_SENDER).delete()
+        ProcessedEvent.objects.filter(key__startswith='bench-session-').delete()
+        event_deduplicator.clear()
+        session_store.evict(BENCH_SENDER)
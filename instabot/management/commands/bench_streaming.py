@@ -0,0 +1,116 @@
+from django.core.management.base import BaseCommand, CommandError
+from groq import Groq
+import time
+from instabot import graph_api, streaming, views
+from instabot.management.commands.loadtest_webhook import percentile
+from instabot.models import ConversationSession, InstaBotMessage
+from instabot.stubs import GraphStubServer, MockLLMServer
+
+BENCH_SENDER_BASE = 990000000000
+
+
+class Command(BaseCommand):
+    help = 'Compare time to first visible output of buffered and streamed AI replies against local stubs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=10,
+            help='Messages per mode (default: 10)',
+        )
+        parser.add_argument(
+            '--first-token-ms',
+            type=int,
+            default=300,
+            help='Mock LLM delay before the first token (default: 300)',
+        )
+        parser.add_argument(
+            '--token-ms',
+            type=int,
+            default=20,
+            help='Mock LLM delay between tokens (default: 20)',
+        )
+        parser.add_argument(
+            '--graph-latency-ms',
+            type=int,
+            default=50,
+            help='Graph API stub latency per call (default: 50)',
+        )
+
+    def handle(self, *args, **options):
+        if not views.is_ai_api_healthy():
+            raise CommandError('Автомат AI API открыт, ответы пойдут в заглушку. Повторите позже')
+
+        llm = MockLLMServer(first_token_ms=options['first_token_ms'], token_ms=options['token_ms']).start()
+        graph = GraphStubServer(latency_ms=options['graph_latency_ms']).start()
+
+        original_client = views.client
+        original_graph_url = graph_api.GRAPH_API_URL
+        original_streaming = streaming.AI_STREAMING
+        views.client = Groq(api_key='stub', base_url=llm.url)
+        graph_api.GRAPH_API_URL = graph.url
+
+        self.stdout.write(self.style.SUCCESS('=== БЕНЧМАРК ПОТОКОВЫХ ОТВЕТОВ ==='))
+        self.stdout.write(
+            f'Сообщений: {options["messages"]}, первый токен: {options["first_token_ms"]} мс, '
+            f'между токенами: {options["token_ms"]} мс, Graph API: {options["graph_latency_ms"]} мс\n'
+        )
+
+        try:
+            for mode, enabled in (('Целиком', False), ('Поток', True)):
+                streaming.AI_STREAMING = enabled
+                results = [self.run_once(graph, index, enabled) for index in range(options['messages'])]
+                self.report(mode, results)
+        finally:
+            views.client = original_client
+            graph_api.GRAPH_API_URL = original_graph_url
+            streaming.AI_STREAMING = original_streaming
+            llm.stop()
+            graph.stop()
+            self.cleanup(options['messages'])
+
+    def run_once(self, graph, index, enabled):
+        sender_id = str(BENCH_SENDER_BASE + index + (1000 if enabled else 0))
+        ConversationSession.objects.update_or_create(
+            sender_id=sender_id,
+            defaults={'current_state': 'inquiry'}
+        )
+
+        start_time = time.perf_counter()
+        views.process_messaging_event({
+            'sender': {'id': sender_id},
+            'message': {'text': 'Расскажите про доставку и цены'},
+        })
+        finished_at = time.perf_counter()
+
+        with graph.lock:
+            calls = [received_at for received_at, body in graph.received
+                     if str(body.get('recipient', {}).get('id')) == sender_id]
+        messages = graph.messages_for(sender_id)
+        return {
+            'first_visible_ms': (calls[0] - start_time) * 1000 if calls else None,
+            'first_text_ms': (messages[0][0] - start_time) * 1000 if messages else None,
+            'total_ms': (finished_at - start_time) * 1000,
+            'messages': len(messages),
+        }
+
+    def report(self, mode, results):
+        first_visible = [result['first_visible_ms'] for result in results if result['first_visible_ms'] is not None]
+        first_text = [result['first_text_ms'] for result in results if result['first_text_ms'] is not None]
+        total = [result['total_ms'] for result in results]
+        messages = sum(result['messages'] for result in results) / len(results)
+
+        self.stdout.write(
+            f'{mode:<8} | первый отклик p50 {percentile(first_visible, 50):6.0f} мс | '
+            f'первый текст p50 {percentile(first_text, 50):6.0f} мс, p95 {percentile(first_text, 95):6.0f} мс | '
+            f'всего p50 {percentile(total, 50):6.0f} мс | сообщений на ответ {messages:.1f}'
+        )
+
+    def cleanup(self, count):
+        sender_ids = [
+            str(BENCH_SENDER_BASE + index + offset)
+            for index in range(count) for offset in (0, 1000)
+        ]
+        InstaBotMessage.objects.filter(sender_id__in=sender_ids).delete()
+        ConversationSession.objects.filter(sender_id__in=sender_ids).delete()
@@ -1,39 +1,161 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from datetime import timedelta
-from instabot.models import InstaBotMessage, ConversationSession, Purchase, Product
+from datetime import date, timedelta
+import argparse
+from django.db.models import Count, Q, Sum
+import json
+from instabot.models import ConversationSession, DailyProductStat, DailyStat, Product, IntentCacheEntry
+from instabot.event_queue import queue_stats
+from instabot.outbound_queue import outbound_stats
+from instabot.rollups import rollup_daily_stats
+from instabot.views import ai_breaker
+
+TOP_PRODUCTS = 5
+
+
+def parse_day(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'неверная дата {value}, ожидается ГГГГ-ММ-ДД')
 
 
 class Command(BaseCommand):
     help = 'Show bot statistics'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from',
+            dest='from_day',
+            type=parse_day,
+            help='First day of the period, YYYY-MM-DD (default: 30 days before --to)',
+        )
+        parser.add_argument(
+            '--to',
+            dest='to_day',
+            type=parse_day,
+            help='Last day of the period, YYYY-MM-DD (default: today)',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Print statistics as JSON',
+        )
+
     def handle(self, *args, **options):
-        # Active sessions
-        active_sessions = ConversationSession.objects.exclude(current_state='idle').count()
-        total_sessions = ConversationSession.objects.count()
+        today = timezone.localdate()
+        to_day = options['to_day'] or today
+        from_day = options['from_day'] or to_day - timedelta(days=29)
+        if from_day > to_day:
+            raise CommandError('--from позже --to')
+
+        # Only rows added since the last rollup are read
+        rollup_daily_stats()
 
-        # Messages today
-        today = timezone.now().date()
-        messages_today = InstaBotMessage.objects.filter(timestamp__date=today).count()
+        stats = {
+            'period': {'from': from_day, 'to': to_day},
+            'totals': self.totals(DailyStat.objects.all()),
+            'today': self.totals(DailyStat.objects.filter(day=today)),
+            'period_totals': self.totals(DailyStat.objects.filter(day__range=(from_day, to_day))),
+            'days': list(
+                DailyStat.objects.filter(day__range=(from_day, to_day)).order_by('day')
+                .values('day', 'messages', 'new_sessions', 'orders', 'revenue')
+            ),
+            'top_products': list(
+                DailyProductStat.objects.filter(day__range=(from_day, to_day))
+                .values('product_name')
+                .annotate(quantity=Sum('quantity'), revenue=Sum('revenue'))
+                .order_by('-quantity')[:TOP_PRODUCTS]
+            ),
+            'sessions': {
+                'active': ConversationSession.objects.exclude(current_state='idle').count(),
+                'total': ConversationSession.objects.count(),
+            },
+            'products': Product.objects.aggregate(total=Count('id'), available=Count('id', filter=Q(available=True))),
+            'queue': queue_stats(),
+            'outbound': outbound_stats(),
+            'intent_cache': IntentCacheEntry.objects.aggregate(
+                entries=Count('id'), hits=Sum('hits'), misses=Sum('misses')
+            ),
+            'ai_breaker': ai_breaker.stats(),
+        }
 
-        # Purchases
-        total_purchases = Purchase.objects.count()
-        purchases_today = Purchase.objects.filter(timestamp__date=today).count()
+        if options['json']:
+            self.stdout.write(json.dumps(stats, ensure_ascii=False, indent=2, default=str))
+        else:
+            self.print_stats(stats)
 
-        # Revenue
-        total_revenue = sum(p.total_amount for p in Purchase.objects.all())
-        revenue_today = sum(p.total_amount for p in Purchase.objects.filter(timestamp__date=today))
+    def totals(self, days):
+        totals = days.aggregate(
+            messages=Sum('messages'), new_sessions=Sum('new_sessions'), orders=Sum('orders'), revenue=Sum('revenue')
+        )
+        return {name: value or 0 for name, value in totals.items()}
 
-        # Products
-        total_products = Product.objects.count()
-        available_products = Product.objects.filter(available=True).count()
+    def print_stats(self, stats):
+        period = stats['period']
+        totals = stats['totals']
+        today = stats['today']
+        period_totals = stats['period_totals']
+        queue = stats['queue']
+        outbound = stats['outbound']
+        intent_cache = stats['intent_cache']
+        breaker = stats['ai_breaker']
 
         self.stdout.write(self.style.SUCCESS('=== СТАТИСТИКА БОТА ==='))
-        self.stdout.write(f'Активных сессий: {active_sessions} из {total_sessions}')
-        self.stdout.write(f'Сообщений сегодня: {messages_today}')
-        self.stdout.write(f'Заказов всего: {total_purchases}')
-        self.stdout.write(f'Заказов сегодня: {purchases_today}')
-        self.stdout.write(f'Общая выручка: {total_revenue} сом')
-        self.stdout.write(f'Выручка сегодня: {revenue_today} сом')
-        self.stdout.write(f'Товаров: {available_products} из {total_products} доступно')
+        self.stdout.write(f'Активных сессий: {stats["sessions"]["active"]} из {stats["sessions"]["total"]}')
+        self.stdout.write(f'Сообщений сегодня: {today["messages"]}')
+        self.stdout.write(f'Заказов всего: {totals["orders"]}')
+        self.stdout.write(f'Заказов сегодня: {today["orders"]}')
+        self.stdout.write(f'Общая выручка: {totals["revenue"]} сом')
+        self.stdout.write(f'Выручка сегодня: {today["revenue"]} сом')
+        self.stdout.write(f'Товаров: {stats["products"]["available"]} из {stats["products"]["total"]} доступно')
+
+        self.stdout.write(self.style.SUCCESS(f'\n=== С {period["from"]} ПО {period["to"]} ==='))
+        self.stdout.write(
+            f'Сообщений: {period_totals["messages"]}, новых сессий: {period_totals["new_sessions"]}, '
+            f'заказов: {period_totals["orders"]}, выручка: {period_totals["revenue"]} сом'
+        )
+        for day in stats['days']:
+            self.stdout.write(
+                f'  {day["day"]}: {day["messages"]:6} сообщений, {day["new_sessions"]:4} сессий, '
+                f'{day["orders"]:4} заказов, {day["revenue"]} сом'
+            )
+        if stats['top_products']:
+            self.stdout.write('Популярные товары:')
+            for product in stats['top_products']:
+                self.stdout.write(f'  {product["product_name"]}: {product["quantity"]} шт, {product["revenue"]} сом')
 
+        self.stdout.write('')
+        self.stdout.write(f'Событий в очереди: {queue["pending"]} (ошибок: {queue["failed"]})')
+        if queue['processed']:
+            self.stdout.write(
+                f'Задержка очереди: {queue["avg_wait_ms"]:.0f} мс, '
+                f'обработка: {queue["avg_processing_ms"]:.0f} мс'
+            )
+        self.stdout.write(
+            f'Отложенных ответов: {outbound["pending"]} '
+            f'(старейший {outbound["oldest_pending_seconds"]:.0f}с, ошибок: {outbound["failed"]})'
+        )
+        if outbound['sent']:
+            self.stdout.write(
+                f'Ожидание отложенных ответов: {outbound["avg_wait_ms"] / 1000:.1f}с '
+                f'(макс. {outbound["max_wait_ms"] / 1000:.1f}с)'
+            )
+        cache_hits = intent_cache['hits'] or 0
+        cache_lookups = cache_hits + (intent_cache['misses'] or 0)
+        if cache_lookups:
+            self.stdout.write(
+                f'Кэш намерений: {intent_cache["entries"]} записей, '
+                f'попаданий {cache_hits / cache_lookups:.1%} ({cache_hits} запросов к AI сэкономлено)'
+            )
+        breaker_line = (
+            f'AI API: {breaker["state"]}, ошибок подряд: {breaker["failure_count"]}, '
+            f'отвечено заглушкой: {breaker["short_circuited"]}, '
+            f'недоступен всего: {breaker["total_open_seconds"]:.0f}с'
+        )
+        if breaker['state'] == 'closed':
+            self.stdout.write(breaker_line)
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'{breaker_line} (открыт {breaker["current_open_seconds"]:.0f}с)'
+            ))
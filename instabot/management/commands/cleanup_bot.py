@@ -1,37 +1,113 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
-from instabot.models import InstaBotMessage, ConversationSession
+import time
+from instabot.models import ConversationSession, WebhookEvent, IntentCacheEntry, OutboundMessage
+from instabot.intent_cache import INTENT_CACHE_TTL
+from instabot.dedupe import purge_processed_events
+from instabot.retention import MESSAGE_RETENTION_HOURS, PURGE_BATCH_SIZE, delete_in_batches, purge_expired_messages
 
 
 class Command(BaseCommand):
-    help = 'Clean up old bot data'
+    help = (
+        'Clean up old bot data in primary key batches. '
+        'An interrupted run continues where it stopped when started again.'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--days',
             type=int,
             default=7,
-            help='Number of days to keep data (default: 7)',
+            help='Number of days to keep sessions and processed events (default: 7)',
+        )
+        parser.add_argument(
+            '--message-hours',
+            type=int,
+            default=MESSAGE_RETENTION_HOURS,
+            help=f'Hours of chat history to keep (default: {MESSAGE_RETENTION_HOURS})',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help=f'Rows deleted per transaction (default: {PURGE_BATCH_SIZE})',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help='Seconds to pause between batches (default: 0.1)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count rows that would be deleted without deleting them',
         )
 
     def handle(self, *args, **options):
-        days = options['days']
-        cutoff_date = timezone.now() - timedelta(days=days)
+        self.verbosity = options['verbosity']
+        dry_run = options['dry_run']
+        cutoff_date = timezone.now() - timedelta(days=options['days'])
+        batches = {
+            'batch_size': options['batch_size'],
+            'sleep': options['sleep'],
+            'dry_run': dry_run,
+            'on_batch': self.report_batch,
+        }
 
-        # Clean old messages
-        old_messages = InstaBotMessage.objects.filter(timestamp__lt=cutoff_date)
-        message_count = old_messages.count()
-        old_messages.delete()
+        jobs = [
+            ('старых сообщений', lambda: purge_expired_messages(
+                retention_hours=options['message_hours'], **batches
+            )),
+            # Plain SQL delete without post_delete, so no session store eviction: worker caches
+            # expire within SESSION_CACHE_TTL and a session deleted meanwhile is inserted again
+            ('старых сессий', lambda: delete_in_batches(
+                ConversationSession.objects.filter(updated_at__lt=cutoff_date), 'cleanup_sessions', **batches
+            )),
+            # Failed events are kept as long as processed ones for inspection
+            ('обработанных событий', lambda: delete_in_batches(
+                WebhookEvent.objects.filter(status__in=['done', 'failed'], created_at__lt=cutoff_date),
+                'cleanup_webhook_events',
+                **batches
+            )),
+            # Delivered messages of the outbound delay queue
+            ('отправленных ответов', lambda: delete_in_batches(
+                OutboundMessage.objects.filter(status='sent', created_at__lt=cutoff_date), 'cleanup_outbound',
+                **batches
+            )),
+            # Dedupe records past the redelivery window
+            ('записей дедупликации', lambda: purge_processed_events(**batches)),
+            ('записей кэша намерений', lambda: delete_in_batches(
+                IntentCacheEntry.objects.filter(
+                    updated_at__lt=timezone.now() - timedelta(seconds=INTENT_CACHE_TTL)
+                ),
+                'cleanup_intent_cache',
+                **batches
+            )),
+        ]
 
-        # Clean old sessions
-        old_sessions = ConversationSession.objects.filter(updated_at__lt=cutoff_date)
-        session_count = old_sessions.count()
-        old_sessions.delete()
+        verb = 'Будет удалено' if dry_run else 'Удалено'
+        total = 0
+        start_time = time.time()
+        for label, job in jobs:
+            job_start = time.time()
+            deleted = job()
+            total += deleted
+            self.stdout.write(f'{verb} {deleted} {label}{self.rate(deleted, time.time() - job_start)}')
 
         self.stdout.write(
-            self.style.SUCCESS(
-                f'Удалено {message_count} старых сообщений и {session_count} старых сессий.'
-            )
+            self.style.SUCCESS(f'{verb} всего {total} строк{self.rate(total, time.time() - start_time)}')
         )
 
+    def rate(self, rows, seconds):
+        if not rows:
+            return ''
+        return f' за {seconds:.1f}с ({rows / max(seconds, 0.001):.0f} строк/с)'
+
+    def report_batch(self, batch):
+        if self.verbosity >= 2:
+            self.stdout.write(
+                f'  {batch["name"]}: {batch["deleted"]} строк до id {batch["last_id"]} '
+                f'за {batch["seconds"] * 1000:.0f} мс'
+            )
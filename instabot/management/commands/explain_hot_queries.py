@@ -0,0 +1,123 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models.functions import Mod
+from django.utils import timezone
+from datetime import timedelta
+import random
+import re
+from instabot.models import InstaBotMessage, Purchase
+from instabot.retention import history_cutoff
+
+
+class Command(BaseCommand):
+    help = 'Show query plans of hot bot queries, optionally on temporarily seeded data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Insert this many synthetic messages (and a tenth as many purchases) '
+                 'inside a transaction that is rolled back afterwards (default: 0)',
+        )
+        parser.add_argument(
+            '--senders',
+            type=int,
+            default=1000,
+            help='Distinct senders in seeded data (default: 1000)',
+        )
+        parser.add_argument(
+            '--analyze',
+            action='store_true',
+            help='Run EXPLAIN ANALYZE (executes the queries)',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            sender_id = 'explain-0'
+            if options['seed']:
+                self.seed(options['seed'], options['senders'])
+
+            now = timezone.now()
+            today = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+            queries = [
+                (
+                    'История для AI (generate_ai_response)',
+                    InstaBotMessage.objects.filter(
+                        sender_id=sender_id,
+                        timestamp__gte=history_cutoff()
+                    ).order_by('-timestamp')[:10],
+                ),
+                (
+                    'Недавний заказ (has_recent_purchase)',
+                    Purchase.objects.filter(
+                        sender_id=sender_id,
+                        timestamp__gte=now - timedelta(hours=2)
+                    ),
+                ),
+                (
+                    'Сообщения сегодня (bot_stats)',
+                    InstaBotMessage.objects.filter(timestamp__gte=today),
+                ),
+                (
+                    'Заказы сегодня (bot_stats)',
+                    Purchase.objects.filter(timestamp__gte=today),
+                ),
+                (
+                    'Устаревшая история (cleanup_bot)',
+                    InstaBotMessage.objects.filter(timestamp__lt=history_cutoff()),
+                ),
+            ]
+
+            for title, queryset in queries:
+                self.stdout.write(self.style.SUCCESS(f'\n=== {title} ==='))
+                explain_options = {'analyze': True} if options['analyze'] else {}
+                self.stdout.write(queryset.explain(**explain_options))
+
+                plan = queryset.explain()
+                # PostgreSQL reports "Seq Scan", SQLite a bare "SCAN <table>"
+                if 'Seq Scan' in plan or re.search(r'\bSCAN \w+\s*$', plan, re.MULTILINE):
+                    self.stdout.write(self.style.WARNING('⚠ Последовательное сканирование таблицы'))
+
+            # Never keep seeded rows
+            transaction.set_rollback(True)
+
+    def seed(self, count, senders):
+        now = timezone.now()
+        self.stdout.write(f'Заполнение: {count} сообщений, {count // 10} заказов...')
+
+        InstaBotMessage.objects.bulk_create(
+            [
+                InstaBotMessage(
+                    sender_id=f'explain-{i % senders}',
+                    role=random.choice(['user', 'assistant']),
+                    content='seed',
+                )
+                for i in range(count)
+            ],
+            batch_size=5000,
+        )
+        Purchase.objects.bulk_create(
+            [
+                Purchase(
+                    sender_id=f'explain-{i % senders}',
+                    products_data=[],
+                    phone_number='0555000000',
+                    address='seed',
+                    customer_last_message='seed',
+                    total_amount=1000,
+                )
+                for i in range(count // 10)
+            ],
+            batch_size=5000,
+        )
+
+        # auto_now_add ignores explicit values, spread timestamps over the last 30 days afterwards
+        for model in (InstaBotMessage, Purchase):
+            seeded = model.objects.filter(sender_id__startswith='explain-').annotate(day=Mod('id', 30))
+            for day in range(30):
+                seeded.filter(day=day).update(timestamp=now - timedelta(days=day, minutes=random.randint(0, 1440)))
+
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(f'ANALYZE {model._meta.db_table}')
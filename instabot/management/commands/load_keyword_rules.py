@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from instabot.keywords import DEFAULT_RULES
+from instabot.models import KeywordRule
+
+
+class Command(BaseCommand):
+    help = 'Copy default intent keywords into the KeywordRule table for tuning in admin'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Delete existing rules first',
+        )
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            deleted, _ = KeywordRule.objects.all().delete()
+            self.stdout.write(self.style.WARNING(f'Удалено правил: {deleted}'))
+
+        created_count = 0
+        for intent, keywords in DEFAULT_RULES.items():
+            for keyword in keywords:
+                rule, created = KeywordRule.objects.get_or_create(intent=intent, keyword=keyword)
+                if created:
+                    created_count += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Готово! Создано {created_count} новых правил.')
+        )
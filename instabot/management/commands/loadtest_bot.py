@@ -0,0 +1,217 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from concurrent.futures import ThreadPoolExecutor
+from groq import Groq
+import json
+import threading
+import time
+from instabot import graph_api, views
+from instabot.catalog import get_catalog
+from instabot.dedupe import event_deduplicator
+from instabot.management.commands.loadtest_webhook import percentile
+from instabot.models import ConversationSession, InstaBotMessage, ProcessedEvent, Purchase
+from instabot.stubs import GraphStubServer, MockLLMServer
+
+LOADTEST_SENDER_BASE = 970000000000
+
+# (stage, message) turns of one synthetic customer, {product} is filled from the catalog
+CONVERSATION = [
+    ('browse', 'каталог'),
+    ('select', 'хочу купить'),
+    ('select', '{product} 2 шт'),
+    ('select', 'оформить'),
+    ('phone', '+996 555 123 456'),
+    ('address', 'ул. Киевская 100, кв 5'),
+    ('confirm', 'Подтвердить'),
+    ('ask', 'Когда привезут заказ?'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Replay multi-turn conversations from concurrent senders against the webhook with stubbed AI and Graph APIs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--senders',
+            type=int,
+            default=50,
+            help='Synthetic customers, each runs the whole conversation (default: 50)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=10,
+            help='Conversations in flight at once (default: 10)',
+        )
+        parser.add_argument(
+            '--llm-latency-ms',
+            type=int,
+            default=300,
+            help='Mock LLM delay before the first token (default: 300)',
+        )
+        parser.add_argument(
+            '--token-ms',
+            type=int,
+            default=10,
+            help='Mock LLM delay between tokens (default: 10)',
+        )
+        parser.add_argument(
+            '--llm-fail-every',
+            type=int,
+            default=0,
+            help='Answer every N-th LLM request with 500, 0 disables (default: 0)',
+        )
+        parser.add_argument(
+            '--graph-latency-ms',
+            type=int,
+            default=50,
+            help='Graph API stub latency per call (default: 50)',
+        )
+        parser.add_argument(
+            '--graph-fail-every',
+            type=int,
+            default=0,
+            help='Answer every N-th Graph API call with 429, 0 disables (default: 0)',
+        )
+
+    def handle(self, *args, **options):
+        if not views.is_ai_api_healthy():
+            raise CommandError('Автомат AI API открыт, ответы пойдут в заглушку. Повторите позже')
+
+        products = get_catalog().products
+        if not products:
+            raise CommandError('Нет доступных товаров, выполните setup_bot')
+        product = products[0]
+
+        llm = MockLLMServer(
+            first_token_ms=options['llm_latency_ms'],
+            token_ms=options['token_ms'],
+            fail_every=options['llm_fail_every']
+        ).start()
+        graph = GraphStubServer(
+            latency_ms=options['graph_latency_ms'],
+            fail_every=options['graph_fail_every']
+        ).start()
+
+        original_client = views.client
+        original_graph_url = graph_api.GRAPH_API_URL
+        original_queue_mode = views.WEBHOOK_QUEUE_MODE
+        original_process = views.process_messaging_event
+        # Failed LLM calls should reach the breaker instead of being retried by the client
+        views.client = Groq(api_key='stub', base_url=llm.url, max_retries=0)
+        graph_api.GRAPH_API_URL = graph.url
+        # Replies are measured end to end, the queue would only time the enqueue
+        views.WEBHOOK_QUEUE_MODE = False
+        self.queries = {}
+        self.queries_lock = threading.Lock()
+        views.process_messaging_event = self.counting(original_process)
+
+        sender_ids = [str(LOADTEST_SENDER_BASE + index) for index in range(options['senders'])]
+        self.cleanup(sender_ids)
+
+        self.stdout.write(self.style.SUCCESS('=== НАГРУЗОЧНЫЙ ТЕСТ ДИАЛОГОВ ==='))
+        self.stdout.write(
+            f'Диалогов: {len(sender_ids)}, параллельно: {options["concurrency"]}, '
+            f'сообщений в диалоге: {len(CONVERSATION)}, товар: {product.name}'
+        )
+        self.stdout.write(
+            f'LLM: {options["llm_latency_ms"]} мс + {options["token_ms"]} мс/токен, '
+            f'Graph API: {options["graph_latency_ms"]} мс\n'
+        )
+
+        try:
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                results = list(executor.map(lambda sender_id: self.run_conversation(sender_id, product), sender_ids))
+            elapsed = time.perf_counter() - start_time
+
+            self.report(results, elapsed, sender_ids, llm, graph)
+        finally:
+            views.client = original_client
+            graph_api.GRAPH_API_URL = original_graph_url
+            views.WEBHOOK_QUEUE_MODE = original_queue_mode
+            views.process_messaging_event = original_process
+            llm.stop()
+            graph.stop()
+            self.cleanup(sender_ids)
+
+    def counting(self, process):
+        """Wrap event processing to count the queries it runs on the dispatcher thread"""
+        def process_counted(event):
+            count = [0]
+
+            def counter(execute, sql, params, many, context):
+                count[0] += 1
+                return execute(sql, params, many, context)
+
+            with connection.execute_wrapper(counter):
+                process(event)
+            with self.queries_lock:
+                self.queries[event['message']['mid']] = count[0]
+        return process_counted
+
+    def run_conversation(self, sender_id, product):
+        factory = RequestFactory()
+        turns = []
+        for index, (stage, text) in enumerate(CONVERSATION):
+            mid = f'loadtest-{sender_id}-{index}'
+            body = json.dumps({
+                'entry': [{
+                    'messaging': [{
+                        'sender': {'id': sender_id},
+                        'timestamp': int(time.time() * 1000),
+                        'message': {'mid': mid, 'text': text.format(product=product.name)},
+                    }]
+                }]
+            })
+            request = factory.post('/instabot/webhook/', data=body, content_type='application/json')
+
+            start_time = time.perf_counter()
+            response = views.webhook(request)
+            turns.append((stage, mid, time.perf_counter() - start_time, response.status_code == 200))
+        return turns
+
+    def report(self, results, elapsed, sender_ids, llm, graph):
+        turns = [turn for conversation in results for turn in conversation]
+        errors = sum(1 for stage, mid, latency, ok in turns if not ok)
+        purchases = Purchase.objects.filter(sender_id__in=sender_ids).count()
+
+        self.stdout.write(f'Время: {elapsed:.1f}с')
+        self.stdout.write(
+            f'Пропускная способность: {len(turns) / elapsed:.1f} сообщений/с, '
+            f'{len(results) / elapsed:.2f} диалогов/с'
+        )
+        purchases_style = self.style.SUCCESS if purchases == len(sender_ids) else self.style.ERROR
+        self.stdout.write(purchases_style(f'Оформлено заказов: {purchases} из {len(sender_ids)}'))
+        if errors:
+            self.stdout.write(self.style.ERROR(f'Ошибок webhook: {errors}'))
+
+        self.stdout.write(f'\n{"Этап":<10} | {"сообщ.":>6} | {"p50":>7} | {"p95":>7} | {"p99":>7} | запросов к БД')
+        self.stdout.write('-' * 66)
+        stages = []
+        for stage, text in CONVERSATION:
+            if stage not in stages:
+                stages.append(stage)
+        for stage in stages + [None]:
+            selected = [turn for turn in turns if stage is None or turn[0] == stage]
+            latencies = [latency * 1000 for _, _, latency, _ in selected]
+            queries = [self.queries[mid] for _, mid, _, _ in selected if mid in self.queries]
+            self.stdout.write(
+                f'{stage or "всего":<10} | {len(selected):6} | {percentile(latencies, 50):5.0f}мс | '
+                f'{percentile(latencies, 95):5.0f}мс | {percentile(latencies, 99):5.0f}мс | '
+                f'{sum(queries) / len(queries) if queries else 0:5.1f} '
+                f'(макс. {max(queries) if queries else 0})'
+            )
+
+        self.stdout.write(
+            f'\nLLM запросов: {llm.requests}, вызовов Graph API: {graph.calls}, '
+            f'текстов доставлено: {sum(1 for _, body in graph.received if "message" in body)}'
+        )
+
+    def cleanup(self, sender_ids):
+        InstaBotMessage.objects.filter(sender_id__in=sender_ids).delete()
+        ConversationSession.objects.filter(sender_id__in=sender_ids).delete()
+        Purchase.objects.filter(sender_id__in=sender_ids).delete()
+        ProcessedEvent.objects.filter(key__startswith='loadtest-').delete()
+        event_deduplicator.clear()
@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import time
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = 'Fire concurrent webhook POSTs at running servers to compare the WSGI and ASGI paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            action='append',
+            required=True,
+            help='Webhook URL, can be given several times, e.g. '
+                 'http://127.0.0.1:8000/instabot/webhook/ and http://127.0.0.1:8001/instabot/webhook/async/',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Requests per URL (default: 200)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=50,
+            help='Requests in flight at once (default: 50)',
+        )
+        parser.add_argument(
+            '--senders',
+            type=int,
+            default=50,
+            help='Distinct sender IDs (default: 50)',
+        )
+        parser.add_argument(
+            '--text',
+            type=str,
+            default='Привет! Сколько стоит доставка?',
+            help='Message text to send',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('=== НАГРУЗОЧНЫЙ ТЕСТ WEBHOOK ==='))
+        self.stdout.write(
+            f'Запросов: {options["requests"]}, параллельно: {options["concurrency"]}, '
+            f'отправителей: {options["senders"]}\n'
+        )
+
+        for url in options['url']:
+            latencies, errors, elapsed = self.run(url, options)
+            self.stdout.write(self.style.SUCCESS(url))
+            self.stdout.write(f'  Пропускная способность: {len(latencies) / elapsed:.1f} запросов/с')
+            self.stdout.write(
+                f'  Задержка p50/p95/p99: {percentile(latencies, 50) * 1000:.0f} / '
+                f'{percentile(latencies, 95) * 1000:.0f} / {percentile(latencies, 99) * 1000:.0f} мс'
+            )
+            if errors:
+                self.stdout.write(self.style.ERROR(f'  Ошибок: {errors}'))
+
+    def run(self, url, options):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=options['concurrency'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        def post(i):
+            payload = {
+                'entry': [{
+                    'messaging': [{
+                        'sender': {'id': str(9000000000 + i % options['senders'])},
+                        'message': {'mid': f'loadtest-{time.time_ns()}-{i}', 'text': options['text']},
+                    }]
+                }]
+            }
+            start_time = time.time()
+            try:
+                response = session.post(url, json=payload, timeout=60)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            return time.time() - start_time, ok
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(post, range(options['requests'])))
+        elapsed = time.time() - start_time
+
+        latencies = [latency for latency, ok in results if ok]
+        errors = len(results) - len(latencies)
+        return latencies, errors, elapsed
@@ -0,0 +1,195 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+import logging
+import threading
+import time
+from instabot.catalog import warm_catalog
+from instabot.dispatcher import configure_dispatcher
+from instabot.event_queue import queue_stats, run_worker
+from instabot.graph_api import get_outbox, send_metrics
+from instabot.outbound_queue import outbound_stats, send_due_messages
+from instabot.rate_limit import rate_limiter
+from instabot.retention import purge_expired_messages
+from instabot.session_store import SESSION_CACHE_TTL, session_store
+from instabot.summarizer import summarize_pending
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sends of due replies from the delay queue
+DELAY_QUEUE_INTERVAL = 0.5
+
+
+class Command(BaseCommand):
+    help = (
+        'Run worker pool that processes queued webhook events. '
+        'Messages of one sender are handled in order, so run a single instance per database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of senders processed concurrently (default: 4)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Events claimed from the queue at once (default: 50)',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty (default: 1.0)',
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=int,
+            default=60,
+            help='Seconds between queue statistics reports (default: 60)',
+        )
+        parser.add_argument(
+            '--retention-interval',
+            type=int,
+            default=3600,
+            help='Seconds between expired chat history purges, 0 disables (default: 3600)',
+        )
+        parser.add_argument(
+            '--summary-interval',
+            type=int,
+            default=60,
+            help='Seconds between conversation summary updates, 0 disables (default: 60)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit',
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        dispatcher = configure_dispatcher(workers)
+        # The only process handling messages, with each sender's messages in order
+        session_store.ttl = SESSION_CACHE_TTL
+        warm_catalog()
+        stop_event = threading.Event()
+
+        thread = threading.Thread(
+            target=run_worker,
+            name='bot-worker',
+            args=(stop_event,),
+            kwargs={
+                'batch_size': options['batch_size'],
+                'poll_interval': options['poll_interval'],
+                'drain_only': options['once'],
+            },
+            daemon=True,
+        )
+        thread.start()
+
+        # Each job in its own thread, a slow summary pass or purge does not hold up due replies
+        jobs = [
+            # Replies deferred by the rate limiter
+            self.start_job('delay-queue', DELAY_QUEUE_INTERVAL, send_due_messages, stop_event),
+            self.start_job('stats', options['stats_interval'], self.report_stats, stop_event),
+        ]
+        if options['retention_interval']:
+            jobs.append(self.start_job(
+                'retention', options['retention_interval'], self.purge_history, stop_event, run_first=True
+            ))
+        if options['summary_interval']:
+            # Summaries are refreshed here, never on the reply path
+            jobs.append(self.start_job('summaries', options['summary_interval'], self.update_summaries, stop_event))
+
+        self.stdout.write(self.style.SUCCESS(f'Запущено обработчиков: {workers}'))
+
+        try:
+            while thread.is_alive():
+                thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Остановка обработчиков...'))
+            stop_event.set()
+            thread.join()
+
+        stop_event.set()
+        for job in jobs:
+            job.join()
+        dispatcher.shutdown()
+        get_outbox().shutdown()
+
+        self.report_stats()
+
+    def start_job(self, name, interval, job, stop_event, run_first=False):
+        """Run job every interval seconds in a thread until stop_event is set.
+
+        Errors are logged and the job runs again at the next interval.
+        """
+        def loop():
+            try:
+                if not run_first and stop_event.wait(interval):
+                    return
+                while True:
+                    try:
+                        job()
+                    except Exception:
+                        logger.exception(f"Periodic job {name} failed")
+                    finally:
+                        close_old_connections()
+                    if stop_event.wait(interval):
+                        return
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=loop, name=f'bot-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    def purge_history(self):
+        start_time = time.time()
+        deleted = purge_expired_messages()
+        if deleted:
+            self.stdout.write(f'Удалено {deleted} устаревших сообщений ({time.time() - start_time:.2f}с)')
+
+    def update_summaries(self):
+        updated = summarize_pending()
+        if updated:
+            self.stdout.write(f'Обновлено кратких содержаний диалогов: {updated}')
+
+    def report_stats(self):
+        stats = queue_stats()
+        self.stdout.write(
+            f'Очередь: {stats["pending"]} ожидают, {stats["processing"]} в работе, '
+            f'{stats["failed"]} с ошибкой, старейшее событие {stats["oldest_pending_seconds"]:.1f}с'
+        )
+        if stats['processed']:
+            self.stdout.write(
+                f'За последний час обработано {stats["processed"]}: '
+                f'ожидание {stats["avg_wait_ms"]:.0f} мс (макс. {stats["max_wait_ms"]}), '
+                f'обработка {stats["avg_processing_ms"]:.0f} мс (макс. {stats["max_processing_ms"]})'
+            )
+
+        outbound = outbound_stats()
+        limiter = rate_limiter.stats()
+        if outbound['pending'] or outbound['sent']:
+            self.stdout.write(
+                f'Отложенные ответы: {outbound["pending"]} ожидают '
+                f'(старейший {outbound["oldest_pending_seconds"]:.0f}с), отправлено за час {outbound["sent"]}, '
+                f'лимит {limiter["rate"]:.1f}/с, использование API {limiter["usage"]}%'
+            )
+
+        sends = send_metrics.stats()
+        if sends['calls']:
+            self.stdout.write(
+                f'Graph API: {sends["calls"]} вызовов, ошибок {sends["errors"]}, повторов {sends["retries"]}, '
+                f'объединено сообщений {sends["coalesced"]}, '
+                f'задержка p50 {sends["p50_ms"]:.0f} мс, p95 {sends["p95_ms"]:.0f} мс'
+            )
+
+        sessions = session_store.stats()
+        if sessions['hits'] or sessions['misses']:
+            self.stdout.write(
+                f'Сессии: {sessions["size"]} в кэше, попаданий {sessions["hits"]}, чтений из БД {sessions["misses"]}, '
+                f'записей {sessions["writes"]}, конфликтов версий {sessions["conflicts"]}'
+            )
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from instabot.models import ConversationSession
+from instabot.summarizer import summarize_pending, summarize_session
+
+
+class Command(BaseCommand):
+    help = 'Fold conversation turns that left the prompt window into per-sender summaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=200,
+            help='Maximum number of summaries to update (default: 200)',
+        )
+        parser.add_argument(
+            '--sender',
+            type=str,
+            help='Only summarize the conversation with this sender',
+        )
+
+    def handle(self, *args, **options):
+        if options['sender']:
+            try:
+                session = ConversationSession.objects.get(sender_id=options['sender'])
+            except ConversationSession.DoesNotExist:
+                raise CommandError(f'Сессия {options["sender"]} не найдена')
+
+            if summarize_session(session):
+                session.refresh_from_db()
+                self.stdout.write(self.style.SUCCESS('Краткое содержание обновлено:'))
+                self.stdout.write(session.conversation_summary)
+            else:
+                self.stdout.write(self.style.WARNING('Нет новых сообщений для краткого содержания или AI API недоступен'))
+            return
+
+        updated = summarize_pending(limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS(f'Обновлено кратких содержаний: {updated}'))
@@ -0,0 +1,150 @@
+from django.core.management.base import BaseCommand, CommandError
+from pathlib import Path
+import random
+import time
+from instabot.intent_model import INTENT_MODEL_PATH, INTENT_MODEL_THRESHOLD, IntentModel
+from instabot.keywords import best_intent, score_intents
+from instabot.models import IntentCacheEntry
+
+
+class Command(BaseCommand):
+    help = (
+        'Train local intent classifier on AI-labelled messages the keyword rules do not recognise, '
+        'the only messages it is asked about'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--holdout',
+            type=float,
+            default=0.2,
+            help='Share of samples kept for evaluation (default: 0.2)',
+        )
+        parser.add_argument(
+            '--epochs',
+            type=int,
+            default=15,
+            help='Training epochs (default: 15)',
+        )
+        parser.add_argument(
+            '--min-samples',
+            type=int,
+            default=30,
+            help='Refuse to train on fewer samples (default: 30)',
+        )
+        parser.add_argument(
+            '--output-dir',
+            type=str,
+            default=str(Path(INTENT_MODEL_PATH).parent),
+            help='Directory for model artifacts',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Train and report without saving the model',
+        )
+
+    def handle(self, *args, **options):
+        samples = self.collect_samples()
+        if len(samples) < options['min_samples']:
+            raise CommandError(f'Недостаточно данных для обучения: {len(samples)} примеров')
+
+        labels = {label for text, label in samples}
+        if len(labels) < 2:
+            raise CommandError('Нужны примеры хотя бы двух намерений')
+
+        random.Random(42).shuffle(samples)
+        split = int(len(samples) * (1 - options['holdout']))
+        train, test = samples[:split], samples[split:]
+        if not test:
+            raise CommandError('Проверочная выборка пуста, увеличьте --holdout')
+
+        self.stdout.write(self.style.SUCCESS('=== ОБУЧЕНИЕ КЛАССИФИКАТОРА НАМЕРЕНИЙ ==='))
+        self.stdout.write(f'Примеров: {len(samples)} (обучение {len(train)}, проверка {len(test)})')
+        for label in sorted(labels):
+            self.stdout.write(f'  {label}: {sum(1 for text, sample_label in samples if sample_label == label)}')
+
+        start_time = time.time()
+        model = IntentModel.train(
+            [text for text, label in train],
+            [label for text, label in train],
+            epochs=options['epochs'],
+        )
+        self.stdout.write(f'Время обучения: {time.time() - start_time:.1f}с')
+
+        metrics = self.evaluate(model, test)
+        model.metrics = metrics
+
+        # Final model is trained on all samples
+        final_model = IntentModel.train(
+            [text for text, label in samples],
+            [label for text, label in samples],
+            epochs=options['epochs'],
+        )
+        final_model.metrics = metrics
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('\nПробный запуск: модель не сохранена'))
+            return
+
+        path = final_model.save(options['output_dir'])
+        self.stdout.write(self.style.SUCCESS(f'\nМодель {final_model.version} сохранена: {path}'))
+
+    def collect_samples(self):
+        """AI-labelled texts from the intent cache that the keyword rules miss.
+
+        classify_intent answers keyword matches before the model, training or evaluating on
+        them would teach the rules and inflate the reported accuracy.
+        """
+        samples = []
+        skipped = 0
+        for text, intent in IntentCacheEntry.objects.values_list('text', 'intent').iterator():
+            if best_intent(score_intents(text)):
+                skipped += 1
+            else:
+                samples.append((text, intent))
+
+        if skipped:
+            self.stdout.write(f'Пропущено сообщений, распознаваемых ключевыми словами: {skipped}')
+        return samples
+
+    def evaluate(self, model, test):
+        correct = 0
+        confident = 0
+        confident_correct = 0
+        per_label = {}
+
+        start_time = time.perf_counter()
+        predictions = [model.predict(text) for text, label in test]
+        latency = (time.perf_counter() - start_time) / len(test)
+
+        for (text, label), (predicted, probability) in zip(test, predictions):
+            stats = per_label.setdefault(label, {'total': 0, 'correct': 0})
+            stats['total'] += 1
+            if predicted == label:
+                correct += 1
+                stats['correct'] += 1
+            if probability >= INTENT_MODEL_THRESHOLD:
+                confident += 1
+                if predicted == label:
+                    confident_correct += 1
+
+        metrics = {
+            'samples': len(test),
+            'accuracy': correct / len(test),
+            'coverage': confident / len(test),
+            'confident_accuracy': confident_correct / confident if confident else 0,
+            'threshold': INTENT_MODEL_THRESHOLD,
+            'latency_us': latency * 1000000,
+        }
+
+        self.stdout.write(self.style.SUCCESS('\nКАЧЕСТВО НА ПРОВЕРОЧНОЙ ВЫБОРКЕ:'))
+        self.stdout.write(f'Точность: {metrics["accuracy"]:.1%}')
+        self.stdout.write(
+            f'Уверенных ответов (порог {INTENT_MODEL_THRESHOLD}): {metrics["coverage"]:.1%}, '
+            f'их точность: {metrics["confident_accuracy"]:.1%}'
+        )
+        for label, stats in sorted(per_label.items()):
+            self.stdout.write(f'  {label}: {stats["correct"]}/{stats["total"]}')
+        self.stdout.write(f'Задержка предсказания: {metrics["latency_us"]:.0f} мкс')
+        return metrics
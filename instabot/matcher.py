@@ -0,0 +1,102 @@
+import re
+from collections import deque
+
+QUANTITY_PATTERN = re.compile(r'(\d+)\s*шт')
+
+
+class KeywordMatcher:
+    """Aho–Corasick automaton: finds every occurrence of many keywords in one pass over the text"""
+
+    def __init__(self, keywords):
+        """keywords: iterable of (keyword, value) pairs, a keyword may carry several values"""
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for keyword, value in keywords:
+            if keyword:
+                self._add(keyword, value)
+        self._build_failure_links()
+
+    def _add(self, keyword, value):
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append((len(keyword), value))
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # Inherit matches that end at the same position (suffix keywords)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def iter_matches(self, text):
+        """Yield (start, end, value) for every keyword occurrence, overlapping ones included"""
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in output[node]:
+                yield index + 1 - length, index + 1, value
+
+
+class ProductMatcher:
+    """Finds every product mentioned in a message together with its quantity"""
+
+    def __init__(self, products):
+        self._matcher = KeywordMatcher((product.name.lower(), product) for product in products)
+
+    def find(self, message):
+        """Return list of (product, quantity) in order of appearance"""
+        text = message.lower()
+
+        # Leftmost-longest, non-overlapping: "триммер wahl pro" wins over "триммер wahl"
+        matches = sorted(self._matcher.iter_matches(text), key=lambda match: (match[0], match[0] - match[1]))
+        selected = []
+        last_end = 0
+        for start, end, product in matches:
+            if start >= last_end:
+                selected.append((start, end, product))
+                last_end = end
+
+        # A product mentioned again keeps its first position and the last quantity given for it
+        quantities = {}
+        products = {}
+        consumed = 0
+        for index, (start, end, product) in enumerate(selected):
+            # Quantity is looked up after the name first ("Wahl 2 шт"), then before it ("2 шт Wahl"),
+            # a quantity already taken by the previous product is not counted again
+            next_start = selected[index + 1][0] if index + 1 < len(selected) else len(text)
+            previous_end = max(selected[index - 1][1] if index > 0 else 0, consumed)
+            after = QUANTITY_PATTERN.search(text, end, next_start)
+            before = QUANTITY_PATTERN.findall(text, previous_end, start)
+            if after:
+                quantity = int(after.group(1))
+                consumed = after.end()
+            elif before:
+                quantity = int(before[-1])
+            else:
+                quantity = None
+
+            products.setdefault(product.id, product)
+            if quantity is not None or product.id not in quantities:
+                quantities[product.id] = quantity
+
+        return [(product, quantities[product_id] or 1) for product_id, product in products.items()]
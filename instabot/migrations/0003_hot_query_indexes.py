@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0002_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='instabotmessage',
+            index=models.Index(fields=['sender_id', '-timestamp'], name='instabot_msg_sender_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instabotmessage',
+            index=models.Index(fields=['timestamp'], name='instabot_msg_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['sender_id', 'timestamp'], name='instabot_purchase_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['timestamp'], name='instabot_purchase_ts_idx'),
+        ),
+    ]
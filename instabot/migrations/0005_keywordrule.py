@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0004_intentcacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeywordRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('intent', models.CharField(choices=[('ПОКУПКА', 'Покупка'), ('КАТАЛОГ', 'Каталог'), ('ЖАЛОБА', 'Жалоба'), ('БЛАГОДАРНОСТЬ', 'Благодарность'), ('ДОПОЛНИТЬ', 'Дополнить заказ'), ('ОФОРМЛЕНИЕ', 'Оформление заказа')], max_length=20)),
+                ('keyword', models.CharField(max_length=100)),
+                ('weight', models.FloatField(default=1.0)),
+                ('active', models.BooleanField(default=True)),
+            ],
+            options={
+                'unique_together': {('intent', 'keyword')},
+            },
+        ),
+    ]
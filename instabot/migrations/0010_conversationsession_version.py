@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0009_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsession',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
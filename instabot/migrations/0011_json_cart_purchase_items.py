@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """New JSON columns next to the text ones, filled by 0012 and swapped in by 0013"""
+
+    dependencies = [
+        ('instabot', '0010_conversationsession_version'),
+    ]
+
+    operations = [
+        # Lets 0013 be reversed on rows created after the swap
+        migrations.AlterField(
+            model_name='purchase',
+            name='products_data',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.AddField(
+            model_name='conversationsession',
+            name='selected_products_json',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='purchase',
+            name='products_data_json',
+            field=models.JSONField(default=list),
+        ),
+        migrations.CreateModel(
+            name='PurchaseItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=255)),
+                ('quantity', models.PositiveIntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('subtotal', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='purchase_items', to='instabot.product')),
+                ('purchase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='instabot.purchase')),
+            ],
+        ),
+    ]
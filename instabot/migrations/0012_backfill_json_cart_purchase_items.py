@@ -0,0 +1,103 @@
+import json
+import logging
+from decimal import Decimal
+
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000
+
+
+def parse(text, default):
+    if not text:
+        return default
+    try:
+        return json.loads(text)
+    except ValueError:
+        logger.warning(f"Unparseable JSON left empty: {text[:100]}")
+        return default
+
+
+def purchase_items(PurchaseItem, purchase_id, products_data, product_ids):
+    items = []
+    for line in products_data:
+        quantity = int(line.get('quantity') or 1)
+        price = Decimal(str(line.get('price') or 0))
+        product_id = line.get('product_id')
+        items.append(PurchaseItem(
+            purchase_id=purchase_id,
+            product_id=product_id if product_id in product_ids else None,
+            product_name=line.get('product_name') or '',
+            quantity=quantity,
+            price=price,
+            subtotal=Decimal(str(line['subtotal'])) if line.get('subtotal') is not None else price * quantity,
+        ))
+    return items
+
+
+def forwards(apps, schema_editor):
+    ConversationSession = apps.get_model('instabot', 'ConversationSession')
+    Purchase = apps.get_model('instabot', 'Purchase')
+    PurchaseItem = apps.get_model('instabot', 'PurchaseItem')
+    Product = apps.get_model('instabot', 'Product')
+
+    batch = []
+    sessions = ConversationSession.objects.exclude(selected_products__isnull=True).exclude(selected_products='')
+    for session in sessions.only('id', 'selected_products').iterator(chunk_size=BATCH_SIZE):
+        session.selected_products_json = parse(session.selected_products, None)
+        batch.append(session)
+        if len(batch) >= BATCH_SIZE:
+            ConversationSession.objects.bulk_update(batch, ['selected_products_json'])
+            batch = []
+    ConversationSession.objects.bulk_update(batch, ['selected_products_json'])
+
+    product_ids = set(Product.objects.values_list('id', flat=True))
+    batch = []
+    items = []
+    for purchase in Purchase.objects.only('id', 'products_data').iterator(chunk_size=BATCH_SIZE):
+        purchase.products_data_json = parse(purchase.products_data, [])
+        batch.append(purchase)
+        items += purchase_items(PurchaseItem, purchase.id, purchase.products_data_json, product_ids)
+        if len(batch) >= BATCH_SIZE:
+            Purchase.objects.bulk_update(batch, ['products_data_json'])
+            PurchaseItem.objects.bulk_create(items, batch_size=BATCH_SIZE)
+            batch = []
+            items = []
+    Purchase.objects.bulk_update(batch, ['products_data_json'])
+    PurchaseItem.objects.bulk_create(items, batch_size=BATCH_SIZE)
+
+
+def backwards(apps, schema_editor):
+    ConversationSession = apps.get_model('instabot', 'ConversationSession')
+    Purchase = apps.get_model('instabot', 'Purchase')
+
+    batch = []
+    for session in ConversationSession.objects.only('id', 'selected_products_json').iterator(chunk_size=BATCH_SIZE):
+        if session.selected_products_json is not None:
+            session.selected_products = json.dumps(session.selected_products_json)
+            batch.append(session)
+        if len(batch) >= BATCH_SIZE:
+            ConversationSession.objects.bulk_update(batch, ['selected_products'])
+            batch = []
+    ConversationSession.objects.bulk_update(batch, ['selected_products'])
+
+    batch = []
+    for purchase in Purchase.objects.only('id', 'products_data_json').iterator(chunk_size=BATCH_SIZE):
+        purchase.products_data = json.dumps(purchase.products_data_json or [], ensure_ascii=False)
+        batch.append(purchase)
+        if len(batch) >= BATCH_SIZE:
+            Purchase.objects.bulk_update(batch, ['products_data'])
+            batch = []
+    Purchase.objects.bulk_update(batch, ['products_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0011_json_cart_purchase_items'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0012_backfill_json_cart_purchase_items'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='conversationsession',
+            name='selected_products',
+        ),
+        migrations.RenameField(
+            model_name='conversationsession',
+            old_name='selected_products_json',
+            new_name='selected_products',
+        ),
+        migrations.RemoveField(
+            model_name='purchase',
+            name='products_data',
+        ),
+        migrations.RenameField(
+            model_name='purchase',
+            old_name='products_data_json',
+            new_name='products_data',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0015_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='circuitbreakerstate',
+            name='probe_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0016_circuitbreakerstate_probe_started_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboundmessage',
+            index=models.Index(fields=['recipient_id', 'status'], name='instabot_outbound_recip_idx'),
+        ),
+    ]
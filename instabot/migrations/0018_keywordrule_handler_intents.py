@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+# Keyword lists of the post-purchase and browsing handlers before they shared the idle vocabulary
+HANDLER_RULES = {
+    'ДОПОЛНИТЬ': ['купить', 'заказать', 'еще', 'также', 'тоже'],
+    'ПОКАЗАТЬ_КАТАЛОГ': ['каталог', 'товары', 'что есть'],
+    'ВЫБРАТЬ': ['купить', 'заказать', 'хочу', 'возьму'],
+}
+
+
+def add_handler_rules(apps, schema_editor):
+    """Tables filled by load_keyword_rules get the new vocabularies, empty tables keep the defaults"""
+    KeywordRule = apps.get_model('instabot', 'KeywordRule')
+    if not KeywordRule.objects.exists():
+        return
+
+    KeywordRule.objects.filter(intent='ДОПОЛНИТЬ', keyword='ещё').delete()
+    for intent, keywords in HANDLER_RULES.items():
+        for keyword in keywords:
+            KeywordRule.objects.get_or_create(intent=intent, keyword=keyword)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0017_outboundmessage_recipient_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='keywordrule',
+            name='intent',
+            field=models.CharField(choices=[('ПОКУПКА', 'Покупка'), ('КАТАЛОГ', 'Каталог'), ('ЖАЛОБА', 'Жалоба'), ('БЛАГОДАРНОСТЬ', 'Благодарность'), ('ДОПОЛНИТЬ', 'Дополнить заказ'), ('ПОКАЗАТЬ_КАТАЛОГ', 'Каталог после заказа'), ('ВЫБРАТЬ', 'Покупка из каталога'), ('ОФОРМЛЕНИЕ', 'Оформление заказа')], max_length=20),
+        ),
+        migrations.RunPython(add_handler_rules, migrations.RunPython.noop),
+    ]
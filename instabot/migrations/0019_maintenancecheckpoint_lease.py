@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instabot', '0018_keywordrule_handler_intents'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='maintenancecheckpoint',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='maintenancecheckpoint',
+            name='owner',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
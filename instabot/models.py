@@ -1,5 +1,6 @@
 from django.db import models
 from django.utils import timezone
+import copy
 import json
 
 
@@ -9,6 +10,32 @@ class InstaBotMessage(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Recent history of a sender for AI context
+            models.Index(fields=['sender_id', '-timestamp'], name='instabot_msg_sender_ts_idx'),
+            # Retention purge and daily statistics
+            models.Index(fields=['timestamp'], name='instabot_msg_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.timestamp} - {self.sender_id} ({self.role}: {self.content[:50]}'
+
+
+class ArchivedMessage(models.Model):
+    """Chat history moved out of InstaBotMessage by archive.MessageArchive, never read by the bot"""
+    message_id = models.BigIntegerField(unique=True)  # id in InstaBotMessage
+    sender_id = models.CharField(max_length=64)
+    role = models.CharField(max_length=10, choices=[('user', 'User'), ('assistant', 'Assistant')])
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender_id', 'timestamp'], name='instabot_archived_sender_idx'),
+        ]
+
     def __str__(self):
         return f'{self.timestamp} - {self.sender_id} ({self.role}: {self.content[:50]}'
 
@@ -43,21 +70,55 @@ class ConversationSession(models.Model):
 
     sender_id = models.CharField(max_length=64, unique=True)
     current_state = models.CharField(max_length=50, choices=STATES, default='idle')
-    selected_products = models.TextField(blank=True, null=True)  # JSON field for multiple products
+    selected_products = models.JSONField(blank=True, null=True)  # [{'product_id', 'quantity'}]
     collected_phone = models.CharField(max_length=20, blank=True, null=True)
     collected_address = models.TextField(blank=True, null=True)
+    conversation_summary = models.TextField(blank=True, null=True)  # Rolling summary of turns older than the prompt window
+    summarized_until = models.DateTimeField(blank=True, null=True)  # Timestamp of the last message in the summary
+    version = models.PositiveIntegerField(default=0)  # Bumped on every write, guards cached copies
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Fields changed by the conversation flow, written back by the session store
+    TRACKED_FIELDS = ('current_state', 'selected_products', 'collected_phone', 'collected_address')
+
+    # Set on sessions handed out by the session store, which writes them once per message
+    write_behind = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.mark_clean()
+        return instance
+
+    def mark_clean(self):
+        """Remember tracked field values as stored in the database"""
+        # Copied, the cart list is changed in place
+        self._stored = {name: copy.deepcopy(self.__dict__.get(name)) for name in self.TRACKED_FIELDS}
+
+    def get_dirty_fields(self):
+        """Tracked fields changed since the session was loaded or last written"""
+        stored = getattr(self, '_stored', {})
+        return [
+            name for name in self.TRACKED_FIELDS
+            if name not in stored or self.__dict__.get(name) != stored[name]
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.write_behind:
+            return
+        self.version += 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = [*kwargs['update_fields'], 'version']
+        super().save(*args, **kwargs)
+        self.mark_clean()
+
     def get_selected_products(self):
         """Return list of selected products with quantities"""
-        if self.selected_products:
-            return json.loads(self.selected_products)
-        return []
+        return self.selected_products or []
 
     def set_selected_products(self, products_list):
-        """Set selected products as JSON"""
-        self.selected_products = json.dumps(products_list)
+        self.selected_products = products_list
 
     def add_product(self, product_id, quantity=1):
         """Add product to cart or increase quantity"""
@@ -82,17 +143,9 @@ class ConversationSession(models.Model):
 
     def get_total_price(self):
         """Calculate total price of all selected products"""
-        total = 0
-        products = self.get_selected_products()
+        from .cart import price_cart
 
-        for item in products:
-            try:
-                product = Product.objects.get(id=item['product_id'])
-                total += product.price * item['quantity']
-            except Product.DoesNotExist:
-                continue
-
-        return total
+        return price_cart(self.get_selected_products()).total
 
     def clear_cart(self):
         """Clear all selected products"""
@@ -112,25 +165,214 @@ class ConversationSession(models.Model):
 
 class Purchase(models.Model):
     sender_id = models.CharField(max_length=64)
-    products_data = models.TextField()  # JSON field with products and quantities
+    products_data = models.JSONField(default=list)  # Order lines as shown to the customer, see also items
     phone_number = models.CharField(max_length=20)
     address = models.TextField()
     customer_last_message = models.TextField()
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # has_recent_purchase
+            models.Index(fields=['sender_id', 'timestamp'], name='instabot_purchase_sender_idx'),
+            # Daily statistics
+            models.Index(fields=['timestamp'], name='instabot_purchase_ts_idx'),
+        ]
+
     def get_products_data(self):
         """Return products data as list"""
-        return json.loads(self.products_data)
+        return self.products_data or []
 
     def set_products_data(self, products_list):
-        """Set products data as JSON"""
-        self.products_data = json.dumps(products_list, ensure_ascii=False)
+        self.products_data = products_list
 
     def __str__(self):
         return f"Заказ {self.id} - {self.sender_id} - {self.total_amount} сом"
 
 
+class PurchaseItem(models.Model):
+    """Order line, lets sales per product be aggregated in SQL"""
+    purchase = models.ForeignKey(Purchase, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, blank=True, null=True, related_name='purchase_items')
+    product_name = models.CharField(max_length=255)  # Name at the time of the order
+    quantity = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2)
+
+    def __str__(self):
+        return f"{self.product_name} x{self.quantity}"
+
+
+class WebhookEvent(models.Model):
+    STATUSES = (
+        ('pending', 'В очереди'),
+        ('processing', 'Обрабатывается'),
+        ('done', 'Обработано'),
+        ('failed', 'Ошибка'),
+    )
+
+    payload = models.TextField()  # Raw webhook POST body
+    status = models.CharField(max_length=20, choices=STATUSES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    wait_ms = models.PositiveIntegerField(blank=True, null=True)  # Time spent in the queue
+    processing_ms = models.PositiveIntegerField(blank=True, null=True)  # Time spent in the worker
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='instabot_webhook_status_idx'),
+        ]
+
+    def get_payload(self):
+        """Return decoded webhook payload"""
+        return json.loads(self.payload)
+
+    def __str__(self):
+        return f"Событие {self.id} - {self.status}"
+
+
+class IntentCacheEntry(models.Model):
+    key = models.CharField(max_length=64, unique=True)  # sha256 of normalised message
+    text = models.TextField()  # Normalised message
+    intent = models.CharField(max_length=20)
+    hits = models.PositiveIntegerField(default=0)
+    misses = models.PositiveIntegerField(default=0)  # AI classifications stored for this text
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.text[:50]} - {self.intent}"
+
+
+class KeywordRule(models.Model):
+    INTENTS = (
+        ('ПОКУПКА', 'Покупка'),
+        ('КАТАЛОГ', 'Каталог'),
+        ('ЖАЛОБА', 'Жалоба'),
+        ('БЛАГОДАРНОСТЬ', 'Благодарность'),
+        ('ДОПОЛНИТЬ', 'Дополнить заказ'),
+        ('ПОКАЗАТЬ_КАТАЛОГ', 'Каталог после заказа'),
+        ('ВЫБРАТЬ', 'Покупка из каталога'),
+        ('ОФОРМЛЕНИЕ', 'Оформление заказа'),
+    )
+
+    intent = models.CharField(max_length=20, choices=INTENTS)
+    keyword = models.CharField(max_length=100)  # Matched as a substring of the lowercased message
+    weight = models.FloatField(default=1.0)
+    active = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = ('intent', 'keyword')
+
+    def __str__(self):
+        return f"{self.intent}: {self.keyword}"
+
+
+class CircuitBreakerState(models.Model):
+    STATES = (
+        ('closed', 'Closed'),
+        ('open', 'Open'),
+        ('half_open', 'Half-open'),
+    )
+
+    name = models.CharField(max_length=50, unique=True)
+    state = models.CharField(max_length=20, choices=STATES, default='closed')
+    failure_count = models.PositiveIntegerField(default=0)  # Consecutive failures
+    opened_at = models.DateTimeField(null=True, blank=True)
+    probe_started_at = models.DateTimeField(null=True, blank=True)  # Last half-open probe
+    last_success_at = models.DateTimeField(null=True, blank=True)
+    last_failure_at = models.DateTimeField(null=True, blank=True)
+    short_circuited = models.PositiveBigIntegerField(default=0)  # Requests sent to fallback while open
+    total_open_seconds = models.FloatField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.name} - {self.state}"
+
+
+class OutboundMessage(models.Model):
+    STATUSES = (
+        ('pending', 'Ожидает отправки'),
+        ('sending', 'Отправляется'),
+        ('sent', 'Отправлено'),
+        ('failed', 'Ошибка'),
+    )
+
+    recipient_id = models.CharField(max_length=255)
+    text = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUSES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    wait_ms = models.PositiveIntegerField(blank=True, null=True)  # Delay caused by rate limiting
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='instabot_outbound_due_idx'),
+            # Deferred replies a new reply to the recipient has to wait for
+            models.Index(fields=['recipient_id', 'status'], name='instabot_outbound_recip_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient_id} - {self.status}"
+
+
+class ProcessedEvent(models.Model):
+    key = models.CharField(max_length=255, unique=True)  # Message mid, or sender and timestamp
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+class MaintenanceCheckpoint(models.Model):
+    """Progress of a batch job over a table, lets it resume where it stopped"""
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)  # Last processed primary key
+    owner = models.CharField(max_length=32, blank=True, default='')  # Run holding the checkpoint
+    locked_until = models.DateTimeField(blank=True, null=True)  # Lease of the owner, renewed every batch
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+class DailyStat(models.Model):
+    """Per-day totals, added to incrementally by rollups.rollup_daily_stats"""
+    day = models.DateField(unique=True)
+    messages = models.PositiveIntegerField(default=0)
+    new_sessions = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.day}: {self.orders} заказов, {self.revenue} сом"
+
+
+class DailyProductStat(models.Model):
+    """Per-day sales of one product, keyed by the name on the order lines"""
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, blank=True, null=True, related_name='daily_stats')
+    product_name = models.CharField(max_length=255)
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product_name'], name='instabot_daily_product_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.day}: {self.product_name} x{self.quantity}"
+
+
 # Keep your existing Customer model for backward compatibility
 class Customer(models.Model):
     sender_id = models.CharField(max_length=255)
@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from decouple import config
+from django.db import close_old_connections, transaction
+from django.db.models import Avg, Count, Max, Min, Q
+from django.utils import timezone
+
+from .graph_api import RateLimited, send_text, send_typing
+from .models import OutboundMessage
+from .rate_limit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Longer waits for a send token go to the delay queue instead of blocking a sender thread
+OUTBOUND_MAX_INLINE_WAIT = config('OUTBOUND_MAX_INLINE_WAIT', default=2.0, cast=float)
+OUTBOUND_MAX_ATTEMPTS = config('OUTBOUND_MAX_ATTEMPTS', default=5, cast=int)
+# Messages stuck in 'sending' longer than this are picked up again
+OUTBOUND_VISIBILITY_TIMEOUT = 300
+# Seconds between delay queue checks made by senders, see drain_due_messages
+OUTBOUND_DRAIN_INTERVAL = 10
+
+_drain_lock = threading.Lock()
+_last_drain = 0
+
+
+def deliver(text, recipient_id):
+    """Send text once the rate limiter allows it, defer it to the delay queue when throttled.
+
+    Runs on the outbox send threads, stale database connections are closed around it as the
+    dispatcher does per event.
+    """
+    close_old_connections()
+    try:
+        return send_or_defer(text, recipient_id)
+    finally:
+        close_old_connections()
+
+
+def send_or_defer(text, recipient_id):
+    waiting = waiting_delay(recipient_id)
+    if waiting is not None:
+        # Older deferred replies of the recipient go first, also once the hold has expired
+        result = defer_or_wait(recipient_id, text, waiting)
+        if not waiting:
+            send_due_messages(recipient_id=recipient_id)
+        return result
+
+    delay = rate_limiter.acquire(recipient_id)
+    while delay:
+        if delay > OUTBOUND_MAX_INLINE_WAIT:
+            return defer_or_wait(recipient_id, text, delay)
+        time.sleep(delay)
+        delay = rate_limiter.acquire(recipient_id)
+
+    try:
+        result = send_text(text, recipient_id)
+    except RateLimited as e:
+        logger.warning(f"{str(e)}, deferring message to {recipient_id} by {e.retry_after}s")
+        rate_limiter.block(e.retry_after)
+        return defer_or_wait(recipient_id, text, e.retry_after, error=str(e))
+
+    drain_due_messages()
+    return result
+
+
+def deliver_typing(recipient_id):
+    """Send a typing indicator when the rate limiter allows it right away, it is not worth a wait"""
+    delay = rate_limiter.acquire(recipient_id)
+    if delay:
+        return {"skipped": f"rate limited for {delay:.1f}s"}
+
+    try:
+        return send_typing(recipient_id)
+    except RateLimited as e:
+        rate_limiter.block(e.retry_after)
+        return {"error": str(e)}
+
+
+def waiting_delay(recipient_id):
+    """Seconds until the last delay queue message of recipient_id is due, None if it has none"""
+    try:
+        waiting = OutboundMessage.objects.filter(
+            recipient_id=recipient_id,
+            status__in=['pending', 'sending']
+        ).aggregate(count=Count('id'), due=Max('next_attempt_at', filter=Q(status='pending')))
+    except Exception as e:
+        logger.error(f"Error checking delay queue for {recipient_id}: {str(e)}")
+        return None
+
+    if not waiting['count']:
+        return None
+    if waiting['due'] is None:
+        # Only messages being sent right now
+        return 0
+    return max(0, (waiting['due'] - timezone.now()).total_seconds())
+
+
+def defer_or_wait(recipient_id, text, delay, error=None):
+    """Defer the message, or wait and send it from this thread when the delay queue fails"""
+    try:
+        return defer_message(recipient_id, text, delay, error=error)
+    except Exception as e:
+        logger.error(f"Error deferring message to {recipient_id}, sending in {delay:.0f}s: {str(e)}")
+        time.sleep(delay)
+        return send_text(text, recipient_id)
+
+
+def drain_due_messages():
+    """Send due messages of the delay queue at most every OUTBOUND_DRAIN_INTERVAL seconds.
+
+    Called by senders after a successful send, so deferred replies also go out in deployments
+    that run only the webhook and no run_bot_workers. Returns number sent.
+    """
+    global _last_drain
+
+    if time.time() - _last_drain < OUTBOUND_DRAIN_INTERVAL or not _drain_lock.acquire(blocking=False):
+        return 0
+    try:
+        _last_drain = time.time()
+        return send_due_messages(limit=10)
+    except Exception as e:
+        logger.error(f"Error draining delay queue: {str(e)}")
+        return 0
+    finally:
+        _drain_lock.release()
+
+
+def defer_message(recipient_id, text, delay, error=None):
+    """Store message in the delay queue, sent when due by run_bot_workers or drain_due_messages"""
+    message = OutboundMessage.objects.create(
+        recipient_id=recipient_id,
+        text=text,
+        next_attempt_at=timezone.now() + timedelta(seconds=delay),
+        last_error=error
+    )
+    rate_limiter.hold(recipient_id, delay)
+    return {"deferred": message.id}
+
+
+def claim_due_messages(limit=50, recipient_id=None):
+    """Lock due messages, of recipient_id only if given, and mark them as sending"""
+    now = timezone.now()
+
+    with transaction.atomic():
+        due = OutboundMessage.objects.filter(
+            Q(status='pending') | Q(status='sending'),
+            next_attempt_at__lte=now
+        )
+        if recipient_id is not None:
+            due = due.filter(recipient_id=recipient_id)
+        messages = list(due.select_for_update(skip_locked=True).order_by('id')[:limit])
+        if not messages:
+            return []
+
+        # A sender that dies leaves the rows in 'sending' until the visibility timeout
+        OutboundMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            status='sending',
+            next_attempt_at=now + timedelta(seconds=OUTBOUND_VISIBILITY_TIMEOUT)
+        )
+    return messages
+
+
+def reschedule(message, delay, error=None):
+    message.status = 'pending'
+    message.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    if error is not None:
+        message.last_error = error
+    message.save(update_fields=['status', 'next_attempt_at', 'last_error', 'attempts'])
+
+
+def send_due_messages(limit=50, recipient_id=None):
+    """Send due messages from the delay queue in order, returns number sent"""
+    messages = claim_due_messages(limit, recipient_id)
+    waiting = {}  # recipient_id -> delay, later messages of the recipient wait as well
+    sent = 0
+
+    for message in messages:
+        recipient_id = message.recipient_id
+        delay = waiting.get(recipient_id) or rate_limiter.acquire(recipient_id, queued=True)
+        if delay:
+            waiting[recipient_id] = delay
+            reschedule(message, delay)
+            continue
+
+        message.attempts += 1
+        try:
+            send_text(message.text, recipient_id)
+        except RateLimited as e:
+            rate_limiter.block(e.retry_after)
+            waiting[recipient_id] = e.retry_after
+            reschedule(message, e.retry_after, error=str(e))
+            continue
+        except Exception as e:
+            logger.error(f"Error sending queued message {message.id} to {recipient_id}: {str(e)}")
+            if message.attempts >= OUTBOUND_MAX_ATTEMPTS:
+                message.status = 'failed'
+                message.last_error = str(e)
+                message.save(update_fields=['status', 'last_error', 'attempts'])
+            else:
+                waiting[recipient_id] = 10 * 2 ** message.attempts
+                reschedule(message, waiting[recipient_id], error=str(e))
+            continue
+
+        message.status = 'sent'
+        message.sent_at = timezone.now()
+        message.wait_ms = int((message.sent_at - message.created_at).total_seconds() * 1000)
+        message.save(update_fields=['status', 'sent_at', 'wait_ms', 'attempts'])
+        sent += 1
+
+    return sent
+
+
+def outbound_stats(window_minutes=60):
+    """Return delay queue depth and wait figures for recently sent messages"""
+    now = timezone.now()
+    waiting = OutboundMessage.objects.filter(status__in=['pending', 'sending'])
+    oldest = waiting.aggregate(oldest=Min('created_at'))['oldest']
+
+    recent = OutboundMessage.objects.filter(
+        status='sent',
+        sent_at__gte=now - timedelta(minutes=window_minutes)
+    ).aggregate(
+        sent=Count('id'),
+        avg_wait_ms=Avg('wait_ms'),
+        max_wait_ms=Max('wait_ms'),
+    )
+
+    return {
+        'pending': waiting.count(),
+        'failed': OutboundMessage.objects.filter(status='failed').count(),
+        'oldest_pending_seconds': (now - oldest).total_seconds() if oldest else 0,
+        **recent,
+    }
@@ -0,0 +1,173 @@
+import logging
+import math
+import threading
+
+from decouple import config
+
+from .catalog import get_catalog
+from .models import InstaBotMessage
+from .retention import history_cutoff
+
+logger = logging.getLogger(__name__)
+
+# Estimated prompt tokens allowed per AI call, history and catalog are trimmed to fit
+PROMPT_TOKEN_BUDGET = config('PROMPT_TOKEN_BUDGET', default=1500, cast=int)
+PROMPT_HISTORY_TURNS = config('PROMPT_HISTORY_TURNS', default=5, cast=int)
+# Mixed Russian/English text averages about three characters per token
+CHARS_PER_TOKEN = 3
+# Role and separator tokens added per chat message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+CATALOG_STATES = ['browsing', 'purchase_product_selection', 'post_purchase']
+
+STATE_PROMPTS = {
+    'idle': """Ты — вежливый помощник магазина триммеров и товаров для парикмахеров в Бишкеке.
+Отвечай кратко и по делу. Доставка по Бишкеку бесплатная.
+Предложи посмотреть каталог или помоги с вопросами. Если клиент недавно сделал заказ,
+поблагодари его и предложи дополнительную помощь.""",
+
+    'browsing': """Ты показываешь каталог товаров. Предоставь информацию о доступных товарах
+из базы данных. Помоги клиенту выбрать товар и добавить в корзину.""",
+
+    'purchase_product_selection': """Клиент добавляет товары в корзину. Помоги выбрать товары,
+показывай цены и наличие. После выбора товаров предложи оформить заказ.""",
+
+    'purchase_collecting_phone': """Собери номер телефона клиента для заказа.
+Объясни, что номер нужен для связи по доставке. Проверь, что номер введен корректно.""",
+
+    'purchase_collecting_address': """Собери адрес доставки. Уточни точный адрес в Бишкеке
+для бесплатной доставки.""",
+
+    'purchase_confirmation': """Покажи итоговую информацию о заказе: товары, количество,
+общую сумму, адрес доставки. Попроси подтвердить заказ словом 'Подтвердить'.""",
+
+    'complaint': """Обрабатывай жалобу клиента вежливо и профессионально.
+Извинись и предложи решение проблемы.""",
+
+    'inquiry': """Отвечай на общие вопросы о товарах, доставке, оплате.
+Будь информативным но кратким.""",
+
+    'post_purchase': """Клиент только что сделал заказ. Отвечай дружелюбно,
+предлагай дополнительную помощь или товары. Напомни о возможности связаться при необходимости."""
+}
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+
+def get_state_prompt(state):
+    return STATE_PROMPTS.get(state, STATE_PROMPTS['idle'])
+
+
+def render_catalog_summary(products):
+    """Names and prices only, used when the full catalog does not fit the budget"""
+    if not products:
+        return "К сожалению, товаров нет в наличии."
+    lines = [f"- {product.name}: {product.price} сом" for product in products]
+    lines.append("Доставка по Бишкеку бесплатная.")
+    return "\n".join(lines)
+
+
+_lock = threading.Lock()
+_catalog_messages = {}  # (catalog version, summarized) -> system message
+
+
+def get_catalog_message(summarized=False):
+    """Catalog system message, rendered once per catalog version"""
+    catalog = get_catalog()
+    key = (catalog.version, catalog.built_at, summarized)
+
+    message = _catalog_messages.get(key)
+    if message is None:
+        text = render_catalog_summary(catalog.products) if summarized else catalog.text
+        message = {"role": "system", "content": f"Доступные товары:\n{text}"}
+        with _lock:
+            # Older versions are never asked for again
+            for stale_key in [stale for stale in _catalog_messages if stale[:2] != key[:2]]:
+                del _catalog_messages[stale_key]
+            _catalog_messages[key] = message
+    return message
+
+
+class Prompt:
+    def __init__(self, messages, tokens, history_turns, dropped_turns, catalog_mode):
+        self.messages = messages
+        self.tokens = tokens
+        self.history_turns = history_turns
+        self.dropped_turns = dropped_turns
+        self.catalog_mode = catalog_mode
+
+
+def fetch_history(sender_id, turns=PROMPT_HISTORY_TURNS):
+    """Last turns of the conversation, oldest first"""
+    rows = InstaBotMessage.objects.filter(
+        sender_id=sender_id,
+        timestamp__gte=history_cutoff()
+    ).order_by('-timestamp').values_list('role', 'content')[:turns]
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+
+def build_prompt(session, cart_text=None, budget=PROMPT_TOKEN_BUDGET):
+    """Assemble system prompt, catalog and history within the token budget.
+
+    Earlier turns come from the rolling conversation summary. Over budget the catalog is first
+    reduced to names and prices, then the oldest turns are dropped; the latest turn is always kept.
+    """
+    system_prompt = get_state_prompt(session.current_state)
+    if cart_text:
+        system_prompt += f"\nТекущая корзина клиента: {cart_text}"
+    system_message = {"role": "system", "content": system_prompt}
+
+    # Turns older than the history window, kept short by the summarizer
+    summary_message = None
+    if session.conversation_summary:
+        summary_message = {
+            "role": "system",
+            "content": f"Краткое содержание предыдущего разговора:\n{session.conversation_summary}"
+        }
+
+    catalog_mode = None
+    catalog_message = None
+    if session.current_state in CATALOG_STATES:
+        catalog_mode = 'full'
+        catalog_message = get_catalog_message()
+
+    history = fetch_history(session.sender_id)
+    history_tokens = [message_tokens(message) for message in history]
+
+    def total():
+        return (
+            message_tokens(system_message)
+            + (message_tokens(summary_message) if summary_message else 0)
+            + (message_tokens(catalog_message) if catalog_message else 0)
+            + sum(history_tokens)
+        )
+
+    if total() > budget and catalog_message is not None:
+        catalog_mode = 'summary'
+        catalog_message = get_catalog_message(summarized=True)
+
+    dropped = 0
+    while total() > budget and len(history) > 1:
+        history.pop(0)
+        history_tokens.pop(0)
+        dropped += 1
+
+    messages = [system_message]
+    if summary_message is not None:
+        messages.append(summary_message)
+    if catalog_message is not None:
+        messages.append(catalog_message)
+    messages += history
+
+    prompt = Prompt(messages, total(), len(history), dropped, catalog_mode)
+    logger.info(
+        f"Prompt for {session.sender_id} ({session.current_state}): ~{prompt.tokens} tokens, "
+        f"{prompt.history_turns} turns (dropped {dropped}), catalog {catalog_mode or '-'}"
+    )
+    return prompt
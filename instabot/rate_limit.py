@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+# Sends per second across all recipients, adapted down from the Graph API usage headers
+OUTBOUND_RATE = config('OUTBOUND_RATE', default=20, cast=float)
+OUTBOUND_BURST = config('OUTBOUND_BURST', default=40, cast=int)
+OUTBOUND_RECIPIENT_RATE = config('OUTBOUND_RECIPIENT_RATE', default=1, cast=float)
+OUTBOUND_RECIPIENT_BURST = config('OUTBOUND_RECIPIENT_BURST', default=5, cast=int)
+# Usage percentage from which the send rate is reduced
+OUTBOUND_THROTTLE_FROM = 75
+OUTBOUND_MIN_RATE_FACTOR = 0.05
+MAX_RECIPIENT_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def take(self):
+        self.tokens -= 1
+
+
+def parse_usage(headers):
+    """Highest usage percentage and seconds until access is regained from Graph API usage headers"""
+    usage = 0
+    regain_seconds = 0
+
+    app_usage = headers.get('X-App-Usage')
+    if app_usage:
+        try:
+            usage = max([usage] + [value for value in json.loads(app_usage).values() if isinstance(value, (int, float))])
+        except (ValueError, AttributeError):
+            logger.warning(f"Unparseable X-App-Usage header: {app_usage}")
+
+    business_usage = headers.get('X-Business-Use-Case-Usage')
+    if business_usage:
+        try:
+            for entries in json.loads(business_usage).values():
+                for entry in entries:
+                    usage = max(usage, entry.get('call_count', 0), entry.get('total_cputime', 0), entry.get('total_time', 0))
+                    regain_seconds = max(regain_seconds, entry.get('estimated_time_to_regain_access', 0) * 60)
+        except (ValueError, AttributeError):
+            logger.warning(f"Unparseable X-Business-Use-Case-Usage header: {business_usage}")
+
+    return usage, regain_seconds
+
+
+class RateLimiter:
+    """Global and per-recipient token buckets for outbound sends.
+
+    The global rate is scaled down as the usage reported by the Graph API approaches 100%,
+    and sends are paused while the API says access is blocked.
+    """
+
+    def __init__(self, rate=OUTBOUND_RATE, burst=OUTBOUND_BURST,
+                 recipient_rate=OUTBOUND_RECIPIENT_RATE, recipient_burst=OUTBOUND_RECIPIENT_BURST):
+        self.base_rate = rate
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self._lock = threading.Lock()
+        self._global = TokenBucket(rate, burst)
+        self._recipients = OrderedDict()
+        self._held = {}  # recipient_id -> monotonic time its deferred messages are due
+        self.blocked_until = 0
+        self.usage = 0
+
+    def acquire(self, recipient_id, queued=False):
+        """Take a token and return 0, or return seconds to wait without taking anything.
+
+        queued is set when sending from the delay queue, which is not held back by its own messages.
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            if self.blocked_until > now:
+                return self.blocked_until - now
+
+            # Keep order behind messages already waiting in the delay queue
+            held = None if queued else self._held.get(recipient_id)
+            if held is not None:
+                if held > now:
+                    return held - now
+                del self._held[recipient_id]
+
+            bucket = self._recipient_bucket(recipient_id)
+            delay = max(self._global.wait_time(now), bucket.wait_time(now))
+            if delay:
+                return delay
+
+            self._global.take()
+            bucket.take()
+            return 0
+
+    def hold(self, recipient_id, seconds):
+        """Make new sends to recipient_id wait until their deferred messages are due"""
+        with self._lock:
+            self._held[recipient_id] = max(self._held.get(recipient_id, 0), time.monotonic() + seconds)
+
+    def block(self, seconds):
+        """Pause all sends, e.g. after the API reported a rate limit error"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def adapt(self, headers):
+        """Scale the global rate to the usage reported in response headers"""
+        usage, regain_seconds = parse_usage(headers)
+        if regain_seconds:
+            self.block(regain_seconds)
+
+        if usage < OUTBOUND_THROTTLE_FROM:
+            factor = 1
+        else:
+            factor = max(OUTBOUND_MIN_RATE_FACTOR, (100 - usage) / (100 - OUTBOUND_THROTTLE_FROM))
+
+        with self._lock:
+            if usage != self.usage:
+                logger.info(f"Graph API usage {usage}%, outbound rate {self.base_rate * factor:.1f}/s")
+            self.usage = usage
+            self._global.rate = self.base_rate * factor
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'rate': self._global.rate,
+                'usage': self.usage,
+                'blocked_seconds': max(0, self.blocked_until - now),
+                'held_recipients': sum(1 for until in self._held.values() if until > now),
+            }
+
+    def _recipient_bucket(self, recipient_id):
+        bucket = self._recipients.get(recipient_id)
+        if bucket is None:
+            bucket = self._recipients[recipient_id] = TokenBucket(self.recipient_rate, self.recipient_burst)
+            while len(self._recipients) > MAX_RECIPIENT_BUCKETS:
+                self._recipients.popitem(last=False)
+        else:
+            self._recipients.move_to_end(recipient_id)
+        return bucket
+
+
+rate_limiter = RateLimiter()
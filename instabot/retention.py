@@ -0,0 +1,182 @@
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+from decouple import config
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .archive import MessageArchive
+from .models import InstaBotMessage, MaintenanceCheckpoint
+from .rollups import rollup_daily_stats
+
+logger = logging.getLogger(__name__)
+
+# Chat history older than this is not used for AI context and gets purged
+MESSAGE_RETENTION_HOURS = config('MESSAGE_RETENTION_HOURS', default=24, cast=int)
+# Rows deleted per transaction by the purge jobs
+PURGE_BATCH_SIZE = config('PURGE_BATCH_SIZE', default=5000, cast=int)
+# Move expired messages to ArchivedMessage instead of deleting them
+ARCHIVE_MESSAGES = config('ARCHIVE_MESSAGES', default=False, cast=bool)
+# Seconds a batch job holds its checkpoint without finishing a batch, a crashed run's lease expires
+CHECKPOINT_LEASE_SECONDS = 300
+
+
+def history_cutoff():
+    """Oldest timestamp still considered part of the conversation history"""
+    return timezone.now() - timedelta(hours=MESSAGE_RETENTION_HOURS)
+
+
+def has_cascades(model):
+    """True if deleting model rows has to touch other tables"""
+    return any(
+        getattr(relation, 'on_delete', None) is not models.DO_NOTHING
+        for relation in model._meta.related_objects
+    )
+
+
+def raw_delete(model, ids, using):
+    """DELETE ... WHERE pk IN ids without loading the rows, returns number deleted"""
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote(model._meta.db_table)} WHERE {quote(model._meta.pk.column)} '
+            f'IN ({", ".join(["%s"] * len(ids))})',
+            ids
+        )
+        return cursor.rowcount
+
+
+def acquire_checkpoint(name):
+    """Lease the MaintenanceCheckpoint name for a run, None while another run holds it"""
+    checkpoint, created = MaintenanceCheckpoint.objects.get_or_create(name=name)
+    now = timezone.now()
+    owner = uuid.uuid4().hex
+    acquired = MaintenanceCheckpoint.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+        pk=checkpoint.pk
+    ).update(owner=owner, locked_until=now + timedelta(seconds=CHECKPOINT_LEASE_SECONDS))
+    if not acquired:
+        return None
+    return MaintenanceCheckpoint.objects.get(pk=checkpoint.pk)
+
+
+def delete_in_batches(queryset, name, batch_size=PURGE_BATCH_SIZE, sleep=0, dry_run=False, on_batch=None,
+                      before_delete=None):
+    """Delete rows of queryset in primary key order, batch_size rows per transaction.
+
+    Progress is stored in the MaintenanceCheckpoint name, so an interrupted run resumes after
+    the last deleted batch; a finished run resets it. The checkpoint is leased for the run, a
+    concurrent run of the same job (the run_bot_workers retention job and cleanup_bot) is
+    skipped instead of moving the position under it. Models without cascading relations are
+    deleted with plain SQL, skipping the collector that loads every row and sends signals.
+    before_delete(ids) runs in the transaction of each batch, e.g. to copy the rows elsewhere.
+    With dry_run nothing is deleted and the rows that would be are counted.
+    Returns number of rows deleted.
+    """
+    model = queryset.model
+    using = queryset.db
+    position = 0
+    checkpoint = None
+    if not dry_run:
+        checkpoint = acquire_checkpoint(name)
+        if checkpoint is None:
+            logger.info(f"Skipping {name}, another run holds its checkpoint")
+            return 0
+        position = checkpoint.position
+    if position:
+        logger.info(f"Resuming {name} after id {position}")
+
+    total = 0
+    finished = False
+    try:
+        while True:
+            start_time = time.time()
+            ids = list(
+                queryset.filter(pk__gt=position).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                finished = True
+                break
+
+            if dry_run:
+                deleted = len(ids)
+            else:
+                with transaction.atomic(using=using):
+                    if before_delete:
+                        before_delete(ids)
+                    if has_cascades(model):
+                        deleted, _ = model.objects.using(using).filter(pk__in=ids).delete()
+                    else:
+                        deleted = raw_delete(model, ids, using)
+                    renewed = MaintenanceCheckpoint.objects.filter(pk=checkpoint.pk, owner=checkpoint.owner).update(
+                        position=ids[-1],
+                        locked_until=timezone.now() + timedelta(seconds=CHECKPOINT_LEASE_SECONDS),
+                        updated_at=timezone.now()
+                    )
+                    if not renewed:
+                        # Lease expired and taken over, that run continues from its own position
+                        transaction.set_rollback(True, using=using)
+                if not renewed:
+                    logger.warning(f"Lost the checkpoint of {name}, stopping")
+                    break
+            position = ids[-1]
+
+            total += deleted
+            if on_batch:
+                on_batch({
+                    'name': name,
+                    'deleted': deleted,
+                    'last_id': position,
+                    'seconds': time.time() - start_time,
+                })
+            if len(ids) < batch_size:
+                finished = True
+                break
+            if sleep:
+                # Lets live traffic take the table between batches
+                time.sleep(sleep)
+    finally:
+        if checkpoint is not None:
+            # The position is kept for the next run unless this one got through the table
+            released = {'owner': '', 'locked_until': None, 'updated_at': timezone.now()}
+            if finished:
+                released['position'] = 0
+            MaintenanceCheckpoint.objects.filter(pk=checkpoint.pk, owner=checkpoint.owner).update(**released)
+    return total
+
+
+def purge_expired_messages(retention_hours=None, batch_size=PURGE_BATCH_SIZE, sleep=0, dry_run=False, on_batch=None,
+                           archive=None):
+    """Delete expired chat history in primary key batches, returns number deleted.
+
+    Each batch is a separate short DELETE, so live traffic writing new messages is never
+    blocked by one large transaction. With an archive.MessageArchive, or ARCHIVE_MESSAGES set,
+    the messages are moved to the archive instead of being dropped.
+    """
+    if archive is None and ARCHIVE_MESSAGES and not dry_run:
+        with MessageArchive() as archive:
+            return purge_expired_messages(retention_hours, batch_size, sleep, dry_run, on_batch, archive)
+
+    if retention_hours is None:
+        retention_hours = MESSAGE_RETENTION_HOURS
+
+    if not dry_run:
+        # Daily message counts are kept after the messages themselves are gone
+        rollup_daily_stats()
+
+    cutoff = timezone.now() - timedelta(hours=retention_hours)
+    expired = InstaBotMessage.objects.filter(timestamp__lt=cutoff)
+    options = {'batch_size': batch_size, 'sleep': sleep, 'dry_run': dry_run, 'on_batch': on_batch}
+
+    if archive is not None:
+        deleted = delete_in_batches(expired, 'archive_messages', before_delete=archive.add, **options)
+    else:
+        deleted = delete_in_batches(expired, 'purge_messages', **options)
+
+    if deleted and not dry_run:
+        logger.info(f"{'Archived' if archive is not None else 'Purged'} {deleted} expired messages")
+    return deleted
@@ -0,0 +1,111 @@
+import logging
+from datetime import timedelta
+
+from decouple import config
+from django.db import transaction
+from django.db.models import Count, F, Max, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import (
+    ConversationSession, DailyProductStat, DailyStat, InstaBotMessage, MaintenanceCheckpoint, Purchase, PurchaseItem
+)
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = config('ROLLUP_BATCH_SIZE', default=10000, cast=int)
+# Rows younger than this wait for the next run, so ids committed out of order are not skipped
+ROLLUP_LAG_SECONDS = 30
+
+
+def add_to_daily_stats(rows):
+    """rows: [{'day', <field>: increment, ...}]"""
+    for row in rows:
+        day = row.pop('day')
+        DailyStat.objects.get_or_create(day=day)
+        DailyStat.objects.filter(day=day).update(
+            **{field: F(field) + (value or 0) for field, value in row.items()}
+        )
+
+
+def add_to_product_stats(rows):
+    for row in rows:
+        stat, created = DailyProductStat.objects.get_or_create(
+            day=row['day'],
+            product_name=row['product_name'],
+            defaults={'product_id': row['product_id']}
+        )
+        DailyProductStat.objects.filter(pk=stat.pk).update(
+            quantity=F('quantity') + row['quantity'],
+            revenue=F('revenue') + row['revenue']
+        )
+
+
+# checkpoint name -> (model, timestamp field, aggregation of a pk range, writer)
+SOURCES = {
+    'rollup_messages': (
+        InstaBotMessage, 'timestamp',
+        lambda rows: rows.values('day').annotate(messages=Count('id')),
+        add_to_daily_stats,
+    ),
+    'rollup_sessions': (
+        ConversationSession, 'created_at',
+        lambda rows: rows.values('day').annotate(new_sessions=Count('id')),
+        add_to_daily_stats,
+    ),
+    'rollup_purchases': (
+        Purchase, 'timestamp',
+        lambda rows: rows.values('day').annotate(orders=Count('id'), revenue=Sum('total_amount')),
+        add_to_daily_stats,
+    ),
+    'rollup_purchase_items': (
+        PurchaseItem, 'purchase__timestamp',
+        lambda rows: rows.values('day', 'product_name').annotate(
+            quantity=Sum('quantity'), revenue=Sum('subtotal'), product_id=Max('product_id')
+        ),
+        add_to_product_stats,
+    ),
+}
+
+
+def rollup_batch(name, batch_size=ROLLUP_BATCH_SIZE):
+    """Add the next batch of rows after the checkpoint to the rollups, returns number of rows"""
+    model, time_field, aggregate, write = SOURCES[name]
+    settled_before = timezone.now() - timedelta(seconds=ROLLUP_LAG_SECONDS)
+
+    with transaction.atomic():
+        # Locked, concurrent runs wait instead of counting rows twice
+        checkpoint, created = MaintenanceCheckpoint.objects.select_for_update().get_or_create(name=name)
+        ids = list(
+            model.objects.filter(pk__gt=checkpoint.position, **{f'{time_field}__lt': settled_before})
+            .order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0
+
+        rows = model.objects.filter(pk__gt=checkpoint.position, pk__lte=ids[-1]).annotate(day=TruncDate(time_field))
+        write(list(aggregate(rows).order_by()))
+
+        checkpoint.position = ids[-1]
+        checkpoint.save(update_fields=['position', 'updated_at'])
+    return len(ids)
+
+
+def rollup_daily_stats(batch_size=ROLLUP_BATCH_SIZE):
+    """Bring the daily rollups up to date, returns rows added per source.
+
+    Only rows created since the previous run are read, so the cost does not grow with history.
+    Chat history is purged after MESSAGE_RETENTION_HOURS, messages must be rolled up before that.
+    """
+    totals = {}
+    for name in SOURCES:
+        totals[name] = 0
+        while True:
+            added = rollup_batch(name, batch_size)
+            totals[name] += added
+            if added < batch_size:
+                break
+
+    if any(totals.values()):
+        logger.info(f"Rolled up daily stats: {totals}")
+    return totals
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ConversationSession
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached session is trusted before it is read again, 0 disables the cache. Only
+# run_bot_workers turns the cache on, see SessionStore
+SESSION_CACHE_TTL = config('SESSION_CACHE_TTL', default=30, cast=int)
+SESSION_CACHE_SIZE = config('SESSION_CACHE_SIZE', default=10000, cast=int)
+
+
+class SessionStore:
+    """Conversation sessions written once per message, optionally cached per process.
+
+    load() returns a session whose save() calls are deferred, commit() writes only the changed
+    fields. The version column detects sessions changed elsewhere since they were loaded; the
+    write is then rejected, as this message's changes were decided from an outdated state.
+
+    The cache is only valid where a single process handles all messages of a sender, i.e.
+    the run_bot_workers dispatcher, which enables it. Webhook processes handling messages
+    inline load every session from the database. A cached session expires ttl seconds after
+    it was read, whatever was written to it since.
+    """
+
+    def __init__(self, ttl=0, max_size=SESSION_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()  # sender_id -> (session, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.conflicts = 0
+
+    def load(self, sender_id):
+        """Cached or stored session of sender_id, a new unsaved one for unknown senders"""
+        now = time.time()
+        with self._lock:
+            cached = self._sessions.get(sender_id)
+            if cached and cached[1] > now:
+                self._sessions.move_to_end(sender_id)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        session = ConversationSession.objects.filter(sender_id=sender_id).first()
+        if session is None:
+            # Inserted by commit() together with the first changes
+            session = ConversationSession(sender_id=sender_id, current_state='idle')
+        session.write_behind = True
+        self._remember(session)
+        return session
+
+    def commit(self, session):
+        """Write changed fields of session, returns True if anything was written"""
+        if session.pk is None:
+            return self._insert(session)
+
+        fields = session.get_dirty_fields()
+        if not fields:
+            return False
+        changes = {name: getattr(session, name) for name in fields}
+
+        updated = ConversationSession.objects.filter(pk=session.pk, version=session.version).update(
+            **changes,
+            version=F('version') + 1,
+            updated_at=timezone.now()
+        )
+        if updated:
+            session.version += 1
+            session.mark_clean()
+            self.writes += 1
+            return True
+
+        self.evict(session.sender_id)
+        if not ConversationSession.objects.filter(pk=session.pk).exists():
+            # Deleted meanwhile, e.g. by cleanup_bot, nothing to conflict with
+            session.pk = None
+            return self._insert(session)
+
+        # Changed elsewhere since it was loaded, e.g. by another process or the admin. Mixing
+        # fields of both could pair a cart with the state of another turn, keep the stored row
+        self.conflicts += 1
+        logger.error(f"Session {session.sender_id} changed concurrently, discarding changes to {', '.join(fields)}")
+        return False
+
+    def evict(self, sender_id):
+        with self._lock:
+            self._sessions.pop(sender_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._sessions)
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'conflicts': self.conflicts,
+        }
+
+    def _insert(self, session):
+        session.write_behind = False
+        try:
+            with transaction.atomic():
+                session.save(force_insert=True)
+            inserted = True
+        except IntegrityError:
+            inserted = False
+        session.write_behind = True
+
+        if not inserted:
+            # Another process created the session first
+            self.evict(session.sender_id)
+            self.conflicts += 1
+            logger.error(f"Session {session.sender_id} created concurrently, discarding this message's changes")
+            return False
+
+        self.writes += 1
+        # The whole row was just written, cache it again after the post_save eviction
+        self._remember(session)
+        return True
+
+    def _remember(self, session):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._sessions[session.sender_id] = (session, time.time() + self.ttl)
+            self._sessions.move_to_end(session.sender_id)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+
+session_store = SessionStore()
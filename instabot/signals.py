@@ -0,0 +1,34 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import invalidate_catalog
+from .keywords import invalidate_classifier
+from .models import ConversationSession, KeywordRule, Product
+from .session_store import session_store
+from .tracing import install_query_counter
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog_on_product_change(sender, **kwargs):
+    """Covers admin edits too, including list_editable price/availability changes"""
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=KeywordRule)
+@receiver(post_delete, sender=KeywordRule)
+def invalidate_classifier_on_rule_change(sender, **kwargs):
+    invalidate_classifier()
+
+
+@receiver(post_save, sender=ConversationSession)
+@receiver(post_delete, sender=ConversationSession)
+def evict_session_on_change(sender, instance, **kwargs):
+    """Sessions saved outside the session store, e.g. by the admin or management commands"""
+    session_store.evict(instance.sender_id)
+
+
+@receiver(connection_created)
+def count_queries_on_new_connection(sender, connection, **kwargs):
+    install_query_counter(connection)
@@ -0,0 +1,143 @@
+import contextvars
+import re
+import time
+from contextlib import contextmanager
+
+from decouple import config
+
+from . import tracing
+
+# Stream AI replies to Instagram sentence by sentence instead of waiting for the full completion
+AI_STREAMING = config('AI_STREAMING', default=False, cast=bool)
+# Sentences are merged until a chunk has at least this many characters
+STREAM_MIN_CHUNK_CHARS = config('STREAM_MIN_CHUNK_CHARS', default=80, cast=int)
+
+SENTENCE_END = re.compile(r'[.!?…]+[)"»]*\s+|\n+')
+
+_target = contextvars.ContextVar('stream_target', default=None)
+
+
+class StreamTarget:
+    """Recipient of the message being processed and the text already delivered to them"""
+
+    def __init__(self, recipient_id):
+        self.recipient_id = recipient_id
+        self.delivered = ''
+        self.chunks = 0
+        self.started_at = time.perf_counter()
+        self.first_chunk_ms = None
+
+    def record_chunk(self, text):
+        self.delivered += text
+        self.chunks += 1
+        if self.first_chunk_ms is None:
+            self.first_chunk_ms = (time.perf_counter() - self.started_at) * 1000
+
+    def remainder(self, reply):
+        """Part of the final reply that still has to be sent"""
+        if not self.delivered:
+            return reply
+        if reply.startswith(self.delivered):
+            return reply[len(self.delivered):].strip()
+        # Handler replaced the streamed text (error path), send it in full
+        return reply
+
+
+@contextmanager
+def stream_to(recipient_id):
+    """Let generate_ai_response deliver chunks to recipient_id while the block runs"""
+    target = StreamTarget(recipient_id)
+    token = _target.set(target)
+    try:
+        yield target
+    finally:
+        _target.reset(token)
+
+
+def current_target():
+    """Active StreamTarget when streaming is enabled, otherwise None"""
+    if not AI_STREAMING:
+        return None
+    return _target.get()
+
+
+class SentenceChunker:
+    """Accumulate streamed deltas and cut them into sentence-sized messages"""
+
+    def __init__(self, min_chars=STREAM_MIN_CHUNK_CHARS):
+        self.min_chars = min_chars
+        self.buffer = ''
+
+    def feed(self, delta):
+        """Add delta, return list of complete chunks ready to send"""
+        self.buffer += delta
+        chunks = []
+        while True:
+            cut = None
+            for match in SENTENCE_END.finditer(self.buffer):
+                if match.end() >= self.min_chars:
+                    cut = match.end()
+                    break
+            if cut is None:
+                return chunks
+            chunks.append(self.buffer[:cut])
+            self.buffer = self.buffer[cut:]
+
+    def flush(self):
+        """Return whatever is left once the stream ends"""
+        chunk, self.buffer = self.buffer, ''
+        return [chunk] if chunk.strip() else []
+
+
+def iter_deltas(stream):
+    """Text deltas of an OpenAI-compatible chat completion stream"""
+    for event in stream:
+        usage = tracing.stream_usage(event)
+        if usage:
+            tracing.record_tokens('reply', usage)
+        if event.choices:
+            delta = event.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+def deliver_stream(stream, target, send):
+    """Send completed sentences of stream to target as they arrive, return the full text"""
+    chunker = SentenceChunker()
+    text = ''
+
+    for delta in iter_deltas(stream):
+        text += delta
+        for chunk in chunker.feed(delta):
+            send(chunk.strip(), target.recipient_id)
+            target.record_chunk(chunk)
+
+    for chunk in chunker.flush():
+        send(chunk.strip(), target.recipient_id)
+        target.record_chunk(chunk)
+
+    return text
+
+
+async def deliver_stream_async(stream, target, send):
+    """Async variant of deliver_stream, send is a coroutine function"""
+    chunker = SentenceChunker()
+    text = ''
+
+    async for event in stream:
+        usage = tracing.stream_usage(event)
+        if usage:
+            tracing.record_tokens('reply', usage)
+        delta = event.choices[0].delta.content if event.choices else None
+        if not delta:
+            continue
+        text += delta
+        for chunk in chunker.feed(delta):
+            await send(chunk.strip(), target.recipient_id)
+            target.record_chunk(chunk)
+
+    for chunk in chunker.flush():
+        await send(chunk.strip(), target.recipient_id)
+        target.record_chunk(chunk)
+
+    return text
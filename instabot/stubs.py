@@ -0,0 +1,232 @@
+"""Local stand-ins for the LLM and Graph APIs, used by the bench_* management commands"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "Здравствуйте! У нас есть триммеры Philips и Xiaomi, машинки для стрижки и насадки. "
+    "Триммер для бороды Philips стоит 3500 сом и отлично подходит для ежедневного ухода. "
+    "Доставка по Бишкеку бесплатная при заказе от 5000 сом. "
+    "Напишите, какой товар вас интересует, и я помогу оформить заказ!"
+)
+
+
+class StubServer:
+    """Threaded HTTP server on a free local port"""
+
+    handler_class = None
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self._server.server_address[1]}'
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), self.handler_class)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, Nagle would stall keep-alive connections
+    disable_nagle_algorithm = True
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockLLMHandler(StubHandler):
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_json({'error': {'message': 'not found'}}, status=404)
+            return
+
+        request = self.read_json()
+        stub = self.stub
+        with stub.lock:
+            stub.requests += 1
+            failing = stub.fail_every and stub.requests % stub.fail_every == 0
+        time.sleep(stub.first_token_ms / 1000)
+
+        if failing:
+            self.send_json({'error': {'message': 'Internal server error', 'type': 'server_error'}}, status=500)
+            return
+
+        if request.get('stream'):
+            self.stream_reply(request)
+        else:
+            time.sleep(stub.token_ms * len(stub.tokens) / 1000)
+            self.send_json({
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', 'stub'),
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': stub.reply},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(stub.tokens), 'total_tokens': len(stub.tokens)},
+            })
+
+    def stream_reply(self, request):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        for index, token in enumerate(self.stub.tokens):
+            if index:
+                time.sleep(self.stub.token_ms / 1000)
+            self.write_event({
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': request.get('model', 'stub'),
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+            })
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.write_chunk(b'')
+
+    def write_event(self, data):
+        self.write_chunk(f'data: {json.dumps(data, ensure_ascii=False)}\n\n'.encode('utf-8'))
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class MockLLMServer(StubServer):
+    """OpenAI-compatible chat completions endpoint with configurable latency.
+
+    first_token_ms is the delay before the first token, token_ms the delay between tokens;
+    non-streaming requests wait for the whole reply like the real API.
+    Every fail_every-th request is answered with 500.
+    """
+
+    handler_class = MockLLMHandler
+
+    def __init__(self, reply=DEFAULT_REPLY, first_token_ms=300, token_ms=20, fail_every=0, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.first_token_ms = first_token_ms
+        self.token_ms = token_ms
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def tokens(self):
+        words = self.reply.split(' ')
+        return [word + ' ' for word in words[:-1]] + words[-1:]
+
+
+class GraphHandler(StubHandler):
+    def setup(self):
+        super().setup()
+        with self.stub.lock:
+            self.stub.connections += 1
+
+    def do_POST(self):
+        body = self.read_json()
+        stub = self.stub
+        received_at = time.perf_counter()
+        with stub.lock:
+            stub.calls += 1
+            failing = stub.fail_every and stub.calls % stub.fail_every == 0
+            if not failing:
+                stub.received.append((received_at, body))
+
+        time.sleep(stub.latency_ms / 1000)
+        if failing and stub.fail_status != 429:
+            self.send_json({'error': {'message': 'Invalid parameter', 'code': 100}}, status=stub.fail_status)
+            return
+        if failing:
+            # Rate limited the way the Graph API does it, the client must back off
+            self.send_json(
+                {'error': {'message': 'Application request limit reached', 'code': 4}},
+                status=429,
+                headers={'Retry-After': str(stub.retry_after)}
+            )
+            return
+
+        recipient = body.get('recipient', {}).get('id')
+        headers = {'X-App-Usage': json.dumps(stub.app_usage)} if stub.app_usage else None
+        self.send_json({'recipient_id': str(recipient), 'message_id': f'stub-{len(stub.received)}'}, headers=headers)
+
+
+class GraphStubServer(StubServer):
+    """Accepts Send API calls and records when each one arrived.
+
+    Every fail_every-th call is answered with fail_status, 429 by default with a Retry-After of
+    retry_after seconds, connections counts TCP connections opened.
+    app_usage, e.g. {'call_count': 90}, is returned in the X-App-Usage header.
+    """
+
+    handler_class = GraphHandler
+
+    def __init__(self, latency_ms=50, fail_every=0, fail_status=429, retry_after=0, app_usage=None, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_ms = latency_ms
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.app_usage = app_usage
+        self.lock = threading.Lock()
+        self.received = []
+        self.calls = 0
+        self.connections = 0
+
+    def reset(self):
+        with self.lock:
+            self.received = []
+            self.calls = 0
+            self.connections = 0
+
+    def messages_for(self, recipient_id):
+        """[(received_at, body)] of text messages sent to recipient_id"""
+        with self.lock:
+            return [
+                (received_at, body) for received_at, body in self.received
+                if str(body.get('recipient', {}).get('id')) == str(recipient_id) and 'message' in body
+            ]
@@ -0,0 +1,120 @@
+import logging
+
+from decouple import config
+from django.db.models import Max
+
+from . import tracing, views
+from .models import ConversationSession, InstaBotMessage
+from .prompts import PROMPT_HISTORY_TURNS
+from .retention import history_cutoff
+from .session_store import session_store
+
+logger = logging.getLogger(__name__)
+
+# Turns that fell out of the prompt window needed before the summary is updated
+SUMMARY_MIN_NEW_TURNS = config('SUMMARY_MIN_NEW_TURNS', default=4, cast=int)
+SUMMARY_MAX_CHARS = config('SUMMARY_MAX_CHARS', default=600, cast=int)
+SUMMARY_MODEL = config('SUMMARY_MODEL', default='google/gemma-3n-e4b-it')
+
+
+def get_summary_prompt():
+    return f"""Ты ведешь краткое содержание переписки магазина триммеров с клиентом.
+Обнови содержание с учетом новых сообщений. Сохрани важное: какие товары интересовали клиента,
+что он заказал или хотел заказать, его вопросы, жалобы и договоренности.
+Пиши от третьего лица, без приветствий, не длиннее {SUMMARY_MAX_CHARS} символов."""
+
+
+def format_turns(turns):
+    names = {'user': 'Клиент', 'assistant': 'Бот'}
+    return "\n".join(f"{names.get(role, role)}: {content}" for role, content, timestamp in turns)
+
+
+def turns_to_summarize(session):
+    """Messages after summarized_until that are older than the raw prompt window, oldest first"""
+    messages = InstaBotMessage.objects.filter(sender_id=session.sender_id)
+    if session.summarized_until:
+        messages = messages.filter(timestamp__gt=session.summarized_until)
+
+    # Cheap check first, most sessions have nothing new outside the window
+    if messages.count() - PROMPT_HISTORY_TURNS < SUMMARY_MIN_NEW_TURNS:
+        return []
+
+    turns = list(messages.order_by('-timestamp').values_list('role', 'content', 'timestamp'))
+    # The newest turns are sent to the AI as they are
+    return list(reversed(turns[PROMPT_HISTORY_TURNS:]))
+
+
+def summarize_session(session):
+    """Fold turns that left the prompt window into the session summary. Returns True if updated"""
+    turns = turns_to_summarize(session)
+    if len(turns) < SUMMARY_MIN_NEW_TURNS:
+        return False
+
+    if not views.is_ai_api_healthy():
+        return False
+
+    previous = session.conversation_summary or "Пока ничего."
+    try:
+        completion = views.client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": get_summary_prompt()},
+                {"role": "user", "content": f"Текущее содержание:\n{previous}\n\nНовые сообщения:\n{format_turns(turns)}"}
+            ],
+            timeout=views.AI_API_TIMEOUT,
+            max_tokens=300
+        )
+        summary = (completion.choices[0].message.content or '').strip()
+        tracing.record_tokens('summary', completion.usage)
+        views.record_ai_success()
+    except Exception as e:
+        logger.error(f"Error summarizing conversation for {session.sender_id}: {str(e)}")
+        views.record_ai_failure()
+        return False
+
+    if not summary:
+        return False
+
+    # Skip if another run updated the summary meanwhile
+    updated = ConversationSession.objects.filter(
+        pk=session.pk,
+        summarized_until=session.summarized_until
+    ).update(
+        conversation_summary=summary[:SUMMARY_MAX_CHARS],
+        summarized_until=turns[-1][2]
+    )
+    # update() skips the post_save eviction, a cached copy would keep and write back the old summary
+    session_store.evict(session.sender_id)
+    return bool(updated)
+
+
+def sessions_to_summarize():
+    """Sessions with recent turns that are not in their summary yet, most recently active first"""
+    latest = dict(
+        InstaBotMessage.objects.filter(timestamp__gte=history_cutoff())
+        .values('sender_id')
+        .annotate(last=Max('timestamp'))
+        .values_list('sender_id', 'last')
+    )
+    sessions = ConversationSession.objects.filter(sender_id__in=list(latest)).only(
+        'id', 'sender_id', 'conversation_summary', 'summarized_until'
+    )
+    pending = [
+        session for session in sessions
+        if session.summarized_until is None or latest[session.sender_id] > session.summarized_until
+    ]
+    pending.sort(key=lambda session: latest[session.sender_id], reverse=True)
+    return pending
+
+
+def summarize_pending(limit=50):
+    """Update up to limit summaries of recently active conversations, returns number updated"""
+    updated = 0
+    for session in sessions_to_summarize():
+        if updated >= limit:
+            break
+        if summarize_session(session):
+            updated += 1
+    if updated:
+        logger.info(f"Updated {updated} conversation summaries")
+    return updated
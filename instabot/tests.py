@@ -1,3 +1,964 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import async_views, event_queue, graph_api, outbound_queue, views
+from .archive import MessageArchive
+from .cart import price_cart
+from .catalog import get_catalog, invalidate_catalog
+from .circuit_breaker import CircuitBreaker
+from .dedupe import event_deduplicator
+from .dispatcher import SenderDispatcher
+from .intent_cache import IntentCache
+from .keywords import KeywordClassifier, best_intent, default_rules, get_classifier, invalidate_classifier
+from .management.commands import train_intent_model
+from .matcher import ProductMatcher
+from .models import (
+    ArchivedMessage, CircuitBreakerState, ConversationSession, DailyProductStat, DailyStat, InstaBotMessage,
+    IntentCacheEntry, MaintenanceCheckpoint, OutboundMessage, ProcessedEvent, Product, Purchase, PurchaseItem,
+    WebhookEvent,
+)
+from .prompts import build_prompt
+from .rate_limit import RateLimiter
+from .retention import purge_expired_messages
+from .rollups import rollup_daily_stats
+from .session_store import SessionStore, session_store
+from .streaming import SentenceChunker, StreamTarget, deliver_stream
+from .stubs import GraphStubServer
+
+RECIPIENT_ID = '990000000001'
+
+
+def create_products(count):
+    return Product.objects.bulk_create([
+        Product(name=f'Триммер {index}', description='Тест', category='trimmers', price=Decimal(100 + index))
+        for index in range(count)
+    ])
+
+
+class PriceCartQueriesTest(TestCase):
+    """Pricing a cart costs the same number of queries whatever its size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(10)
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def cart(self, size):
+        return [{'product_id': product.id, 'quantity': 2} for product in self.products[:size]]
+
+    def test_available_products_come_from_the_catalog(self):
+        get_catalog()
+        for size in (1, 10):
+            with self.assertNumQueries(0):
+                pricing = price_cart(self.cart(size))
+            self.assertEqual(len(pricing.lines), size)
+            self.assertEqual(pricing.total, sum(product.price * 2 for product in self.products[:size]))
+
+    def test_products_off_sale_are_loaded_in_one_query(self):
+        Product.objects.update(available=False)
+        invalidate_catalog()
+        get_catalog()
+        for size in (1, 10):
+            with self.assertNumQueries(1):
+                pricing = price_cart(self.cart(size))
+            self.assertEqual(len(pricing.lines), size)
+
+    def test_orders_are_priced_from_the_database(self):
+        get_catalog()
+        # Changed by another process, this one's catalog cache still has the old price
+        Product.objects.filter(pk=self.products[0].pk).update(price=Decimal('999.00'))
+        self.assertEqual(price_cart(self.cart(1)).total, self.products[0].price * 2)
+
+        for size in (1, 10):
+            with self.assertNumQueries(1):
+                pricing = price_cart(self.cart(size), current=True)
+            self.assertEqual(pricing.lines[0].product.price, Decimal('999.00'))
+            self.assertEqual(len(pricing.lines), size)
+
+    def test_confirmed_purchase_uses_current_prices(self):
+        get_catalog()
+        Product.objects.filter(pk=self.products[0].pk).update(price=Decimal('999.00'))
+        session = ConversationSession.objects.create(
+            sender_id=RECIPIENT_ID,
+            current_state='purchase_confirmation',
+            selected_products=self.cart(1),
+            collected_phone='+996555000000',
+            collected_address='Бишкек'
+        )
+
+        views.handle_purchase_confirmation(session, 'подтвердить')
+
+        purchase = Purchase.objects.get(sender_id=RECIPIENT_ID)
+        self.assertEqual(purchase.total_amount, Decimal('1998.00'))
+        self.assertEqual(purchase.items.get().price, Decimal('999.00'))
+
+    def test_deleted_products_are_reported_missing(self):
+        get_catalog()
+        items = self.cart(2) + [{'product_id': 999999, 'quantity': 1}]
+        with self.assertNumQueries(1):
+            pricing = price_cart(items)
+        self.assertEqual(len(pricing.lines), 2)
+        self.assertEqual(pricing.missing, [{'product_id': 999999, 'quantity': 1}])
+
+
+class ProductMatcherTest(SimpleTestCase):
+    def setUp(self):
+        self.wahl = Product(id=1, name='Wahl')
+        self.wahl_pro = Product(id=2, name='Wahl Pro')
+        self.philips = Product(id=3, name='Philips')
+        self.matcher = ProductMatcher([self.wahl, self.wahl_pro, self.philips])
+
+    def find(self, message):
+        return [(product.name, quantity) for product, quantity in self.matcher.find(message)]
+
+    def test_quantity_after_or_before_the_name(self):
+        self.assertEqual(self.find('Хочу philips 3 шт'), [('Philips', 3)])
+        self.assertEqual(self.find('2 шт philips'), [('Philips', 2)])
+        self.assertEqual(self.find('philips'), [('Philips', 1)])
+
+    def test_longest_name_wins(self):
+        self.assertEqual(self.find('wahl pro 2шт и wahl'), [('Wahl Pro', 2), ('Wahl', 1)])
+
+    def test_quantity_belongs_to_one_product(self):
+        self.assertEqual(self.find('wahl 2 шт philips'), [('Wahl', 2), ('Philips', 1)])
+
+    def test_repeated_product_takes_the_last_quantity(self):
+        self.assertEqual(self.find('wahl, wahl 5 шт'), [('Wahl', 5)])
+        self.assertEqual(self.find('wahl 2 шт, нет, wahl 3 шт и philips'), [('Wahl', 3), ('Philips', 1)])
+        self.assertEqual(self.find('wahl 4 шт, philips, wahl'), [('Wahl', 4), ('Philips', 1)])
+
+
+class GraphStubTestMixin:
+    """Points the Graph API client at a local stub server and gives it a fresh rate limiter"""
+
+    graph_latency_ms = 0
+    graph_fail_every = 0
+
+    def setUp(self):
+        super().setUp()
+        self.graph = GraphStubServer(latency_ms=self.graph_latency_ms, fail_every=self.graph_fail_every).start()
+        self.addCleanup(self.graph.stop)
+        self.use_rate_limiter(RateLimiter())
+        patcher = mock.patch.object(graph_api, 'GRAPH_API_URL', self.graph.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_rate_limiter(self, limiter):
+        for module in (graph_api, outbound_queue):
+            patcher = mock.patch.object(module, 'rate_limiter', limiter)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sent_texts(self, recipient_id=RECIPIENT_ID):
+        return [body['message']['text'] for received_at, body in self.graph.messages_for(recipient_id)]
+
+
+class OutboxTest(GraphStubTestMixin, TestCase):
+    graph_latency_ms = 200
+
+    def setUp(self):
+        super().setUp()
+        self.outbox = graph_api.Outbox(workers=2)
+        self.addCleanup(self.outbox.shutdown)
+
+    def submit_during_first_send(self, first, *rest, separator='\n\n'):
+        """Queue rest while first is in flight at the stub"""
+        futures = [self.outbox.submit(RECIPIENT_ID, first, separator)]
+        deadline = time.time() + 5
+        while not self.graph.calls and time.time() < deadline:
+            time.sleep(0.005)
+        return futures + [self.outbox.submit(RECIPIENT_ID, text, separator) for text in rest]
+
+    def test_replies_queued_during_a_send_are_coalesced(self):
+        futures = self.submit_during_first_send('Первый', 'Второй', 'Третий')
+        self.assertTrue(self.outbox.flush(RECIPIENT_ID, timeout=5))
+
+        self.assertEqual(self.sent_texts(), ['Первый', 'Второй\n\nТретий'])
+        self.assertIs(futures[1].result(), futures[2].result())
+        self.assertIn('message_id', futures[0].result())
+
+    def test_coalesced_messages_respect_the_length_limit(self):
+        self.outbox.max_chars = 15
+        self.submit_during_first_send('Первый', 'Второй', 'Третий', 'Четвертый')
+        self.assertTrue(self.outbox.flush(RECIPIENT_ID, timeout=5))
+
+        self.assertEqual(self.sent_texts(), ['Первый', 'Второй\n\nТретий', 'Четвертый'])
+
+    def test_streamed_chunks_are_joined_into_one_text(self):
+        self.submit_during_first_send('Здравствуйте!', 'Триммер стоит 3500 сом.', 'Доставка бесплатная.', separator=' ')
+        self.assertTrue(self.outbox.flush(RECIPIENT_ID, timeout=5))
+
+        self.assertEqual(self.sent_texts(), ['Здравствуйте!', 'Триммер стоит 3500 сом. Доставка бесплатная.'])
+
+    def test_typing_indicator_is_queued_ahead_of_the_reply(self):
+        start_time = time.time()
+        self.outbox.submit_typing(RECIPIENT_ID)
+        self.assertLess(time.time() - start_time, self.graph_latency_ms / 1000 / 2)
+        self.outbox.submit(RECIPIENT_ID, 'Ответ')
+        self.assertTrue(self.outbox.flush(RECIPIENT_ID, timeout=5))
+
+        self.assertEqual(
+            [body.get('sender_action') or body['message']['text'] for received_at, body in self.graph.received],
+            ['typing_on', 'Ответ']
+        )
+
+    def test_typing_indicator_is_skipped_while_rate_limited(self):
+        limiter = RateLimiter()
+        limiter.block(10)
+        self.use_rate_limiter(limiter)
+
+        self.assertIn('skipped', outbound_queue.deliver_typing(RECIPIENT_ID))
+        self.assertEqual(self.graph.calls, 0)
+
+    def test_recipients_are_sent_to_in_parallel(self):
+        other_id = '990000000002'
+        self.outbox.submit(RECIPIENT_ID, 'Первому')
+        self.outbox.submit(other_id, 'Второму')
+        self.assertTrue(self.outbox.flush(timeout=5))
+
+        self.assertEqual(self.sent_texts(), ['Первому'])
+        self.assertEqual(self.sent_texts(other_id), ['Второму'])
+        (first_at, first), (second_at, second) = self.graph.received
+        self.assertLess(abs(first_at - second_at), self.graph_latency_ms / 1000)
+
+
+class StreamingTest(SimpleTestCase):
+    def stream(self, text, size=7):
+        return [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[index:index + size]))])
+            for index in range(0, len(text), size)
+        ]
+
+    def test_deltas_are_cut_at_sentence_ends(self):
+        chunker = SentenceChunker(min_chars=10)
+        self.assertEqual(chunker.feed('Привет. Как '), [])
+        self.assertEqual(chunker.feed('дела? Всё'), ['Привет. Как дела? '])
+        self.assertEqual(chunker.flush(), ['Всё'])
+        self.assertEqual(chunker.flush(), [])
+
+    def test_stream_is_delivered_sentence_by_sentence(self):
+        first = 'Триммер Wahl подходит для бороды и усов, ' * 2 + 'доставка бесплатная. '
+        second = 'Напишите, сколько штук оформить.'
+        target = StreamTarget(RECIPIENT_ID)
+        sent = []
+
+        text = deliver_stream(self.stream(first + second), target, lambda chunk, recipient_id: sent.append(chunk))
+
+        self.assertEqual(text, first + second)
+        self.assertEqual(sent, [first.strip(), second])
+        self.assertEqual(target.chunks, 2)
+        self.assertIsNotNone(target.first_chunk_ms)
+        self.assertEqual(target.remainder(text), '')
+        # The handler replaced the streamed text
+        self.assertEqual(target.remainder('Извините, ошибка.'), 'Извините, ошибка.')
+
+
+class OutboxRateLimitTest(GraphStubTestMixin, TransactionTestCase):
+    """Replies the Graph API keeps throttling go to the delay queue, written from the send threads"""
+
+    graph_fail_every = 1
+
+    def test_throttled_reply_is_deferred_and_sent_later(self):
+        outbox = graph_api.Outbox(send=outbound_queue.deliver, workers=1)
+        self.addCleanup(outbox.shutdown)
+
+        result = outbox.submit(RECIPIENT_ID, 'Ответ').result(timeout=10)
+
+        message = OutboundMessage.objects.get(recipient_id=RECIPIENT_ID)
+        self.assertEqual(result, {'deferred': message.id})
+        self.assertEqual(message.status, 'pending')
+        self.assertIn('rate limit', message.last_error)
+        self.assertEqual(self.sent_texts(), [])
+
+        # The API recovers, the delay queue sends the reply once it is due
+        self.graph.fail_every = 0
+        self.use_rate_limiter(RateLimiter())
+        OutboundMessage.objects.filter(pk=message.pk).update(next_attempt_at=timezone.now())
+
+        self.assertEqual(outbound_queue.send_due_messages(), 1)
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'sent')
+        self.assertEqual(self.sent_texts(), ['Ответ'])
+
+    def test_throttled_reply_does_not_wait_for_retry_after(self):
+        self.graph.retry_after = 30
+
+        start_time = time.time()
+        result = outbound_queue.deliver('Ответ', RECIPIENT_ID)
+
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(self.graph.calls, 1)
+        message = OutboundMessage.objects.get(pk=result['deferred'])
+        self.assertGreater(message.next_attempt_at, timezone.now() + timedelta(seconds=25))
+
+    def test_reply_waits_behind_deferred_replies(self):
+        self.graph.fail_every = 0
+        older = OutboundMessage.objects.create(
+            recipient_id=RECIPIENT_ID, text='Старый', next_attempt_at=timezone.now() + timedelta(seconds=60)
+        )
+
+        result = outbound_queue.deliver('Новый', RECIPIENT_ID)
+
+        newer = OutboundMessage.objects.get(pk=result['deferred'])
+        self.assertGreaterEqual(newer.next_attempt_at, older.next_attempt_at)
+        self.assertEqual(self.sent_texts(), [])
+
+    def test_due_deferred_replies_are_sent_first(self):
+        self.graph.fail_every = 0
+        OutboundMessage.objects.create(recipient_id=RECIPIENT_ID, text='Старый', next_attempt_at=timezone.now())
+
+        outbound_queue.deliver('Новый', RECIPIENT_ID)
+
+        self.assertEqual(self.sent_texts(), ['Старый', 'Новый'])
+        self.assertFalse(OutboundMessage.objects.exclude(status='sent').exists())
+
+    def test_reply_is_sent_inline_when_it_cannot_be_deferred(self):
+        self.graph.fail_every = 2
+        self.graph.calls = 1
+        with mock.patch.object(outbound_queue, 'defer_message', side_effect=RuntimeError('database is down')):
+            result = outbound_queue.deliver('Ответ', RECIPIENT_ID)
+
+        self.assertIn('message_id', result)
+        self.assertEqual(self.sent_texts(), ['Ответ'])
+
+    def test_rejected_reply_is_retried_then_failed(self):
+        self.graph.fail_status = 400
+        message = OutboundMessage.objects.create(recipient_id=RECIPIENT_ID, text='Ответ', next_attempt_at=timezone.now())
+
+        self.assertEqual(outbound_queue.send_due_messages(), 0)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('pending', 1))
+        self.assertIn('400', message.last_error)
+
+        OutboundMessage.objects.filter(pk=message.pk).update(
+            attempts=outbound_queue.OUTBOUND_MAX_ATTEMPTS - 1,
+            next_attempt_at=timezone.now()
+        )
+        self.assertEqual(outbound_queue.send_due_messages(), 0)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('failed', outbound_queue.OUTBOUND_MAX_ATTEMPTS))
+
+
+
+class ConversationTurnQueriesTest(GraphStubTestMixin, TestCase):
+    """A conversation turn reads the session at most once and writes it once.
+
+    Queries of a turn: dedupe claim (savepoint, insert, release), user message, session read,
+    session write, reply. Replies go to the stub Graph server from the outbox threads.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.products = create_products(3)
+        invalidate_catalog()
+        get_catalog()
+        invalidate_classifier()
+        get_classifier()
+        self.version = ConversationSession.objects.create(sender_id=RECIPIENT_ID, current_state='browsing').version
+        event_deduplicator.clear()
+        self.addCleanup(session_store.clear)
+        self.addCleanup(graph_api.get_outbox().flush, timeout=5)
+        self.mids = 0
+
+    def send(self, text):
+        self.mids += 1
+        event = {'sender': {'id': RECIPIENT_ID}, 'message': {'mid': f'test-turn-{self.mids}', 'text': text}}
+        views.process_text_message(RECIPIENT_ID, text, event)
+
+    def test_turn_reads_and_writes_the_session_once(self):
+        with mock.patch.object(session_store, 'ttl', 0), self.assertNumQueries(7):
+            self.send('хочу купить')
+
+        session = ConversationSession.objects.get(sender_id=RECIPIENT_ID)
+        self.assertEqual(session.current_state, 'purchase_product_selection')
+        self.assertEqual(session.version, self.version + 1)
+
+    def test_cached_session_is_not_read_again(self):
+        product = self.products[1]
+        with mock.patch.object(session_store, 'ttl', 30):
+            with self.assertNumQueries(7):
+                self.send('хочу купить')
+            with self.assertNumQueries(6):
+                self.send(f'{product.name} 2 шт')
+
+        session = ConversationSession.objects.get(sender_id=RECIPIENT_ID)
+        self.assertEqual(session.get_selected_products(), [{'product_id': product.id, 'quantity': 2}])
+        self.assertEqual(session.version, self.version + 2)
+
+
+class SessionStoreTest(TestCase):
+    def setUp(self):
+        self.store = SessionStore()
+        ConversationSession.objects.create(sender_id=RECIPIENT_ID)
+
+    def stored_state(self):
+        return ConversationSession.objects.get(sender_id=RECIPIENT_ID).current_state
+
+    def test_changed_fields_are_written_once(self):
+        session = self.store.load(RECIPIENT_ID)
+        session.current_state = 'browsing'
+        session.save()
+        self.assertEqual(self.stored_state(), 'idle')
+
+        self.assertTrue(self.store.commit(session))
+        self.assertFalse(self.store.commit(session))
+        self.assertEqual(self.stored_state(), 'browsing')
+        self.assertEqual(self.store.stats()['writes'], 1)
+
+    def test_session_changed_elsewhere_is_not_overwritten(self):
+        session = self.store.load(RECIPIENT_ID)
+        ConversationSession.objects.filter(sender_id=RECIPIENT_ID).update(
+            current_state='complaint', version=F('version') + 1
+        )
+        session.current_state = 'browsing'
+
+        self.assertFalse(self.store.commit(session))
+        self.assertEqual(self.stored_state(), 'complaint')
+        self.assertEqual(self.store.stats()['conflicts'], 1)
+
+    def test_deleted_session_is_inserted_again(self):
+        session = self.store.load(RECIPIENT_ID)
+        ConversationSession.objects.all().delete()
+        session.current_state = 'browsing'
+
+        self.assertTrue(self.store.commit(session))
+        self.assertEqual(self.stored_state(), 'browsing')
+        self.assertEqual(self.store.stats()['conflicts'], 0)
+
+    def test_session_created_elsewhere_is_not_overwritten(self):
+        session = self.store.load('new-sender')
+        self.assertIsNone(session.pk)
+        ConversationSession.objects.create(sender_id='new-sender', current_state='complaint')
+        session.current_state = 'browsing'
+
+        self.assertFalse(self.store.commit(session))
+        self.assertEqual(ConversationSession.objects.get(sender_id='new-sender').current_state, 'complaint')
+        self.assertEqual(self.store.stats()['conflicts'], 1)
+
+
+class DedupeTest(GraphStubTestMixin, TestCase):
+    """Redelivered events are dropped, unless processing the first delivery failed"""
+
+    def setUp(self):
+        super().setUp()
+        event_deduplicator.clear()
+        self.addCleanup(session_store.clear)
+        self.addCleanup(graph_api.get_outbox().flush, timeout=5)
+
+    def deliver(self, text='каталог', mid='test-dedupe-1'):
+        event = {'sender': {'id': RECIPIENT_ID}, 'message': {'mid': mid, 'text': text}}
+        views.process_text_message(RECIPIENT_ID, text, event)
+
+    def user_messages(self):
+        return InstaBotMessage.objects.filter(sender_id=RECIPIENT_ID, role='user').count()
+
+    def test_redelivery_is_dropped_by_the_cache(self):
+        self.deliver()
+        with self.assertNumQueries(0):
+            self.deliver()
+        self.assertEqual(self.user_messages(), 1)
+
+    def test_redelivery_to_another_worker_is_dropped_by_the_table(self):
+        self.deliver()
+        event_deduplicator.clear()
+        self.deliver()
+        self.assertEqual(self.user_messages(), 1)
+
+    def test_failed_event_is_processed_on_redelivery(self):
+        with mock.patch.object(views, 'handle_conversation_flow', side_effect=RuntimeError('AI down')):
+            self.deliver()
+        self.assertFalse(ProcessedEvent.objects.filter(key='test-dedupe-1').exists())
+
+        self.deliver()
+        self.assertEqual(self.user_messages(), 2)
+        self.assertTrue(InstaBotMessage.objects.filter(sender_id=RECIPIENT_ID, role='assistant').exists())
+        self.assertTrue(ProcessedEvent.objects.filter(key='test-dedupe-1').exists())
+
+
+class KeywordRoutingTest(TestCase):
+    """Each state routes on its own keyword list, as the handlers did before the classifier"""
+
+    def setUp(self):
+        invalidate_classifier()
+        self.addCleanup(invalidate_classifier)
+
+    def route(self, route, state, text):
+        session = ConversationSession(sender_id=RECIPIENT_ID, current_state=state)
+        session.write_behind = True
+        reply = route(session, text)
+        return session.current_state, reply is not None
+
+    def test_idle(self):
+        cases = {
+            'Хочу купить триммер': 'ПОКУПКА',
+            'Можно оформить?': 'ПОКУПКА',
+            'Покажите каталог': 'КАТАЛОГ',
+            'Можно посмотреть?': 'КАТАЛОГ',
+            'Спасибо, отлично, хочу еще': 'ПОКУПКА',
+            'Машинка не работает': 'ЖАЛОБА',
+            'Здравствуйте': None,
+        }
+        for text, intent in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(views.classify_intent_by_keywords(text), intent)
+
+    def test_post_purchase(self):
+        cases = {
+            'Хочу еще один': 'purchase_product_selection',
+            'Можно купить насадки?': 'purchase_product_selection',
+            'Тоже возьму': 'purchase_product_selection',
+            'Что есть из машинок?': 'browsing',
+            'Хочу': 'idle',
+            'Возьму': 'idle',
+            'Оформить': 'idle',
+            'Ещё': 'idle',
+            'Можно посмотреть?': 'idle',
+        }
+        for text, state in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(
+                    self.route(views.route_post_purchase, 'post_purchase', text),
+                    (state, state != 'idle')
+                )
+
+    def test_browsing(self):
+        cases = {
+            'Хочу этот': 'purchase_product_selection',
+            'Возьму два': 'purchase_product_selection',
+            'Оформить': 'browsing',
+            'Еще покажите': 'browsing',
+        }
+        for text, state in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(
+                    self.route(views.route_browsing, 'browsing', text),
+                    (state, state != 'browsing')
+                )
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        self.probe = mock.Mock(return_value=False)
+        self.breaker = CircuitBreaker('test', self.probe, failure_threshold=1, reset_timeout=60)
+        self.breaker.get_state()
+        patcher = mock.patch('instabot.circuit_breaker.connection')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def shift(self, **seconds_ago):
+        now = timezone.now()
+        CircuitBreakerState.objects.filter(name='test').update(
+            **{field: now - timedelta(seconds=seconds) for field, seconds in seconds_ago.items()}
+        )
+        self.breaker._cached = None
+
+    def test_outage_is_counted_from_opening_across_failed_probes(self):
+        self.breaker.record_failure()
+        self.shift(opened_at=300)
+
+        with mock.patch.object(self.breaker, '_run_probe') as run_probe:
+            self.assertFalse(self.breaker.allow_request())
+        self.assertEqual(self.breaker.get_state().state, 'half_open')
+        run_probe.assert_called_once()
+
+        self.breaker._run_probe()
+        state = self.breaker.get_state()
+        self.assertEqual(state.state, 'open')
+        self.assertLess(state.opened_at, timezone.now() - timedelta(seconds=299))
+
+        # The next probe waits reset_timeout after the failed one
+        with mock.patch.object(self.breaker, '_run_probe') as run_probe:
+            self.assertFalse(self.breaker.allow_request())
+        run_probe.assert_not_called()
+
+        self.shift(probe_started_at=61)
+        self.probe.return_value = True
+        with mock.patch.object(self.breaker, '_run_probe'):
+            self.breaker.allow_request()
+        self.breaker._run_probe()
+
+        stats = self.breaker.stats()
+        self.assertEqual(stats['state'], 'closed')
+        self.assertGreaterEqual(stats['total_open_seconds'], 300)
+        self.assertEqual(stats['short_circuited'], 3)
+
+
+class AsyncSenderOrderTest(TestCase):
+    def test_sender_events_keep_order_across_requests(self):
+        handled = []
+
+        async def process(event):
+            mid = event['message']['mid']
+            handled.append(f'start {mid}')
+            if mid == 'first':
+                await asyncio.sleep(0.05)
+            handled.append(f'end {mid}')
+
+        def payload(mid):
+            return {'entry': [{'messaging': [{'sender': {'id': RECIPIENT_ID}, 'message': {'mid': mid}}]}]}
+
+        async def two_requests():
+            await asyncio.gather(
+                async_views.dispatch_webhook_payload_async(payload('first')),
+                async_views.dispatch_webhook_payload_async(payload('second')),
+            )
+
+        with mock.patch.object(async_views, 'process_messaging_event_async', process):
+            asyncio.run(two_requests())
+
+        self.assertEqual(handled, ['start first', 'end first', 'start second', 'end second'])
+
+
+class IntentCacheTest(TestCase):
+    def test_trivial_variations_share_an_entry(self):
+        cache = IntentCache(use_db=False)
+        cache.set('Хочу КУПИТЬ ёлку!', 'ПОКУПКА')
+        self.assertEqual(cache.get('хочу купить елку'), 'ПОКУПКА')
+        self.assertIsNone(cache.get('хочу вернуть елку'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_entries_are_shared_through_the_table(self):
+        IntentCache(ttl=60).set('Где мой заказ?', 'ЖАЛОБА')
+
+        other = IntentCache(ttl=60)
+        self.assertEqual(other.get('где мой заказ'), 'ЖАЛОБА')
+        self.assertEqual(other.db_hits, 1)
+
+        IntentCacheEntry.objects.update(updated_at=timezone.now() - timedelta(seconds=120))
+        self.assertIsNone(IntentCache(ttl=60).get('где мой заказ'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = IntentCache(max_size=2, use_db=False)
+        cache.set('первое', 'ВОПРОС')
+        cache.set('второе', 'ВОПРОС')
+        cache.get('первое')
+        cache.set('третье', 'ВОПРОС')
+        self.assertEqual(cache.get('первое'), 'ВОПРОС')
+        self.assertIsNone(cache.get('второе'))
+
+
+class PromptTest(TestCase):
+    def setUp(self):
+        create_products(30)
+        invalidate_catalog()
+        self.session = ConversationSession(sender_id=RECIPIENT_ID, current_state='browsing')
+        now = timezone.now()
+        for index in range(6):
+            message = InstaBotMessage.objects.create(sender_id=RECIPIENT_ID, role='user', content=f'{index} ' + 'x' * 300)
+            InstaBotMessage.objects.filter(pk=message.pk).update(timestamp=now - timedelta(minutes=10 - index))
+
+    def test_prompt_fits_a_generous_budget_unchanged(self):
+        prompt = build_prompt(self.session, budget=100000)
+        self.assertEqual(prompt.catalog_mode, 'full')
+        self.assertEqual((prompt.history_turns, prompt.dropped_turns), (5, 0))
+        self.assertTrue(prompt.messages[-1]['content'].startswith('5 '))
+
+    def test_catalog_is_summarized_then_oldest_turns_dropped(self):
+        prompt = build_prompt(self.session, budget=600)
+        self.assertEqual(prompt.catalog_mode, 'summary')
+        self.assertGreater(prompt.dropped_turns, 0)
+        self.assertEqual(prompt.history_turns + prompt.dropped_turns, 5)
+        self.assertLessEqual(prompt.tokens, 600)
+        self.assertTrue(prompt.messages[-1]['content'].startswith('5 '))
+
+    def test_latest_turn_is_kept_over_budget(self):
+        prompt = build_prompt(self.session, budget=1)
+        self.assertEqual(prompt.history_turns, 1)
+        self.assertTrue(prompt.messages[-1]['content'].startswith('5 '))
+
+
+class BestIntentTest(TestCase):
+    """Keyword routing follows INTENT_PRIORITY unless score ranking is chosen"""
+
+    def setUp(self):
+        self.classifier = KeywordClassifier(default_rules())
+
+    def test_priority_ranking_routes_like_the_keyword_lists(self):
+        scores = self.classifier.score('Спасибо, отлично, хочу еще')
+        self.assertGreater(scores['БЛАГОДАРНОСТЬ'], scores['ПОКУПКА'])
+        self.assertEqual(best_intent(scores), 'ПОКУПКА')
+
+    def test_score_ranking_is_opt_in(self):
+        scores = self.classifier.score('Спасибо, отлично, хочу еще')
+        self.assertEqual(best_intent(scores, ranking='score'), 'БЛАГОДАРНОСТЬ')
+
+    def test_no_keyword_no_intent(self):
+        self.assertIsNone(best_intent(self.classifier.score('Здравствуйте')))
+        self.assertIsNone(best_intent({}, ranking='score'))
+
+
+class TrainIntentModelTest(TestCase):
+    def test_samples_are_messages_the_keywords_miss(self):
+        texts = {
+            'хочу купить триммер': 'ПОКУПКА',
+            'сколько идет доставка в ош': 'ВОПРОС',
+            'а гарантия есть': 'ВОПРОС',
+        }
+        IntentCacheEntry.objects.bulk_create([
+            IntentCacheEntry(key=str(index), text=text, intent=intent)
+            for index, (text, intent) in enumerate(texts.items())
+        ])
+
+        command = train_intent_model.Command(stdout=io.StringIO())
+        samples = command.collect_samples()
+
+        self.assertEqual(sorted(samples), [('а гарантия есть', 'ВОПРОС'), ('сколько идет доставка в ош', 'ВОПРОС')])
+
+
+class ClaimEventsTest(TestCase):
+    def abandoned_event(self, attempts):
+        started_at = timezone.now() - timedelta(seconds=event_queue.WEBHOOK_EVENT_VISIBILITY_TIMEOUT + 1)
+        return WebhookEvent.objects.create(payload='{}', status='processing', started_at=started_at, attempts=attempts)
+
+    def test_claim_counts_attempts(self):
+        pending = WebhookEvent.objects.create(payload='{}')
+        abandoned = self.abandoned_event(attempts=1)
+
+        claimed = event_queue.claim_events()
+
+        self.assertEqual([event.id for event in claimed], [pending.id, abandoned.id])
+        self.assertEqual([event.attempts for event in claimed], [1, 2])
+        abandoned.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.attempts), ('processing', 2))
+
+    def test_reclaimed_event_releases_its_messages(self):
+        event_deduplicator.clear()
+        self.addCleanup(event_deduplicator.clear)
+        abandoned = self.abandoned_event(attempts=1)
+        abandoned.payload = json.dumps({'entry': [{'messaging': [{'message': {'mid': 'test-reclaim-1'}}]}]})
+        abandoned.save()
+        self.assertTrue(event_deduplicator.claim('test-reclaim-1'))
+
+        event_queue.claim_events()
+
+        self.assertFalse(ProcessedEvent.objects.filter(key='test-reclaim-1').exists())
+        self.assertTrue(event_deduplicator.claim('test-reclaim-1'))
+
+    def test_failed_event_is_retried_until_max_attempts(self):
+        WebhookEvent.objects.create(payload='{}')
+
+        for attempt in range(1, event_queue.WEBHOOK_EVENT_MAX_ATTEMPTS + 1):
+            (event,) = event_queue.claim_events()
+            self.assertEqual(event.attempts, attempt)
+            event_queue.complete_event(event, error=RuntimeError('boom'))
+
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.last_error), ('failed', 'boom'))
+        self.assertEqual(event_queue.claim_events(), [])
+
+    def test_event_abandoned_too_often_is_failed(self):
+        abandoned = self.abandoned_event(attempts=event_queue.WEBHOOK_EVENT_MAX_ATTEMPTS)
+
+        self.assertEqual(event_queue.claim_events(), [])
+        abandoned.refresh_from_db()
+        self.assertEqual(abandoned.status, 'failed')
+        self.assertEqual(abandoned.attempts, event_queue.WEBHOOK_EVENT_MAX_ATTEMPTS)
+
+
+def create_messages(count, hours_ago, sender_id=RECIPIENT_ID):
+    messages = InstaBotMessage.objects.bulk_create([
+        InstaBotMessage(sender_id=sender_id, role='user', content=f'Сообщение {index}') for index in range(count)
+    ])
+    InstaBotMessage.objects.filter(pk__in=[message.pk for message in messages]).update(
+        timestamp=timezone.now() - timedelta(hours=hours_ago)
+    )
+    return sorted(message.pk for message in messages)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RetentionTest(TestCase):
+    def setUp(self):
+        self.expired = create_messages(12, hours_ago=48)
+        self.recent = create_messages(3, hours_ago=1)
+
+    def interrupt(self, batch):
+        raise Interrupted
+
+    def test_interrupted_purge_resumes_after_the_last_batch(self):
+        with self.assertRaises(Interrupted):
+            purge_expired_messages(retention_hours=24, batch_size=5, on_batch=self.interrupt)
+
+        checkpoint = MaintenanceCheckpoint.objects.get(name='purge_messages')
+        self.assertEqual((checkpoint.position, checkpoint.owner, checkpoint.locked_until), (self.expired[4], '', None))
+        self.assertEqual(InstaBotMessage.objects.count(), 10)
+
+        batches = []
+        self.assertEqual(purge_expired_messages(retention_hours=24, batch_size=5, on_batch=batches.append), 7)
+        self.assertEqual([batch['last_id'] for batch in batches], [self.expired[9], self.expired[11]])
+        self.assertEqual(sorted(InstaBotMessage.objects.values_list('pk', flat=True)), self.recent)
+        self.assertEqual(MaintenanceCheckpoint.objects.get(name='purge_messages').position, 0)
+
+    def test_run_is_skipped_while_another_holds_the_checkpoint(self):
+        MaintenanceCheckpoint.objects.create(
+            name='purge_messages', owner='other', locked_until=timezone.now() + timedelta(seconds=60)
+        )
+        self.assertEqual(purge_expired_messages(retention_hours=24, batch_size=5), 0)
+        self.assertEqual(InstaBotMessage.objects.count(), 15)
+
+        # The other run died, its lease expires
+        MaintenanceCheckpoint.objects.filter(name='purge_messages').update(locked_until=timezone.now())
+        self.assertEqual(purge_expired_messages(retention_hours=24, batch_size=5), 12)
+
+    def test_dry_run_counts_without_deleting(self):
+        self.assertEqual(purge_expired_messages(retention_hours=24, batch_size=5, dry_run=True), 12)
+        self.assertEqual(InstaBotMessage.objects.count(), 15)
+        self.assertFalse(MaintenanceCheckpoint.objects.exists())
+
+
+class ArchiveTest(TestCase):
+    def test_expired_messages_are_moved_to_the_archive(self):
+        expired = create_messages(5, hours_ago=48)
+        recent = create_messages(2, hours_ago=1)
+
+        with tempfile.TemporaryDirectory() as export_dir:
+            with MessageArchive(export_dir=export_dir) as archive:
+                self.assertEqual(purge_expired_messages(retention_hours=24, batch_size=2, archive=archive), 5)
+            with gzip.open(archive.path, 'rt', encoding='utf-8') as export:
+                exported = [json.loads(line)['id'] for line in export]
+
+            self.assertEqual(exported, expired)
+            self.assertEqual(sorted(ArchivedMessage.objects.values_list('message_id', flat=True)), expired)
+            self.assertEqual(sorted(InstaBotMessage.objects.values_list('pk', flat=True)), recent)
+
+    def test_empty_export_is_removed(self):
+        with tempfile.TemporaryDirectory() as export_dir:
+            with MessageArchive(export_dir=export_dir) as archive:
+                self.assertEqual(purge_expired_messages(retention_hours=24, archive=archive), 0)
+            self.assertIsNone(archive.path)
+            self.assertEqual(os.listdir(export_dir), [])
+
+
+class RollupTest(TestCase):
+    def setUp(self):
+        self.when = timezone.now() - timedelta(days=2)
+        self.day = timezone.localdate(self.when)
+
+    def add_messages(self, count):
+        InstaBotMessage.objects.filter(pk__in=create_messages(count, hours_ago=0)).update(timestamp=self.when)
+
+    def test_only_new_rows_are_added(self):
+        self.add_messages(3)
+        ConversationSession.objects.create(sender_id=RECIPIENT_ID)
+        ConversationSession.objects.update(created_at=self.when)
+        product = create_products(1)[0]
+        purchase = Purchase.objects.create(
+            sender_id=RECIPIENT_ID, phone_number='0555', address='Бишкек', customer_last_message='да',
+            total_amount=Decimal(200)
+        )
+        Purchase.objects.update(timestamp=self.when)
+        PurchaseItem.objects.create(
+            purchase=purchase, product=product, product_name=product.name, quantity=2, price=Decimal(100),
+            subtotal=Decimal(200)
+        )
+        # Too recent, left for the next run
+        create_messages(1, hours_ago=0)
+
+        totals = rollup_daily_stats()
+        self.assertEqual(totals['rollup_messages'], 3)
+        self.assertEqual(rollup_daily_stats(), dict.fromkeys(totals, 0))
+
+        self.add_messages(2)
+        rollup_daily_stats(batch_size=1)
+
+        stat = DailyStat.objects.get(day=self.day)
+        self.assertEqual((stat.messages, stat.new_sessions, stat.orders, stat.revenue), (5, 1, 1, Decimal(200)))
+        self.assertEqual(
+            list(DailyProductStat.objects.values_list('day', 'product_id', 'quantity', 'revenue')),
+            [(self.day, product.id, 2, Decimal(200))]
+        )
+
+
+class CleanupBotTest(TestCase):
+    def test_old_rows_are_deleted(self):
+        create_messages(4, hours_ago=48)
+        old = timezone.now() - timedelta(days=10)
+        for status in ('done', 'failed', 'pending'):
+            WebhookEvent.objects.create(payload='{}', status=status)
+        WebhookEvent.objects.update(created_at=old)
+        ConversationSession.objects.create(sender_id='old')
+        ConversationSession.objects.update(updated_at=old)
+        ConversationSession.objects.create(sender_id='recent')
+
+        call_command('cleanup_bot', '--sleep', '0', '--message-hours', '24', stdout=io.StringIO())
+
+        self.assertFalse(InstaBotMessage.objects.exists())
+        self.assertEqual(list(WebhookEvent.objects.values_list('status', flat=True)), ['pending'])
+        self.assertEqual(list(ConversationSession.objects.values_list('sender_id', flat=True)), ['recent'])
+
+
+class QueueWorkerTest(TransactionTestCase):
+    """A slow conversation does not hold up events of other senders"""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.handled = []
+        dispatcher = SenderDispatcher(concurrency=2)
+        self.addCleanup(dispatcher.shutdown)
+        patcher = mock.patch.object(views, 'get_dispatcher', return_value=dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(views, 'process_messaging_event', side_effect=self.process)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def process(self, event):
+        if event['sender']['id'] == 'slow':
+            self.release.wait(10)
+        self.handled.append(event['message']['mid'])
+
+    def enqueue(self, sender_id, mid):
+        return event_queue.enqueue_event(json.dumps(
+            {'entry': [{'messaging': [{'sender': {'id': sender_id}, 'message': {'mid': mid, 'text': 'x'}}]}]}
+        ))
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def status(self, event):
+        event.refresh_from_db()
+        return event.status
+
+    def test_events_are_claimed_while_a_slow_sender_runs(self):
+        slow = self.enqueue('slow', 'slow-1')
+        fast = self.enqueue('fast', 'fast-1')
+        stop_event = threading.Event()
+        worker = threading.Thread(
+            target=event_queue.run_worker, args=(stop_event,), kwargs={'batch_size': 2, 'poll_interval': 0.05}
+        )
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(stop_event.set)
+
+        self.assertTrue(self.wait_for(lambda: self.status(fast) == 'done'))
+        # Claimed after the first batch, while its slow event is still running
+        later = self.enqueue('fast', 'fast-2')
+        self.assertTrue(self.wait_for(lambda: self.status(later) == 'done'))
+        self.assertEqual(self.status(slow), 'processing')
+
+        self.release.set()
+        self.assertTrue(self.wait_for(lambda: self.status(slow) == 'done'))
+        self.assertEqual(self.handled, ['fast-1', 'fast-2', 'slow-1'])
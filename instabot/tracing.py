@@ -0,0 +1,226 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+# Share of messages traced, the rest only bump the message counter
+TRACE_SAMPLE_RATE = config('TRACE_SAMPLE_RATE', default=0.1, cast=float)
+
+# Upper bounds of the stage duration histogram, seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+_current = contextvars.ContextVar('instabot_trace', default=None)
+
+
+class Trace:
+    """Stage timings, DB query counts and LLM token usage of one processed message"""
+
+    def __init__(self, sender_id):
+        self.sender_id = sender_id
+        self.started = time.perf_counter()
+        self.total_ms = None
+        self.queries = 0
+        self.stages = {}  # name -> {'ms', 'queries', 'calls'}
+        self.tokens = {}  # call -> {'prompt', 'completion'}
+
+    def add_stage(self, name, ms, queries):
+        stage = self.stages.setdefault(name, {'ms': 0, 'queries': 0, 'calls': 0})
+        stage['ms'] += ms
+        stage['queries'] += queries
+        stage['calls'] += 1
+
+    def add_tokens(self, call, prompt, completion):
+        tokens = self.tokens.setdefault(call, {'prompt': 0, 'completion': 0})
+        tokens['prompt'] += prompt
+        tokens['completion'] += completion
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self.started) * 1000
+
+    def as_dict(self):
+        return {
+            'event': 'message_trace',
+            'sender_id': self.sender_id,
+            'total_ms': round(self.total_ms, 1),
+            'queries': self.queries,
+            'stages': {
+                name: {**stage, 'ms': round(stage['ms'], 1)}
+                for name, stage in self.stages.items()
+            },
+            'tokens': self.tokens,
+        }
+
+
+class Metrics:
+    """Process-wide aggregates of finished traces in Prometheus text format.
+
+    Counters are per process, each worker is scraped on its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.traced = 0
+        self.stages = {}  # name -> {'buckets', 'sum', 'count', 'queries'}
+        self.tokens = {}  # (call, kind) -> tokens
+
+    def count_message(self):
+        with self._lock:
+            self.messages += 1
+
+    def observe(self, trace):
+        timings = [(name, stage['ms'], stage['queries']) for name, stage in trace.stages.items()]
+        timings.append(('total', trace.total_ms, trace.queries))
+
+        with self._lock:
+            self.traced += 1
+            for name, ms, queries in timings:
+                stage = self.stages.setdefault(name, {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0, 'count': 0, 'queries': 0
+                })
+                seconds = ms / 1000
+                for index, bound in enumerate(LATENCY_BUCKETS):
+                    if seconds <= bound:
+                        stage['buckets'][index] += 1
+                stage['sum'] += seconds
+                stage['count'] += 1
+                stage['queries'] += queries
+
+    def add_tokens(self, call, prompt, completion):
+        with self._lock:
+            self.tokens[(call, 'prompt')] = self.tokens.get((call, 'prompt'), 0) + prompt
+            self.tokens[(call, 'completion')] = self.tokens.get((call, 'completion'), 0) + completion
+
+    def render(self):
+        with self._lock:
+            lines = [
+                '# HELP instabot_messages_total Messages processed',
+                '# TYPE instabot_messages_total counter',
+                f'instabot_messages_total {self.messages}',
+                '# HELP instabot_traced_messages_total Messages sampled for tracing',
+                '# TYPE instabot_traced_messages_total counter',
+                f'instabot_traced_messages_total {self.traced}',
+                '# HELP instabot_stage_duration_seconds Time spent per pipeline stage of traced messages',
+                '# TYPE instabot_stage_duration_seconds histogram',
+            ]
+            for name, stage in sorted(self.stages.items()):
+                for bound, count in zip(LATENCY_BUCKETS, stage['buckets']):
+                    lines.append(f'instabot_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'instabot_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+                lines.append(f'instabot_stage_duration_seconds_sum{{stage="{name}"}} {stage["sum"]:.6f}')
+                lines.append(f'instabot_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}')
+
+            lines += [
+                '# HELP instabot_stage_queries_total DB queries per pipeline stage of traced messages',
+                '# TYPE instabot_stage_queries_total counter',
+            ]
+            for name, stage in sorted(self.stages.items()):
+                lines.append(f'instabot_stage_queries_total{{stage="{name}"}} {stage["queries"]}')
+
+            lines += [
+                '# HELP instabot_llm_tokens_total LLM tokens used, all messages',
+                '# TYPE instabot_llm_tokens_total counter',
+            ]
+            for (call, kind), tokens in sorted(self.tokens.items()):
+                lines.append(f'instabot_llm_tokens_total{{call="{call}",type="{kind}"}} {tokens}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def trace(sender_id):
+    """Trace processing of one message if it is sampled, log and aggregate it at the end"""
+    metrics.count_message()
+    if random.random() >= TRACE_SAMPLE_RATE:
+        yield None
+        return
+
+    current = Trace(sender_id)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.finish()
+        metrics.observe(current)
+        logger.info(json.dumps(current.as_dict(), ensure_ascii=False))
+
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage of the current trace, no-op for unsampled messages"""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    queries = current.queries
+    try:
+        yield
+    finally:
+        current.add_stage(name, (time.perf_counter() - started) * 1000, current.queries - queries)
+
+
+def timed(name):
+    """Decorator recording each call of a sync or async function as stage name"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with stage(name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_tokens(call, usage):
+    """Add token usage of an LLM call, usage may be None when the provider omits it"""
+    if usage is None:
+        return
+    prompt = getattr(usage, 'prompt_tokens', 0) or 0
+    completion = getattr(usage, 'completion_tokens', 0) or 0
+    metrics.add_tokens(call, prompt, completion)
+
+    current = _current.get()
+    if current is not None:
+        current.add_tokens(call, prompt, completion)
+
+
+def stream_usage(event):
+    """Usage of a completion stream event: OpenAI sends it in the last chunk, Groq under x_groq"""
+    return getattr(event, 'usage', None) or getattr(getattr(event, 'x_groq', None), 'usage', None)
+
+
+def count_query(execute, sql, params, many, context):
+    current = _current.get()
+    if current is not None:
+        current.queries += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection):
+    """Count queries of every connection, the context variable picks the trace they belong to"""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
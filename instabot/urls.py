@@ -1,8 +1,11 @@
 from django.urls import path
 from .views import *
+from .async_views import webhook_async
 
 urlpatterns = [
     path('webhook/', webhook, name='webhook'),
+    path('webhook/async/', webhook_async, name='webhook_async'),
+    path('metrics/', metrics, name='metrics'),
     path('privacy_policy/', privacy_policy, name='privacy_policy'),
     path('', home_page, name='home_page')
 ]
@@ -3,30 +3,42 @@ from django.views.decorators.csrf import csrf_exempt
 from decouple import config
 from django.http import HttpResponse, JsonResponse
 import json
-import requests
 import re
 from openai import OpenAI
-from .models import InstaBotMessage, Product, ConversationSession, Purchase
+from .models import InstaBotMessage, Purchase, PurchaseItem
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
 import logging
-import time
 from groq import Groq
+from .event_queue import enqueue_event
+from .dispatcher import get_dispatcher
+from .catalog import get_catalog
+from .cart import price_cart
+from .prompts import build_prompt, get_state_prompt
+from .intent_cache import intent_cache
+from .keywords import best_intent, score_intents
+from .intent_model import predict_intent
+from . import graph_api, streaming, tracing
+from .dedupe import event_deduplicator, event_key
+from .session_store import session_store
+from .circuit_breaker import CircuitBreaker, AI_BREAKER_FAILURE_THRESHOLD, AI_BREAKER_RESET_TIMEOUT
+from concurrent.futures import wait
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 VERIFY_TOKEN = config('VERIFY_TOKEN')
-LONG_USER_ACCESS_TOKEN = config('LONG_USER_ACCESS_TOKEN')
 OPENAI_API_KEY = config('OPENAI_API_KEY')
 BOT_ID = config('BOT_ID')
-MAX_HISTORY_LENGTH = 10
 OPENAI_API_MODEL = config('OPENAI_API_MODEL')
+# Store webhook events in the queue table and let run_bot_workers process them
+WEBHOOK_QUEUE_MODE = config('WEBHOOK_QUEUE_MODE', default=False, cast=bool)
+# Bearer token required by the metrics endpoint, empty leaves it open
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+INTENTS = ['ПОКУПКА', 'КАТАЛОГ', 'ИНФОРМАЦИЯ', 'ЖАЛОБА', 'БЛАГОДАРНОСТЬ', 'ПРОЧЕЕ']
 
-# AI API health tracking
-AI_API_LAST_SUCCESS = None
-AI_API_FAILURE_COUNT = 0
-AI_API_MAX_FAILURES = 3
 AI_API_TIMEOUT = 10
 
 # client = OpenAI(
@@ -36,6 +48,8 @@ AI_API_TIMEOUT = 10
 
 client = Groq(
     api_key=config("OPENAI_API_KEY"),
+    # Point at a compatible server, e.g. the stub from instabot/stubs.py
+    base_url=config("GROQ_BASE_URL", default="") or None,
 )
 
 def get_intent_prompt():
@@ -51,38 +65,7 @@ def get_intent_prompt():
 
 
 def get_system_prompt_by_state(state, session=None):
-    prompts = {
-        'idle': """Ты — вежливый помощник магазина триммеров и товаров для парикмахеров в Бишкеке. 
-Отвечай кратко и по делу. Доставка по Бишкеку бесплатная. 
-Предложи посмотреть каталог или помоги с вопросами. Если клиент недавно сделал заказ, 
-поблагодари его и предложи дополнительную помощь.""",
-
-        'browsing': """Ты показываешь каталог товаров. Предоставь информацию о доступных товарах 
-из базы данных. Помоги клиенту выбрать товар и добавить в корзину.""",
-
-        'purchase_product_selection': """Клиент добавляет товары в корзину. Помоги выбрать товары, 
-показывай цены и наличие. После выбора товаров предложи оформить заказ.""",
-
-        'purchase_collecting_phone': """Собери номер телефона клиента для заказа. 
-Объясни, что номер нужен для связи по доставке. Проверь, что номер введен корректно.""",
-
-        'purchase_collecting_address': """Собери адрес доставки. Уточни точный адрес в Бишкеке 
-для бесплатной доставки.""",
-
-        'purchase_confirmation': """Покажи итоговую информацию о заказе: товары, количество, 
-общую сумму, адрес доставки. Попроси подтвердить заказ словом 'Подтвердить'.""",
-
-        'complaint': """Обрабатывай жалобу клиента вежливо и профессионально. 
-Извинись и предложи решение проблемы.""",
-
-        'inquiry': """Отвечай на общие вопросы о товарах, доставке, оплате. 
-Будь информативным но кратким.""",
-
-        'post_purchase': """Клиент только что сделал заказ. Отвечай дружелюбно, 
-предлагай дополнительную помощь или товары. Напомни о возможности связаться при необходимости."""
-    }
-
-    base_prompt = prompts.get(state, prompts['idle'])
+    base_prompt = get_state_prompt(state)
 
     if session and session.get_selected_products():
         cart_info = f"\nТекущая корзина клиента: {format_cart(session)}"
@@ -97,61 +80,36 @@ def format_cart(session):
     if not products:
         return "Корзина пуста"
 
-    cart_text = []
-    total = 0
-
-    for item in products:
-        try:
-            product = Product.objects.get(id=item['product_id'])
-            quantity = item['quantity']
-            subtotal = product.price * quantity
-            total += subtotal
-            cart_text.append(f"• {product.name} x{quantity} = {subtotal} сом")
-        except Product.DoesNotExist:
-            continue
-
-    cart_text.append(f"\nИтого: {total} сом")
+    cart = price_cart(products)
+    cart_text = [str(line) for line in cart.lines]
+    cart_text.append(f"\nИтого: {cart.total} сом")
     return "\n".join(cart_text)
 
 
 def format_product_catalog():
     """Format available products for display"""
-    products = Product.objects.filter(available=True)
-    if not products:
-        return "К сожалению, товаров нет в наличии."
-
-    catalog_text = ["📋 Наши товары:\n"]
-
-    for product in products:
-        catalog_text.append(f"🔹 {product.name}")
-        catalog_text.append(f"   Цена: {product.price} сом")
-        catalog_text.append(f"   {product.description}\n")
-
-    catalog_text.append("Доставка по Бишкеку бесплатная! 🚚")
-    return "\n".join(catalog_text)
+    return get_catalog().text
 
 
 def extract_product_from_message(message):
     """Extract product selection from user message"""
-    # Try to find product by name (case insensitive)
-    products = Product.objects.filter(available=True)
+    products = extract_products_from_message(message)
+    if products:
+        return products[0]
 
-    for product in products:
-        if product.name.lower() in message.lower():
-            # Try to extract quantity
-            quantity_match = re.search(r'(\d+)\s*шт|(\d+)\s*штук|(\d+)\s*штуки', message.lower())
-            quantity = 1
-            if quantity_match:
-                quantity = int(quantity_match.group(1) or quantity_match.group(2) or quantity_match.group(3))
+    return None, None
 
-            return product.id, quantity
 
-    return None, None
+def extract_products_from_message(message):
+    """Extract every mentioned product with its quantity as (product_id, quantity) pairs"""
+    return [
+        (product.id, quantity)
+        for product, quantity in get_catalog().matcher.find(message)
+    ]
 
 
 def check_ai_api_health():
     """Check if AI API is responding"""
-    global AI_API_LAST_SUCCESS, AI_API_FAILURE_COUNT
 
     try:
         # Simple test request
@@ -164,33 +122,33 @@ def check_ai_api_health():
             timeout=5,
             max_tokens=10
         )
-
-        if completion.choices[0].message.content:
-            AI_API_LAST_SUCCESS = time.time()
-            AI_API_FAILURE_COUNT = 0
-            return True
+        return bool(completion.choices[0].message.content)
 
     except Exception as e:
         logger.error(f"AI API health check failed: {str(e)}")
-        AI_API_FAILURE_COUNT += 1
         return False
 
-    return False
 
+# Shared by all workers, probes run in the background while open
+ai_breaker = CircuitBreaker(
+    'ai_api',
+    probe=check_ai_api_health,
+    failure_threshold=AI_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=AI_BREAKER_RESET_TIMEOUT
+)
 
-def is_ai_api_healthy():
-    """Check if AI API is considered healthy"""
-    global AI_API_FAILURE_COUNT, AI_API_LAST_SUCCESS
 
-    # If too many recent failures, consider unhealthy
-    if AI_API_FAILURE_COUNT >= AI_API_MAX_FAILURES:
-        return False
+def record_ai_success():
+    ai_breaker.record_success()
 
-    # If last success was more than 5 minutes ago, do a health check
-    if AI_API_LAST_SUCCESS is None or (time.time() - AI_API_LAST_SUCCESS) > 300:
-        return check_ai_api_health()
 
-    return True
+def record_ai_failure():
+    ai_breaker.record_failure()
+
+
+def is_ai_api_healthy():
+    """False while the breaker is open, callers should use the fallback"""
+    return ai_breaker.allow_request()
 
 
 def get_fallback_response(state, user_message):
@@ -231,6 +189,9 @@ def get_fallback_response(state, user_message):
     }
 
     return fallback_responses.get(state, fallback_responses['idle'])
+
+
+def extract_phone_from_message(message):
     """Extract phone number from message"""
     # Look for phone patterns
     phone_patterns = [
@@ -269,14 +230,12 @@ def webhook(request):
     elif request.method == 'POST':
         try:
             data = json.loads(request.body)
-            for entry in data.get("entry", []):
-                if 'messaging' in entry:
-                    process_message(entry['messaging'])
-                elif 'comments' in entry:
-                    process_comment(entry['comments'])
-                elif 'mention' in entry:
-                    process_mention(entry['mention'])
 
+            if WEBHOOK_QUEUE_MODE:
+                enqueue_event(request.body)
+                return JsonResponse({"status": "Event queued"})
+
+            dispatch_webhook_payload(data)
             return JsonResponse({"status": "Event processed"})
 
         except Exception as e:
@@ -284,6 +243,24 @@ def webhook(request):
             return JsonResponse({"error": str(e)}, status=400)
 
 
+def dispatch_webhook_payload(data):
+    """Route webhook entries to their handlers and wait for them to finish"""
+    wait(submit_webhook_payload(data))
+
+
+def submit_webhook_payload(data):
+    """Route webhook entries to their handlers, returning futures of dispatched messages"""
+    futures = []
+    for entry in data.get("entry", []):
+        if 'messaging' in entry:
+            futures += submit_messages(entry['messaging'])
+        elif 'comments' in entry:
+            process_comment(entry['comments'])
+        elif 'mention' in entry:
+            process_mention(entry['mention'])
+    return futures
+
+
 def privacy_policy(request):
     return render(request, 'privacy_policy.html')
 
@@ -292,53 +269,97 @@ def home_page(request):
     return render(request, 'home.html')
 
 
+def metrics(request):
+    """Pipeline stage timings, query counts and token usage in Prometheus text format"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return HttpResponse('Invalid metrics token', status=403)
+    return HttpResponse(tracing.metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def process_message(data):
-    for event in data:
-        message = event.get("message", {})
-        sender_id = event.get("sender", {}).get("id")
+    """Process messaging events, concurrently across senders and in order per sender"""
+    wait(submit_messages(data))
 
-        if sender_id == BOT_ID:
-            continue
 
-        text = message.get("text")
-        if not text:
-            continue
+def submit_messages(data):
+    dispatcher = get_dispatcher()
+    return [
+        dispatcher.submit(event.get("sender", {}).get("id"), process_messaging_event, event)
+        for event in data
+    ]
 
-        try:
-            # Clean up old messages
-            expiry = timezone.now() - timedelta(hours=24)
-            InstaBotMessage.objects.filter(sender_id=sender_id, timestamp__lt=expiry).delete()
 
-            # Save user message
+def process_messaging_event(event):
+    message = event.get("message", {})
+    sender_id = event.get("sender", {}).get("id")
+
+    if sender_id == BOT_ID:
+        return
+
+    text = message.get("text")
+    if not text:
+        return
+
+    with tracing.trace(sender_id):
+        process_text_message(sender_id, text, event)
+
+
+def process_text_message(sender_id, text, event):
+    """Store the message, run the conversation flow and deliver the reply"""
+    # Meta redelivers events it considers unacknowledged
+    key = event_key(event)
+    with tracing.stage('dedupe'):
+        claimed = event_deduplicator.claim(key)
+    if not claimed:
+        logger.info(f"Dropping duplicate event {key} from {sender_id}")
+        return
+
+    try:
+        # Save user message
+        with tracing.stage('save_message'):
             InstaBotMessage.objects.create(
                 sender_id=sender_id,
                 role="user",
                 content=text
             )
 
-            # Get or create session
-            session, created = ConversationSession.objects.get_or_create(
-                sender_id=sender_id,
-                defaults={'current_state': 'idle'}
-            )
+        # Cached session, its save() calls are deferred to the commit below
+        with tracing.stage('session'):
+            session = session_store.load(sender_id)
 
-            # Process message based on current state
+        # Process message based on current state, AI replies may be streamed to the user meanwhile
+        with tracing.stage(f'state:{session.current_state}'), streaming.stream_to(str(sender_id)) as target:
             reply = handle_conversation_flow(session, text)
 
-            # Save bot response
+        # State changes of the whole message in one write
+        with tracing.stage('session_write'):
+            session_store.commit(session)
+
+        # Save bot response
+        with tracing.stage('save_reply'):
             InstaBotMessage.objects.create(
                 sender_id=sender_id,
                 role="assistant",
                 content=reply
             )
 
-            send_message(reply, str(sender_id))
+        remainder = target.remainder(reply)
+        if remainder:
+            send_message(remainder, str(sender_id))
 
-        except Exception as e:
-            logger.error(f"Error processing message from {sender_id}: {str(e)}")
-            # Send fallback message
-            fallback_message = "Извините, произошла техническая ошибка. Попробуйте еще раз или напишите 'помощь' для начала."
-            send_message(fallback_message, str(sender_id))
+    except Exception as e:
+        logger.error(f"Error processing message from {sender_id}: {str(e)}")
+        # The cached copy may hold changes that were never written
+        session_store.evict(sender_id)
+        # Not handled, a redelivery of the event is processed again
+        event_deduplicator.release(key)
+        # Send fallback message
+        fallback_message = "Извините, произошла техническая ошибка. Попробуйте еще раз или напишите 'помощь' для начала."
+        send_message(fallback_message, str(sender_id))
+
+    # Event counts as handled once its replies are delivered
+    with tracing.stage('send'):
+        graph_api.get_outbox().flush(str(sender_id))
 
 
 def handle_conversation_flow(session, user_message):
@@ -405,56 +426,52 @@ def handle_idle_state(session, user_message):
         # Classify intent using AI
         intent = classify_intent(user_message)
 
-        if intent == 'КАТАЛОГ':
-            session.current_state = 'browsing'
-            session.save()
-            return f"📋 Вот наш каталог:\n\n{format_product_catalog()}\n\nЧто вас интересует?"
+        reply = route_idle_intent(session, intent)
+        if reply is None:
+            return generate_ai_response(session, user_message)
+        return reply
 
-        elif intent == 'ПОКУПКА':
-            session.current_state = 'purchase_product_selection'
-            session.save()
-            return f"Отлично! Давайте выберем товары:\n\n{format_product_catalog()}\n\nНапишите название товара, который хотите купить."
+    except Exception as e:
+        logger.error(f"Error in idle state for {session.sender_id}: {str(e)}")
+        return "Привет! Чем могу помочь? Могу показать каталог товаров или ответить на ваши вопросы."
 
-        elif intent == 'ИНФОРМАЦИЯ':
-            session.current_state = 'inquiry'
-            session.save()
-            return generate_ai_response(session, user_message)
 
-        elif intent == 'ЖАЛОБА':
-            session.current_state = 'complaint'
-            session.save()
-            return "Мне очень жаль, что у вас возникли проблемы. Расскажите подробнее, что случилось, и я постараюсь помочь."
+def route_idle_intent(session, intent):
+    """Apply classified intent in idle state. Returns None when an AI response is needed"""
 
-        elif intent == 'БЛАГОДАРНОСТЬ':
-            return "Спасибо большое! Рады были вам помочь. Если понадобится что-то еще, обращайтесь! 😊"
+    if intent == 'КАТАЛОГ':
+        session.current_state = 'browsing'
+        session.save()
+        return f"📋 Вот наш каталог:\n\n{format_product_catalog()}\n\nЧто вас интересует?"
 
-        else:
-            return generate_ai_response(session, user_message)
+    elif intent == 'ПОКУПКА':
+        session.current_state = 'purchase_product_selection'
+        session.save()
+        return f"Отлично! Давайте выберем товары:\n\n{format_product_catalog()}\n\nНапишите название товара, который хотите купить."
 
-    except Exception as e:
-        logger.error(f"Error in idle state for {session.sender_id}: {str(e)}")
-        return "Привет! Чем могу помочь? Могу показать каталог товаров или ответить на ваши вопросы."
+    elif intent == 'ИНФОРМАЦИЯ':
+        session.current_state = 'inquiry'
+        session.save()
+        return None
+
+    elif intent == 'ЖАЛОБА':
+        session.current_state = 'complaint'
+        session.save()
+        return "Мне очень жаль, что у вас возникли проблемы. Расскажите подробнее, что случилось, и я постараюсь помочь."
+
+    elif intent == 'БЛАГОДАРНОСТЬ':
+        return "Спасибо большое! Рады были вам помочь. Если понадобится что-то еще, обращайтесь! 😊"
+
+    return None
 
 
 def handle_post_purchase_state(session, user_message):
     """Handle messages after recent purchase"""
 
     try:
-        # Check for new purchase intent
-        if any(word in user_message.lower() for word in ['купить', 'заказать', 'еще', 'также', 'тоже']):
-            session.current_state = 'purchase_product_selection'
-            session.save()
-            return f"Конечно! Вот наш каталог:\n\n{format_product_catalog()}\n\nЧто хотите добавить к заказу?"
-
-        # Check for catalog request
-        if any(word in user_message.lower() for word in ['каталог', 'товары', 'что есть']):
-            session.current_state = 'browsing'
-            session.save()
-            return f"📋 Наш каталог:\n\n{format_product_catalog()}"
-
-        # Default response for post-purchase
-        session.current_state = 'idle'
-        session.save()
+        reply = route_post_purchase(session, user_message)
+        if reply is not None:
+            return reply
 
         response = generate_ai_response(session, user_message)
         if not response:
@@ -469,15 +486,36 @@ def handle_post_purchase_state(session, user_message):
         return "Спасибо за заказ! Чем еще могу помочь?"
 
 
+def route_post_purchase(session, user_message):
+    """Apply keyword routing after a purchase. Returns None when an AI response is needed"""
+
+    scores = score_intents(user_message)
+
+    # Check for new purchase intent
+    if scores.get('ДОПОЛНИТЬ'):
+        session.current_state = 'purchase_product_selection'
+        session.save()
+        return f"Конечно! Вот наш каталог:\n\n{format_product_catalog()}\n\nЧто хотите добавить к заказу?"
+
+    # Check for catalog request
+    if scores.get('ПОКАЗАТЬ_КАТАЛОГ'):
+        session.current_state = 'browsing'
+        session.save()
+        return f"📋 Наш каталог:\n\n{format_product_catalog()}"
+
+    # Default response for post-purchase
+    session.current_state = 'idle'
+    session.save()
+    return None
+
+
 def handle_browsing_state(session, user_message):
     """Handle browsing catalog state"""
 
     try:
-        # Check if user wants to buy something
-        if any(word in user_message.lower() for word in ['купить', 'заказать', 'хочу', 'возьму']):
-            session.current_state = 'purchase_product_selection'
-            session.save()
-            return "Отлично! Напишите название товара, который хотите купить."
+        reply = route_browsing(session, user_message)
+        if reply is not None:
+            return reply
 
         return generate_ai_response(session, user_message)
 
@@ -486,25 +524,40 @@ def handle_browsing_state(session, user_message):
         return f"Вот наш каталог:\n\n{format_product_catalog()}\n\nЧто вас интересует?"
 
 
+def route_browsing(session, user_message):
+    """Apply keyword routing while browsing. Returns None when an AI response is needed"""
+
+    # Check if user wants to buy something
+    if score_intents(user_message).get('ВЫБРАТЬ'):
+        session.current_state = 'purchase_product_selection'
+        session.save()
+        return "Отлично! Напишите название товара, который хотите купить."
+
+    return None
+
+
 def handle_product_selection_state(session, user_message):
     """Handle product selection for purchase"""
 
     try:
-        # Check for product in message
-        product_id, quantity = extract_product_from_message(user_message)
-
-        if product_id:
-            session.add_product(product_id, quantity)
+        # Check for products in message
+        selected = extract_products_from_message(user_message)
+
+        if selected:
+            catalog = get_catalog()
+            added = []
+            for product_id, quantity in selected:
+                session.add_product(product_id, quantity)
+                added.append(f"{catalog.by_id[product_id].name} x{quantity}")
             session.save()
 
-            product = Product.objects.get(id=product_id)
-            response = f"✅ Добавил в корзину: {product.name} x{quantity}\n\n"
+            response = f"✅ Добавил в корзину: {', '.join(added)}\n\n"
             response += f"Ваша корзина:\n{format_cart(session)}\n\n"
             response += "Хотите добавить еще товары или оформить заказ?"
             return response
 
         # Check if wants to proceed to order
-        if any(word in user_message.lower() for word in ['заказ', 'оформить', 'купить', 'хватит', 'достаточно']):
+        if score_intents(user_message).get('ОФОРМЛЕНИЕ'):
             if session.get_selected_products():
                 session.current_state = 'purchase_collecting_phone'
                 session.save()
@@ -548,22 +601,11 @@ def handle_address_collection_state(session, user_message):
             session.save()
 
             # Prepare order summary
-            products_info = []
-            total = 0
-
-            for item in session.get_selected_products():
-                try:
-                    product = Product.objects.get(id=item['product_id'])
-                    quantity = item['quantity']
-                    subtotal = product.price * quantity
-                    total += subtotal
-                    products_info.append(f"• {product.name} x{quantity} = {subtotal} сом")
-                except Product.DoesNotExist:
-                    continue
+            cart = price_cart(session.get_selected_products())
 
             summary = f"📋 Подтверждение заказа:\n\n"
-            summary += "\n".join(products_info)
-            summary += f"\n\nИтого: {total} сом"
+            summary += "\n".join(str(line) for line in cart.lines)
+            summary += f"\n\nИтого: {cart.total} сом"
             summary += f"\nТелефон: {session.collected_phone}"
             summary += f"\nАдрес: {session.collected_address}"
             summary += f"\nДоставка: БЕСПЛАТНО"
@@ -591,37 +633,43 @@ def handle_purchase_confirmation(session, user_message):
     """Process confirmed purchase"""
 
     try:
-        # Prepare products data for Purchase model
-        products_data = []
-        total_amount = 0
-
-        for item in session.get_selected_products():
-            try:
-                product = Product.objects.get(id=item['product_id'])
-                quantity = item['quantity']
-                subtotal = product.price * quantity
-                total_amount += subtotal
-
-                products_data.append({
-                    'product_id': product.id,
-                    'product_name': product.name,
-                    'quantity': quantity,
-                    'price': float(product.price),
-                    'subtotal': float(subtotal)
-                })
-            except Product.DoesNotExist:
-                continue
-
-        # Create purchase record
-        purchase = Purchase.objects.create(
-            sender_id=session.sender_id,
-            phone_number=session.collected_phone,
-            address=session.collected_address,
-            customer_last_message=user_message,
-            total_amount=total_amount
-        )
-        purchase.set_products_data(products_data)
-        purchase.save()
+        # Prepare products data for Purchase model, priced from the database rather than the
+        # catalog cache so the order carries current prices
+        cart = price_cart(session.get_selected_products(), current=True)
+        total_amount = cart.total
+
+        products_data = [
+            {
+                'product_id': line.product.id,
+                'product_name': line.product.name,
+                'quantity': line.quantity,
+                'price': float(line.product.price),
+                'subtotal': float(line.subtotal)
+            }
+            for line in cart.lines
+        ]
+
+        # Create purchase record with its lines
+        with transaction.atomic():
+            purchase = Purchase.objects.create(
+                sender_id=session.sender_id,
+                products_data=products_data,
+                phone_number=session.collected_phone,
+                address=session.collected_address,
+                customer_last_message=user_message,
+                total_amount=total_amount
+            )
+            PurchaseItem.objects.bulk_create([
+                PurchaseItem(
+                    purchase=purchase,
+                    product=line.product,
+                    product_name=line.product.name,
+                    quantity=line.quantity,
+                    price=line.product.price,
+                    subtotal=line.subtotal
+                )
+                for line in cart.lines
+            ])
 
         # Set to post-purchase state instead of completely resetting
         session.current_state = 'post_purchase'
@@ -682,101 +730,91 @@ def handle_inquiry_state(session, user_message):
         return "Чем могу помочь? Могу показать каталог товаров или ответить на ваши вопросы."
 
 
+@tracing.timed('classify_intent')
 def classify_intent(user_message):
     """Classify user intent using AI with fallback"""
-    global AI_API_FAILURE_COUNT
-
-    # Simple keyword-based fallback classification
-    message_lower = user_message.lower()
 
-    # Check for purchase intent
-    if any(word in message_lower for word in ['купить', 'заказать', 'хочу', 'возьму', 'оформить']):
-        return 'ПОКУПКА'
+    intent = classify_intent_by_keywords(user_message)
+    if intent:
+        return intent
 
-    # Check for catalog intent
-    if any(word in message_lower for word in ['каталог', 'товары', 'что есть', 'показать', 'посмотреть']):
-        return 'КАТАЛОГ'
+    # Repeated messages skip the AI round-trip
+    intent = intent_cache.get(user_message)
+    if intent:
+        return intent
 
-    # Check for complaints
-    if any(word in message_lower for word in ['жалоба', 'плохо', 'не работает', 'недоволен', 'проблема']):
-        return 'ЖАЛОБА'
-
-    # Check for gratitude
-    if any(word in message_lower for word in ['спасибо', 'благодарю', 'отлично', 'хорошо']):
-        return 'БЛАГОДАРНОСТЬ'
+    # Local model trained on past classifications, escalate to AI only when unsure
+    intent = predict_intent(user_message)
+    if intent:
+        return intent
 
     # Try AI classification if API is healthy
     if is_ai_api_healthy():
         try:
             completion = client.chat.completions.create(
                 model="google/gemma-3n-e4b-it",
-                messages=[
-                    {"role": "system", "content": get_intent_prompt()},
-                    {"role": "user", "content": user_message}
-                ],
+                messages=get_intent_messages(user_message),
                 timeout=AI_API_TIMEOUT,
                 max_tokens=20
             )
 
             intent = completion.choices[0].message.content.strip().upper()
+            tracing.record_tokens('intent', completion.usage)
 
             # Reset failure count on success
-            AI_API_FAILURE_COUNT = 0
-            global AI_API_LAST_SUCCESS
-            AI_API_LAST_SUCCESS = time.time()
+            record_ai_success()
 
-            if intent in ['ПОКУПКА', 'КАТАЛОГ', 'ИНФОРМАЦИЯ', 'ЖАЛОБА', 'БЛАГОДАРНОСТЬ', 'ПРОЧЕЕ']:
+            if intent in INTENTS:
+                intent_cache.set(user_message, intent)
                 return intent
 
         except Exception as e:
             logger.error(f"Error classifying intent with AI: {str(e)}")
-            AI_API_FAILURE_COUNT += 1
+            record_ai_failure()
 
     # Fallback to simple classification
     return 'ПРОЧЕЕ'
 
 
-def generate_ai_response(session, user_message):
-    """Generate AI response with fallback when API fails"""
-    global AI_API_FAILURE_COUNT
+def get_intent_messages(user_message):
+    return [
+        {"role": "system", "content": get_intent_prompt()},
+        {"role": "user", "content": user_message}
+    ]
 
-    # If AI API is not healthy, use fallback immediately
-    # if not is_ai_api_healthy():
-    #     logger.warning(f"AI API unhealthy, using fallback for {session.sender_id}")
-    #     return get_fallback_response(session.current_state, user_message)
 
-    try:
-        # Get recent messages for context
-        recent_messages = InstaBotMessage.objects.filter(
-            sender_id=session.sender_id
-        ).order_by('-timestamp')[:MAX_HISTORY_LENGTH]
-        recent_messages = list(reversed(recent_messages))
+def classify_intent_by_keywords(user_message):
+    """Keyword-based classification. Returns None when nothing matched"""
+    return best_intent(score_intents(user_message))
 
-        # Prepare context
-        messages = [{"role": "system", "content": get_system_prompt_by_state(session.current_state, session)}]
 
-        # Add product catalog to context
-        if session.current_state in ['browsing', 'purchase_product_selection', 'post_purchase']:
-            products_context = f"Доступные товары:\n{format_product_catalog()}"
-            messages.append({"role": "system", "content": products_context})
+@tracing.timed('ai_response')
+def generate_ai_response(session, user_message):
+    """Generate AI response with fallback when API fails"""
 
-        # Add conversation history
-        messages += [{"role": msg.role, "content": msg.content} for msg in recent_messages[-5:]]
+    # If AI API is not healthy, use fallback immediately
+    if not is_ai_api_healthy():
+        logger.warning(f"AI API unhealthy, using fallback for {session.sender_id}")
+        return get_fallback_response(session.current_state, user_message)
 
-        completion = client.chat.completions.create(
-            model="google/gemma-3n-e4b-it",
-            messages=messages,
-            timeout=AI_API_TIMEOUT,
-            max_tokens=200
-        )
+    target = streaming.current_target()
 
-        response = completion.choices[0].message.content
+    try:
+        if target is not None:
+            response = stream_ai_response(session, target)
+        else:
+            completion = client.chat.completions.create(
+                model="google/gemma-3n-e4b-it",
+                messages=build_ai_messages(session),
+                timeout=AI_API_TIMEOUT,
+                max_tokens=200
+            )
+            response = completion.choices[0].message.content
+            tracing.record_tokens('reply', completion.usage)
 
         if response and len(response.strip()) > 0:
             # Success - reset failure count and update last success time
-            AI_API_FAILURE_COUNT = 0
-            global AI_API_LAST_SUCCESS
-            AI_API_LAST_SUCCESS = time.time()
+            record_ai_success()
             return response
         else:
             # Empty response - treat as failure
@@ -784,36 +822,47 @@ def generate_ai_response(session, user_message):
 
     except Exception as e:
         logger.error(f"Error generating AI response for {session.sender_id}: {str(e)}")
-        AI_API_FAILURE_COUNT += 1
+        record_ai_failure()
 
         # Return fallback response
         return get_fallback_response(session.current_state, user_message)
 
 
+def stream_ai_response(session, target):
+    """Show typing indicator, then send the completion sentence by sentence as it streams"""
+    # Queued, the stream is opened without waiting for the Graph API
+    send_typing(target.recipient_id)
+
+    stream = client.chat.completions.create(
+        model="google/gemma-3n-e4b-it",
+        messages=build_ai_messages(session),
+        timeout=AI_API_TIMEOUT,
+        max_tokens=200,
+        stream=True
+    )
+    return streaming.deliver_stream(stream, target, send_stream_chunk)
+
+
+@tracing.timed('build_prompt')
+def build_ai_messages(session):
+    """Prepare system prompt, catalog and history for the AI request within the token budget"""
+    cart_text = format_cart(session) if session.get_selected_products() else None
+    return build_prompt(session, cart_text=cart_text).messages
+
+
 def send_message(reply, recipient_id):
-    """Send message via Instagram Graph API"""
+    """Queue message for the Instagram Graph API, the returned Future resolves to the API response"""
+    return graph_api.get_outbox().submit(str(recipient_id), reply)
 
-    try:
-        url = f'https://graph.instagram.com/v21.0/me/messages'
-        headers = {
-            'Authorization': f'Bearer {LONG_USER_ACCESS_TOKEN}',
-            'Content-Type': "application/json"
-        }
-        json_body = {
-            'recipient': {
-                'id': int(recipient_id)
-            },
-            'message': {
-                'text': str(reply)
-            }
-        }
 
-        response = requests.post(url, headers=headers, json=json_body, timeout=10)
-        return response.json()
+def send_stream_chunk(chunk, recipient_id):
+    """Queue a streamed chunk, chunks joined while a send is in flight continue the same text"""
+    return graph_api.get_outbox().submit(str(recipient_id), chunk, separator=' ')
 
-    except Exception as e:
-        logger.error(f"Error sending message to {recipient_id}: {str(e)}")
-        return {"error": str(e)}
+
+def send_typing(recipient_id):
+    """Queue typing indicator shown while the reply is generated, sent ahead of the reply"""
+    return graph_api.get_outbox().submit_typing(str(recipient_id))
 
 
 def process_comment(data):